@@ -1,45 +1,77 @@
 import numpy as np
 import re
 import os
+from filters import fft_filter, gaussian_kernel
 
 def average_sample(sensor_data):
     data = np.mean(sensor_data, axis=0)
     return data
 
-def calib_data(calib_coeffs, sensor_data, sensitivity=5):
+def calib_data(calib_coeffs, sensor_data, sensitivity=5, out=None):
     '''
     Arguments:
         calib_coeffs is a (3,3,7) numpy array of calibration coefficients
         sensitivity is the volts per tesla of the probe.  Use only either 5 (2 T range) or 100 (100 mT range)
             default range is 2 T
         sensor_data should be a (n, 4) numpy array (Bx, By, Bz, Temperature(in volts))
+            any strided view works, e.g. a column slice of a stream chunk
+        out is an optional (n, 3) array the result is written into
     Returns:
         function returns (n, 3) calibrated hall sensor readings (Bx,By,Bz) in mT
     '''
     Bxyz = sensor_data[:, :-1]
-    temp_v = calib_coeffs[0, 0, 6] * (sensor_data[:, 3] + calib_coeffs[0, 0, 5])
-    temp_v = np.array([temp_v, temp_v, temp_v]).T
+    # (n, 1) column broadcasts against the three field axes
+    temp_v = calib_coeffs[0, 0, 6] * (sensor_data[:, 3:4] + calib_coeffs[0, 0, 5])
 
     # k values are a (3,) array (x_coeff, y_coeff, z_coeff)
     if sensitivity == 5:
-        k1 = calib_coeffs[:, 2, 0]
-        k2 = calib_coeffs[:, 2, 1]
-        k3 = calib_coeffs[:, 2, 2]
-        k4 = calib_coeffs[:, 2, 3]
-        k5 = calib_coeffs[:, 2, 4]
+        k1, k2, k3, k4, k5 = calib_coeffs[:, 2, :5].T
     elif sensitivity == 100:
-        k1 = calib_coeffs[:, 0, 0]
-        k2 = calib_coeffs[:, 0, 1]
-        k3 = calib_coeffs[:, 0, 2]
-        k4 = calib_coeffs[:, 0, 3]
-        k5 = calib_coeffs[:, 0, 4]
+        k1, k2, k3, k4, k5 = calib_coeffs[:, 0, :5].T
     else:
-        print('Invalid sensitivity value')
-    xyz_prime = k1 + Bxyz
-    xyz_dbl_prime = k2 * xyz_prime**3 + xyz_prime
-    xyz_cal_mT = ((k5 * (xyz_dbl_prime + xyz_dbl_prime * k3 * temp_v + k4 * temp_v)) / sensitivity) * 1000
+        raise ValueError('Invalid sensitivity value')
+    if out is None:
+        out = np.empty(Bxyz.shape)
+    # xyz' = k1 + B
+    np.add(Bxyz, k1, out=out)
+    # xyz'' = k2 * xyz'^3 + xyz'
+    tmp = np.power(out, 3)
+    tmp *= k2
+    out += tmp
+    # k5 * (xyz'' * (1 + k3*T) + k4*T) / sensitivity * 1000
+    np.multiply(temp_v, k3, out=tmp)
+    tmp += 1
+    out *= tmp
+    np.multiply(temp_v, k4, out=tmp)
+    out += tmp
+    out *= k5 * (1000 / sensitivity)
 
-    return xyz_cal_mT
+    return out
+
+def fused_transforms(rotation, translation, s_matrix, probe_offset):
+    '''
+    returns (rotation_inv, b_mcs2pcs, xyz_offset) used by transform_scan
+    '''
+    rotation_inv = np.linalg.inv(rotation)
+    # Row vector form of s_matrix@B followed by the mcs -> pcs rotation
+    b_mcs2pcs = s_matrix.T @ rotation_inv
+    xyz_offset = translation - probe_offset @ rotation_inv
+    return (rotation_inv, b_mcs2pcs, xyz_offset)
+
+def transform_scan(volts, positions, calib_coeffs, b_mcs2pcs, rotation_inv, xyz_offset, sensitivity=5,
+                   out=None, dtype=np.float64):
+    '''
+    volts is (n, 4) raw hall sensor data and positions the (n, 3) mcs position
+        of every sample, the transforms come from fused_transforms
+    returns (n, 6) array (x, y, z, Bx, By, Bz) in pcs
+    '''
+    if out is None:
+        out = np.empty((volts.shape[0], 6), dtype=dtype)
+    Bxyz = calib_data(calib_coeffs, volts, sensitivity, out=np.empty((volts.shape[0], 3), dtype=out.dtype))
+    np.matmul(Bxyz, b_mcs2pcs, out=out[:, 3:])
+    np.matmul(positions, rotation_inv, out=out[:, :3])
+    out[:, :3] += xyz_offset
+    return out
 
 def get_xyz_calib_values(path: str):
     '''
@@ -65,17 +97,18 @@ def get_xyz_calib_values(path: str):
 
 def filter_data(data: np.ndarray, cutoff: int):
     '''
-    data: (n,) array of single axis hallsensor data
+    data: (n,) array of single axis hallsensor data, or (n, m) to filter every column
     cutoff: integer value for level of filter smoothing
-    returns (n,) numpy array of filtered sensor data
+    returns numpy array of filtered sensor data, same shape as data, or
+        2*cutoff + 1 samples long for shorter data like np.convolve mode='same'
+    Gaussian convolution (zero padded, mode='same') by FFT overlap-add,
+        see filters.py for the recursive and streaming versions.
     '''
-    x_delta = 1
-    alpha = np.sqrt(np.log(2)/np.pi)
-    x_lc = np.arange(-cutoff, cutoff + x_delta, x_delta)
-    sx = (1/alpha*cutoff)*np.exp(-np.pi*(x_lc/(alpha*cutoff))**2)
-    sx_norm = sx/np.sum(sx)
-    filtered = np.convolve(data, sx_norm, mode='same')
-    return filtered
+    kernel = gaussian_kernel(cutoff)
+    if data.shape[0] < kernel.shape[0]:
+        # Direct convolution is cheap here and keeps the kernel length output
+        return np.apply_along_axis(np.convolve, 0, data, kernel, mode='same')
+    return fft_filter(data, cutoff)
 
 def fit_linear(x, y):
     x_m = np.mean(x)
@@ -0,0 +1,106 @@
+import os
+import warnings
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from resample import GriddedMap, LatticeBinner, grid_scan
+
+class Region:
+    '''
+    Axis aligned box lo..hi (pcs xyz, mm) with a tolerance on the peak |dB| in mT
+    '''
+    def __init__(self, name, lo, hi, tolerance):
+        self.name = name
+        self.lo = np.asarray(lo, dtype=float)
+        self.hi = np.asarray(hi, dtype=float)
+        self.tolerance = tolerance
+
+    def __repr__(self):
+        return f'Region({self.name}, {self.lo}, {self.hi}, {self.tolerance} mT)'
+
+    def contains(self, xyz: np.ndarray):
+        return np.all((xyz >= self.lo) & (xyz <= self.hi), axis=-1)
+
+class MapComparison:
+    '''
+    Difference of one gridded map to a reference on the reference lattice.
+    difference is (nz, ny, nx, 3) map - reference B, NaN where either map has
+        no data.  rms and peak are taken over the overlapping cells, regions
+        maps every Region name to (peak, rms, passed).
+    '''
+    def __init__(self, name, reference, gridded, regions=(), tolerance=None):
+        self.name = name
+        self.nodes = reference.nodes()
+        self.difference = gridded.mean[..., 3:6] - reference.mean[..., 3:6]
+        valid = ~np.isnan(self.difference).any(axis=-1)
+        self.overlap = int(valid.sum())
+        self.coverage = self.overlap / max(int((~np.isnan(reference.mean[..., 3])).sum()), 1)
+        norm = np.linalg.norm(self.difference, axis=-1)
+        self.rms = np.sqrt(np.nanmean(self.difference[valid]**2, axis=0)) if self.overlap else np.full(3, np.nan)
+        self.rms_norm = np.sqrt(np.mean(norm[valid]**2)) if self.overlap else np.nan
+        self.peak = np.max(norm[valid]) if self.overlap else np.nan
+        self.peak_location = self.nodes[valid][np.argmax(norm[valid])] if self.overlap else np.full(3, np.nan)
+        self.tolerance = tolerance
+        self.regions = {}
+        for region in regions:
+            inside = valid & region.contains(self.nodes)
+            if inside.any():
+                peak = np.max(norm[inside])
+                rms = np.sqrt(np.mean(norm[inside]**2))
+                self.regions[region.name] = (peak, rms, bool(peak <= region.tolerance))
+            else:
+                # A region without data can not be accepted
+                self.regions[region.name] = (np.nan, np.nan, False)
+
+    def __repr__(self):
+        return f'MapComparison({self.name}, rms={self.rms_norm:.4f} mT, peak={self.peak:.4f} mT, passed={self.passed})'
+
+    @property
+    def passed(self):
+        if self.tolerance is not None and not self.peak <= self.tolerance:
+            return False
+        return all(result[2] for result in self.regions.values())
+
+    def summary(self):
+        lines = [f'{self.name}: {"PASS" if self.passed else "FAIL"}  rms {self.rms_norm:.4f} mT  '
+                 f'peak {self.peak:.4f} mT at {np.round(self.peak_location, 3)}  coverage {self.coverage:.1%}']
+        for name, (peak, rms, passed) in self.regions.items():
+            lines.append(f'    {name}: {"PASS" if passed else "FAIL"}  rms {rms:.4f} mT  peak {peak:.4f} mT')
+        return '\n'.join(lines)
+
+def grid_on_lattice(source, binner: LatticeBinner, min_count=1):
+    '''
+    grids source (array or field map filename) on a fresh copy of binner's lattice
+    '''
+    lattice = LatticeBinner(binner.origin, binner.spacing, binner.shape)
+    return grid_scan(source, binner=lattice, min_count=min_count)
+
+def compare_maps(reference, maps, names=None, spacing=0.5, regions=(), tolerance=None, min_count=1,
+                 max_workers=None):
+    '''
+    Compares every map in maps (arrays or field map filenames) to reference.
+    reference is an array, a field map filename, a GriddedMap or None for the
+        median of the lot.  All maps are gridded on the reference lattice
+        (or the lattice covering the first map) in a process pool of
+        max_workers (default os.cpu_count()), call from under
+        `if __name__ == '__main__':` on Windows.
+    returns list of MapComparison in the order of maps
+    '''
+    names = names if names is not None else [m if isinstance(m, str) else f'map {i}' for i, m in enumerate(maps)]
+    if reference is None or isinstance(reference, str) or isinstance(reference, np.ndarray):
+        first = reference if reference is not None else maps[0]
+        reference_grid = grid_scan(first, spacing, min_count=min_count)
+    else:
+        reference_grid = reference
+    x, y, z = (reference_grid.x, reference_grid.y, reference_grid.z)
+    spacing = [np.diff(axis)[0] if axis.shape[0] > 1 else spacing for axis in (x, y, z)]
+    binner = LatticeBinner((x[0], y[0], z[0]), spacing, reference_grid.count.shape)
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        grids = list(pool.map(grid_on_lattice, maps, [binner] * len(maps), [min_count] * len(maps)))
+    if reference is None:
+        with warnings.catch_warnings():
+            # cells without data in any map stay NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean = np.nanmedian(np.array([grid.mean for grid in grids]), axis=0)
+        count = np.sum([grid.count for grid in grids], axis=0)
+        reference_grid = GriddedMap(x, y, z, mean, np.full(mean.shape, np.nan), count)
+    return [MapComparison(name, reference_grid, grid, regions, tolerance) for name, grid in zip(names, grids)]
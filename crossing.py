@@ -0,0 +1,105 @@
+import numpy as np
+from filters import fft_filter
+
+class OffsetEstimate:
+    '''
+    Zero crossing of the positive - negative current difference of the FSV
+        passes along one axis.
+    offset: crossing of the mean difference curve (mm, scan axis)
+    pass_offsets: (n_passes,) crossing of every pass pair on its own
+    std: bootstrap standard uncertainty of offset (k=1, normal), NaN with
+        fewer than 2 pass pairs
+    ci: (lo, hi) bootstrap percentile interval at confidence, NaN with fewer
+        than MIN_CI_PASSES pass pairs
+    Filtered samples of one pass share its drift and position error, so only
+        independent pass pairs are resampled.
+    '''
+    MIN_CI_PASSES = 10
+
+    def __init__(self, offset, pass_offsets, bootstrap, confidence):
+        self.offset = offset
+        self.pass_offsets = pass_offsets
+        self.bootstrap = bootstrap[~np.isnan(bootstrap)]
+        self.confidence = confidence
+        self.std = np.nan
+        self.ci = (np.nan, np.nan)
+        if len(pass_offsets) > 1 and self.bootstrap.shape[0] > 1:
+            self.std = np.std(self.bootstrap, ddof=1)
+            if len(pass_offsets) >= self.MIN_CI_PASSES:
+                tail = 50 * (1 - confidence)
+                self.ci = tuple(np.percentile(self.bootstrap, [tail, 100 - tail]))
+
+    def __repr__(self):
+        return f'OffsetEstimate({self.offset:.4f} mm, u={self.std:.4f} mm, {len(self.pass_offsets)} passes)'
+
+    def __float__(self):
+        return float(self.offset)
+
+def crossings(curves: np.ndarray, grid: np.ndarray):
+    '''
+    curves: (m, g) difference curves sampled on grid (g,)
+    Each curve is bracketed between its minimum and maximum, the sign change
+        with the steepest slope inside the bracket is the crossing, refined by
+        linear interpolation.
+    returns (m,) crossings, NaN where a curve has no sign change
+    '''
+    curves = np.atleast_2d(curves)
+    index = np.arange(grid.shape[0] - 1)
+    first = np.minimum(np.argmin(curves, axis=1), np.argmax(curves, axis=1))[:, None]
+    last = np.maximum(np.argmin(curves, axis=1), np.argmax(curves, axis=1))[:, None]
+    left, right = (curves[:, :-1], curves[:, 1:])
+    change = (np.signbit(left) != np.signbit(right)) & (index >= first) & (index < last)
+    slope = np.where(change, np.abs(right - left), -1.0)
+    j = np.argmax(slope, axis=1)
+    rows = np.arange(curves.shape[0])
+    y0, y1 = (left[rows, j], right[rows, j])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        root = grid[j] - y0 * (grid[j+1] - grid[j]) / (y1 - y0)
+    return np.where(change[rows, j], root, np.nan)
+
+def __as_passes__(passes):
+    return [passes] if isinstance(passes, np.ndarray) and passes.ndim == 2 else list(passes)
+
+def estimate_offset(passes_pos, passes_neg, filter_cutoff=500, n_boot=1000, confidence=0.95, seed=None):
+    '''
+    passes_pos / passes_neg: (n, 2) array (position, field) of one pass or a
+        sequence of them, pass k of both forms a pair.
+    Every pass is Gaussian filtered (filter_cutoff samples, see
+        calibration.filter_data) and interpolated onto a common position grid,
+        the crossing of the positive - negative difference is found with
+        crossings().  Opposite scan directions shift both signals by the same
+        lag in opposite directions, which cancels in the difference.
+    The bootstrap resamples the pass pairs (all curves of a resample are
+        averaged at once as a (n_boot, passes) @ (passes, g) product).  A single
+        pass pair has no uncertainty estimate (see OffsetEstimate).
+    returns OffsetEstimate
+    '''
+    passes_pos, passes_neg = (__as_passes__(passes_pos), __as_passes__(passes_neg))
+    if len(passes_pos) != len(passes_neg):
+        raise ValueError('Positive and negative passes must come in pairs')
+    passes = [tuple(p[np.argsort(p[:, 0], kind='stable')] for p in pair) for pair in zip(passes_pos, passes_neg)]
+    # Filtered samples within filter_cutoff of either end are not valid
+    lo = max(p[filter_cutoff, 0] for pair in passes for p in pair)
+    hi = min(p[-filter_cutoff-1, 0] for pair in passes for p in pair)
+    if not hi > lo:
+        raise ValueError('Passes are too short or do not overlap')
+    size = int(np.median([np.count_nonzero((p[:, 0] >= lo) & (p[:, 0] <= hi)) for pair in passes for p in pair]))
+    grid = np.linspace(lo, hi, max(size, 2))
+    pass_curves = np.empty((len(passes), grid.shape[0]))
+    for k, (p, n) in enumerate(passes):
+        pass_curves[k] = (np.interp(grid, p[:, 0], fft_filter(p[:, 1], filter_cutoff)) -
+                          np.interp(grid, n[:, 0], fft_filter(n[:, 1], filter_cutoff)))
+    mean_curve = pass_curves.mean(axis=0)
+    offset = crossings(mean_curve, grid)[0]
+    pass_offsets = crossings(pass_curves, grid)
+    units = pass_curves
+    if n_boot and units.shape[0] > 1 and not np.isnan(offset):
+        # Only the bracket of the mean curve is needed for the resampled curves
+        first, last = sorted((np.argmin(mean_curve), np.argmax(mean_curve)))
+        window = slice(first, last + 1)
+        rng = np.random.default_rng(seed)
+        weights = rng.multinomial(units.shape[0], np.full(units.shape[0], 1 / units.shape[0]), size=n_boot)
+        bootstrap = crossings(weights @ units[:, window] / units.shape[0], grid[window])
+    else:
+        bootstrap = np.zeros(0)
+    return OffsetEstimate(offset, pass_offsets, bootstrap, confidence)
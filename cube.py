@@ -1,20 +1,32 @@
 from nicdaq import HallDAQ
 from calibration import get_xyz_calib_values, calib_data, orthogonalize
+from robust import SequentialMean
 from zeisscmm import CMM
 import numpy as np
 from time import sleep
 import tkinter as tk
 from tkinter import filedialog, ttk
+from tkinter import messagebox
 from PIL import Image, ImageTk
+from jobs import JobExecutor
 
 class Cube:
+    # Standard error of the mean (mT) of every face and the most samples taken for it
+    TARGET_SEM = 0.001
+    MAX_SAMPLES = 15000
+
     def __init__(self, cube_alignment_filename: str,\
                  calibration_array: np.ndarray,\
-                 probe_offset_filename: str):
+                 probe_offset_filename: str,\
+                 daq=None, cmm=None):
+        '''
+        daq and cmm can be passed in to use other backends (see simulation.py)
+        '''
         self.cube_dict = {}
-        self.daq = HallDAQ(1, 20000, start_trigger=True, acquisition='finite')
+        self.cube_stats = {}
+        self.daq = daq if daq is not None else HallDAQ(1, 20000, start_trigger=True, acquisition='finite')
         self.daq.power_on()
-        self.cmm = CMM()
+        self.cmm = cmm if cmm is not None else CMM()
         self.calib_coeffs = calibration_array
         self.rotation, self.translation = self.load_cube_alignment(cube_alignment_filename)
         self.probe_offset = np.genfromtxt(probe_offset_filename)
@@ -32,14 +44,25 @@ class Cube:
         translation = diff[-3:]
         return (rotation, translation)
 
-    def measure(self, cube_dict_key: str):
-        self.daq.start_hallsensor_task()
-        sleep(1)
-        self.daq.pulse()
-        data = self.daq.read_hallsensor()[7500:15000]
-        self.daq.stop_hallsensor_task()
-        cal_data = calib_data(self.calib_coeffs, data)
-        self.cube_dict[cube_dict_key] = np.mean(cal_data, axis=0)
+    def measure(self, cube_dict_key: str, on_chunk=None):
+        '''
+        on_chunk(stats) is called after every chunk with the SequentialMean
+        Raises RuntimeError without storing the side if TARGET_SEM is not
+            reached within MAX_SAMPLES (stats are kept in cube_stats).
+        '''
+        stats = SequentialMean(3, self.TARGET_SEM)
+        self.daq.start_stream()
+        try:
+            self.daq.pulse()
+            # Calibrated samples are averaged as they arrive, from settling until TARGET_SEM is met
+            self.daq.accumulate_until_done(stats, self.MAX_SAMPLES,
+                                           transform=lambda volts: calib_data(self.calib_coeffs, volts),
+                                           on_chunk=on_chunk)
+        finally:
+            self.daq.stop_stream()
+        self.cube_stats[cube_dict_key] = stats
+        stats.require_done(f'Side {cube_dict_key}', 'mT')
+        self.cube_dict[cube_dict_key] = stats.clipped_mean
 
     def shutdown(self):
         self.cmm.close()
@@ -59,7 +82,9 @@ class CubeWindow(tk.Toplevel):
         self.title('Sensor Orthogonalization')
         self.frm_cube_window = tk.Frame(self)
         self.frm_cube_window.pack()
+        self.executor = JobExecutor(self)
         self.create_widgets()
+        self.protocol('WM_DELETE_WINDOW', self.close_window)
     
     def __create_image_dict__(self):
         image_dict = {}
@@ -78,13 +103,15 @@ class CubeWindow(tk.Toplevel):
         self.btn_measure_cube_center = ttk.Button(self.frm_cube_window,
                                                   text='Measure Cube Center',
                                                   command=self.click_iter)
+        self.btn_cancel = ttk.Button(self.frm_cube_window, text='Cancel', command=self.executor.cancel, state='disabled')
         self.btn_close = ttk.Button(self.frm_cube_window, text='Close', command=self.close_window)
         self.lbl_img_desc = tk.Label(self.frm_cube_window, text='Load alignment, calibration, and offsets')
         self.lbl_img = tk.Label(self.frm_cube_window)
         # Place widgets within grid
         self.btn_load_alignment.grid(column=0, row=0, padx=5, pady=5)
         self.btn_measure_cube_center.grid(column=0, row=3, padx=5, pady=5)
-        self.btn_close.grid(column=0, row=4, padx=5, pady=5)
+        self.btn_cancel.grid(column=0, row=4, padx=5, pady=5)
+        self.btn_close.grid(column=0, row=5, padx=5, pady=5)
         self.lbl_img_desc.grid(column=1, row=0, padx=5, pady=5, sticky='w')
         self.lbl_img.grid(column=1, row=1, rowspan=5, padx=5, pady=5)
     
@@ -95,44 +122,84 @@ class CubeWindow(tk.Toplevel):
         self.focus()
     
     def measure_origin(self):
+        if self.click_index < 12:
+            self.btn_measure_cube_center.configure(state='disabled')
+            self.btn_cancel.configure(state='enabled')
+            self.lbl_img_desc.configure(text=f'Please wait.  Measuring side {self.cube_sequence[self.click_index]}...')
+            self.executor.submit(self.__measure_side__, self.click_index, name='cube side',
+                                 on_progress=lambda message, partial: self.lbl_img_desc.configure(text=message),
+                                 on_done=self.side_done,
+                                 on_error=lambda error: self.side_stopped(f'Measurement failed: {error}', error),
+                                 on_cancel=lambda: self.side_stopped('Measurement cancelled.  Measure the side again.'))
+        else:
+            self.btn_measure_cube_center.configure(state='disabled')
+
+    def __measure_side__(self, job, index):
+        '''
+        runs on the executor thread, returns True once all 12 sides are measured
+        '''
+        def on_chunk(stats):
+            if stats.settled:
+                job.progress(f'Measuring side {self.cube_sequence[index]}... {stats.count} samples, '
+                             f'uncertainty {np.max(stats.uncertainty):.2e} mT')
+            else:
+                job.progress(f'Measuring side {self.cube_sequence[index]}... waiting for the signal to settle')
         if self.cube is None:
             self.cube = Cube(self.cube_filename, self.calib_array, 'fsv_offset.txt')
             self.manual_position = self.cube.mcs2cube(self.cube.cmm.get_position())
             self.probe_offset_cube = self.cube.probe_offset@self.cube.rotation
             self.manual_origin_cube = np.array([self.manual_position[0], self.manual_position[1], self.probe_offset_cube[2]])
-        if self.click_index < 12:
-            self.cube.cmm.cnc_on()
+        self.cube.cmm.cnc_on()
+        try:
             self.cube.cmm.set_speed((5,5,5))
             self.cube.cmm.goto_position(self.cube.cube2mcs(self.manual_origin_cube))
-            while np.linalg.norm(self.manual_origin_cube - self.cube.mcs2cube(self.cube.cmm.get_position())) > 0.025:
-                pass
-            self.cube.measure(self.keys[self.click_index])
+            self.cube.cmm.wait_until_arrived(self.cube.cube2mcs(self.manual_origin_cube))
+            job.check()
+            self.cube.measure(self.keys[index], on_chunk=on_chunk)
             self.cube.cmm.set_speed((20,20,20))
             self.cube.cmm.goto_position(self.cube.cube2mcs(self.manual_origin_cube + np.array([0, 0, 135])))
+        finally:
             self.cube.cmm.set_speed((70,70,70))
             self.cube.cmm.cnc_off()
-            if self.click_index == 11:
-                s_matrix = orthogonalize(np.array([i for i in self.cube.cube_dict.values()]))
-                s_matrix_mcs = self.cube.rotation.T@s_matrix
-                np.save('sensitivity.npy', s_matrix_mcs, allow_pickle=False)
-                self.lbl_img_desc.configure(text='Cube qualification complete.  Window can now be closed.')
-                self.btn_measure_cube_center.configure(state='disabled')
-            self.click_index += 1
-        else:
-            self.btn_measure_cube_center.configure(state='disabled')
+        if len(self.cube.cube_dict) < 12:
+            return False
+        s_matrix = orthogonalize(np.array([self.cube.cube_dict[key] for key in self.keys]))
+        s_matrix_mcs = self.cube.rotation.T@s_matrix
+        np.save('sensitivity.npy', s_matrix_mcs, allow_pickle=False)
+        return True
+
+    def side_done(self, complete):
+        self.btn_cancel.configure(state='disabled')
+        self.click_index += 1
+        if complete:
+            self.lbl_img_desc.configure(text='Cube qualification complete.  Window can now be closed.')
+        elif self.click_index < 12:
+            self.btn_measure_cube_center.configure(state='enabled')
+            self.update_step()
+
+    def side_stopped(self, message, error=None):
+        self.btn_cancel.configure(state='disabled')
+        self.btn_measure_cube_center.configure(state='enabled')
+        self.lbl_img_desc.configure(text=message)
+        if error is not None:
+            messagebox.showerror(title='Error', message=str(error))
 
     def click_iter(self):
         if self.click_index is None:
             self.click_index = 0
         self.measure_origin()
-        if self.click_index < 12:
-            self.update_step()
         
     def update_step(self):
         self.lbl_img.configure(image=self.images[self.keys[self.click_index]])
         self.lbl_img_desc.configure(text=f'Rotate cube to side number {self.cube_sequence[self.click_index]}')
     
     def close_window(self):
+        if self.executor.busy:
+            # Wait for the running measurement to reach a safe point
+            self.executor.cancel()
+            self.after(100, self.close_window)
+            return
+        self.executor.shutdown()
         if self.cube is not None:
             self.cube.shutdown()
         self.destroy()
@@ -0,0 +1,315 @@
+import json
+import os
+import struct
+import hashlib
+import threading
+import numpy as np
+from time import time
+
+FIELDMAP_DTYPE = np.dtype([('xyz', '<f8', (3,)), ('B', '<f8', (3,)), ('volts', '<f4', (4,)),
+                           ('temperature', '<f4'), ('time', '<f8'), ('line', '<i4')])
+
+def calibration_hash(calib_coeffs, s_matrix, probe_offset):
+    '''
+    Short sha1 of the calibration arrays, identifies the calibration a map was made with
+    '''
+    sha = hashlib.sha1()
+    for array in (calib_coeffs, s_matrix, probe_offset):
+        sha.update(np.ascontiguousarray(array, dtype='<f8').tobytes())
+    return sha.hexdigest()[:16]
+
+class FieldMapFile:
+    '''
+    Appendable binary field map.
+    Layout: 8 byte magic, uint32 header length, JSON header (dtype, metadata)
+        padded to a multiple of HEADER_BLOCK bytes, then packed FIELDMAP_DTYPE
+        records.  The row count follows from the file size, so every append is a
+        single write at the end and a partially written record (e.g. after a
+        crash) is ignored on open and cut off before the next append.
+    read() returns a read only np.memmap of the records, so large maps open
+        without parsing.
+    '''
+    MAGIC = b'\x93FIELDMP'
+    HEADER_BLOCK = 4096
+    EXTENSION = '.fmap'
+
+    def __init__(self, filename, mode='r'):
+        '''
+        mode 'r' opens an existing file read only, 'a' for appending
+        Use FieldMapFile.create for a new file.
+        '''
+        self.filename = filename
+        self.mode = mode
+        self.lock = threading.Lock()
+        with open(filename, 'rb') as file:
+            magic, length = struct.unpack('<8sI', file.read(12))
+            if magic != self.MAGIC:
+                raise ValueError(f'{filename} is not a field map file')
+            header = json.loads(file.read(length - 12).decode().rstrip())
+        self.data_offset = length
+        self.dtype = np.dtype([(name, form, tuple(shape)) for name, form, shape in header['descr']])
+        self.metadata = header['metadata']
+        self.created = header['created']
+        self.file = None
+        if mode == 'a':
+            self.file = open(filename, 'r+b')
+            self.truncate(len(self))
+
+    def __repr__(self):
+        return f'FieldMapFile({self.filename}, {len(self)} rows)'
+
+    def __len__(self):
+        return (os.path.getsize(self.filename) - self.data_offset) // self.dtype.itemsize
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @classmethod
+    def create(cls, filename, metadata=None, dtype=FIELDMAP_DTYPE):
+        '''
+        Creates (or overwrites) filename and opens it for appending
+        metadata is any JSON serializable dict, e.g. part number, serial,
+            alignment and calibration_hash
+        '''
+        with open(filename, 'wb') as file:
+            file.write(cls.__header__(metadata or {}, dtype, time()))
+        return cls(filename, 'a')
+
+    @classmethod
+    def __header__(cls, metadata, dtype, created):
+        descr = [(name, dtype[name].base.str, dtype[name].shape) for name in dtype.names]
+        text = json.dumps({'descr': descr, 'metadata': metadata, 'created': created}).encode()
+        length = -(-(len(text) + 12) // cls.HEADER_BLOCK) * cls.HEADER_BLOCK
+        return struct.pack('<8sI', cls.MAGIC, length) + text.ljust(length - 12)
+
+    def update_metadata(self, **metadata):
+        '''
+        Merges metadata into the header, rewrites the file if the header grows
+        '''
+        with self.lock:
+            self.metadata.update(metadata)
+            header = self.__header__(self.metadata, self.dtype, self.created)
+            if len(header) == self.data_offset:
+                with open(self.filename, 'r+b') as file:
+                    file.write(header)
+                return
+            records = np.array(self.read())
+            with open(self.filename, 'wb') as file:
+                file.write(header)
+                file.write(records.tobytes())
+            self.data_offset = len(header)
+
+    def append_records(self, records: np.ndarray):
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(np.ascontiguousarray(records, dtype=self.dtype).tobytes())
+            self.file.flush()
+
+    def append(self, xyz, B, volts=None, temperature=None, timestamp=None, line=-1):
+        '''
+        xyz and B are (n, 3) arrays, volts (n, 4); temperature, timestamp and
+            line are (n,) arrays or scalars.  Missing columns are stored as NaN.
+        '''
+        records = np.empty(np.shape(xyz)[0], dtype=self.dtype)
+        records['xyz'] = xyz
+        records['B'] = B
+        records['volts'] = np.nan if volts is None else volts
+        records['temperature'] = np.nan if temperature is None else temperature
+        records['time'] = np.nan if timestamp is None else timestamp
+        records['line'] = line
+        self.append_records(records)
+
+    def truncate(self, rows):
+        '''
+        keeps only the first rows records
+        '''
+        with self.lock:
+            self.file.truncate(self.data_offset + rows * self.dtype.itemsize)
+
+    def read(self):
+        '''
+        returns a read only memory mapped (n,) record array
+        '''
+        rows = len(self)
+        if rows == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.data_offset, shape=(rows,))
+
+    def field_data(self, start=0, stop=None):
+        '''
+        returns an (n, 6) array (x, y, z, Bx, By, Bz) like the reduced text files
+        '''
+        records = self.read()[start:stop]
+        return np.hstack((records['xyz'], records['B']))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def load_fieldmap(filename):
+    '''
+    returns (n, 6) array (x, y, z, Bx, By, Bz) from a FieldMapFile or a text
+        map written with np.savetxt.
+    A text map is converted once to the cache <name>.txt.fmap next to it,
+        which is used instead as long as it is newer than the text file.  A
+        cache name that holds any other field map (metadata source is not the
+        text file) is never read or overwritten.
+    '''
+    if filename.endswith(FieldMapFile.EXTENSION):
+        return FieldMapFile(filename).field_data()
+    binary = filename + FieldMapFile.EXTENSION
+    source = os.path.basename(filename)
+    cached = False
+    if os.path.exists(binary):
+        cache = FieldMapFile(binary)
+        if cache.metadata.get('source') != source:
+            raise FileExistsError(f'{binary} is not the cache of {filename}')
+        cached = not os.path.exists(filename) or os.path.getmtime(binary) >= os.path.getmtime(filename)
+    if cached:
+        return cache.field_data()
+    data = np.loadtxt(filename, ndmin=2)
+    with FieldMapFile.create(binary, {'source': source}) as fieldmap:
+        fieldmap.append(data[:, :3], data[:, 3:6])
+    return data
+
+class FieldMap:
+    '''
+    Query object over scattered field map points, e.g.
+        FieldMap.from_file('fieldmap_reduced.fmap')(points)
+    Points are bucketed into cubic cells of size radius.  B and its gradient at
+        a query point come from a weighted least squares fit of a local
+        polynomial (order 1: linear, order 2: quadratic) to all map points
+        within radius, weighted by (1 - r^2/radius^2)^2.
+    Directions in which the neighbors have no spread (e.g. z for a single
+        plane) are regularized, their gradient comes out as 0.
+    '''
+    def __init__(self, xyz: np.ndarray, B: np.ndarray, radius=1.0, order=1):
+        if order not in (1, 2):
+            raise ValueError('order must be 1 (linear) or 2 (quadratic)')
+        self.radius = radius
+        self.order = order
+        xyz = np.asarray(xyz, dtype=float)
+        self.origin = xyz.min(axis=0)
+        cells = np.floor((xyz - self.origin) / radius).astype(np.int64)
+        self.shape = cells.max(axis=0) + 1
+        keys = self.__keys__(cells)
+        order_index = np.argsort(keys, kind='stable')
+        self.keys = keys[order_index]
+        self.xyz = xyz[order_index]
+        self.B = np.asarray(B, dtype=float)[order_index]
+
+    def __repr__(self):
+        return f'FieldMap({self.xyz.shape[0]} points, radius={self.radius}, order={self.order})'
+
+    @classmethod
+    def from_file(cls, filename, radius=1.0, order=1):
+        data = load_fieldmap(filename)
+        return cls(data[:, :3], data[:, 3:6], radius, order)
+
+    def __keys__(self, cells):
+        return cells[:, 0] + self.shape[0] * (cells[:, 1] + self.shape[1] * cells[:, 2])
+
+    def __basis__(self, d):
+        '''
+        polynomial terms of the (m, 3) offsets d (in units of radius)
+        '''
+        terms = [np.ones(d.shape[0]), d[:, 0], d[:, 1], d[:, 2]]
+        if self.order == 2:
+            terms += [d[:, 0]**2, d[:, 1]**2, d[:, 2]**2, d[:, 0]*d[:, 1], d[:, 0]*d[:, 2], d[:, 1]*d[:, 2]]
+        return np.array(terms).T
+
+    def __pairs__(self, points):
+        '''
+        returns (query index, map index) of every map point in the 27 cells
+            around each query point
+        '''
+        cells = np.floor((points - self.origin) / self.radius).astype(np.int64)
+        query_index = []
+        map_index = []
+        for offset in np.array(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1])).reshape((3, -1)).T:
+            neighbor = cells + offset
+            valid = np.all((neighbor >= 0) & (neighbor < self.shape), axis=1)
+            keys = self.__keys__(neighbor)
+            start = np.searchsorted(self.keys, keys, 'left')
+            counts = np.where(valid, np.searchsorted(self.keys, keys, 'right') - start, 0)
+            total = counts.sum()
+            if total == 0:
+                continue
+            # Expand the (start, count) ranges into flat index lists
+            first = np.repeat(np.cumsum(counts) - counts, counts)
+            query_index.append(np.repeat(np.arange(points.shape[0]), counts))
+            map_index.append(np.repeat(start, counts) + np.arange(total) - first)
+        if not query_index:
+            return (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+        return (np.concatenate(query_index), np.concatenate(map_index))
+
+    def __query_chunk__(self, points):
+        n = points.shape[0]
+        query_index, map_index = self.__pairs__(points)
+        d = (self.xyz[map_index] - points[query_index]) / self.radius
+        r2 = np.einsum('ij,ij->i', d, d)
+        inside = r2 < 1
+        query_index, map_index, d = (query_index[inside], map_index[inside], d[inside])
+        w = (1 - r2[inside])**2
+        phi = self.__basis__(d)
+        B = self.B[map_index]
+        p = phi.shape[1]
+        # Weighted normal equations per query point, accumulated with bincount
+        A = np.empty((n, p, p))
+        for i in range(p):
+            for j in range(i, p):
+                A[:, i, j] = A[:, j, i] = np.bincount(query_index, weights=w * phi[:, i] * phi[:, j], minlength=n)
+        b = np.empty((n, p, 3))
+        for i in range(p):
+            for k in range(3):
+                b[:, i, k] = np.bincount(query_index, weights=w * phi[:, i] * B[:, k], minlength=n)
+        sum_w = np.bincount(query_index, weights=w, minlength=n)
+        sum_w2 = np.bincount(query_index, weights=w**2, minlength=n)
+        sum_wBB = np.array([np.bincount(query_index, weights=w * B[:, k]**2, minlength=n) for k in range(3)]).T
+        count = np.bincount(query_index, minlength=n)
+        ridge = 1e-6 * np.maximum(sum_w, 1e-12)
+        A[:, np.arange(1, p), np.arange(1, p)] += ridge[:, None]
+        # Only axes in which the neighbors spread need data, e.g. a single plane fits in x and y
+        mean_d = A[:, 0, 1:4] / np.maximum(sum_w, 1e-300)[:, None]
+        spread = A[:, np.arange(1, 4), np.arange(1, 4)] / np.maximum(sum_w, 1e-300)[:, None] - mean_d**2 > 1e-4
+        axes = spread.sum(axis=1)
+        rank = 1 + axes if self.order == 1 else 1 + 2 * axes + axes * (axes - 1) // 2
+        enough = count >= rank
+        A[~enough] = np.eye(p)
+        coeffs = np.linalg.solve(A, b)
+        rss = np.maximum(sum_wBB - np.einsum('npk,npk->nk', coeffs, b), 0)
+        variance = rss / np.maximum(sum_w, 1e-300)[:, None] * (count / np.maximum(count - rank, 1))[:, None]
+        # Standard error of the fitted value ~ residual scatter / sqrt(effective number of neighbors)
+        n_eff = sum_w**2 / np.maximum(sum_w2, 1e-300)
+        error = np.sqrt(variance / np.maximum(n_eff, 1)[:, None])
+        field = coeffs[:, 0]
+        gradient = coeffs[:, 1:4].transpose((0, 2, 1)) / self.radius
+        field[~enough] = np.nan
+        gradient[~enough] = np.nan
+        error[~enough] = np.nan
+        return (field, gradient, error)
+
+    def query(self, points, chunk_size=65536):
+        '''
+        points is a (3,) or (n, 3) array in the map frame
+        returns (B, gradient, error): (n, 3) field, (n, 3, 3) gradient with
+            gradient[:, i, j] = dB_i/dx_j and (n, 3) standard error estimate of
+            B.  Points with fewer map points within radius than polynomial
+            terms in the directions the neighbors span give NaN.
+        '''
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        results = [self.__query_chunk__(points[i:i+chunk_size]) for i in range(0, points.shape[0], chunk_size)]
+        return tuple(np.concatenate(part) for part in zip(*results))
+
+    def field(self, points):
+        return self.query(points)[0]
+
+    def gradient(self, points):
+        return self.query(points)[1]
+
+    def __call__(self, points):
+        return self.field(points)
@@ -0,0 +1,127 @@
+import numpy as np
+
+def gaussian_kernel(cutoff: int):
+    '''
+    normalized (2*cutoff + 1,) Gaussian weighting function of calibration.filter_data
+    '''
+    alpha = np.sqrt(np.log(2)/np.pi)
+    x_lc = np.arange(-cutoff, cutoff + 1)
+    sx = np.exp(-np.pi*(x_lc/(alpha*cutoff))**2)
+    return sx/np.sum(sx)
+
+def gaussian_sigma(cutoff: int):
+    '''
+    standard deviation in samples of the Gaussian with the given cutoff
+    '''
+    return np.sqrt(np.log(2)/np.pi) * cutoff / np.sqrt(2*np.pi)
+
+class StreamingGaussian:
+    '''
+    Gaussian filter for chunked (n, m) data by FFT overlap-add.
+    update(chunk) returns the filtered samples that are complete so far, the
+        output lags the input by cutoff samples; flush() returns the rest.
+    The concatenated output equals np.convolve(column, gaussian_kernel(cutoff),
+        mode='same') of the whole record for every column, at O(log k) per
+        sample instead of O(k).
+    '''
+    def __init__(self, cutoff: int, channels=1, block_size=None):
+        self.cutoff = cutoff
+        self.channels = channels
+        kernel = gaussian_kernel(cutoff)
+        k = kernel.shape[0]
+        block_size = 4 * k if block_size is None else block_size
+        self.nfft = 1 << int(np.ceil(np.log2(block_size + k - 1)))
+        self.block = self.nfft - k + 1
+        self.kernel_fft = np.fft.rfft(kernel, self.nfft)[:, None]
+        self.reset()
+
+    def reset(self):
+        self.tail = np.zeros((2 * self.cutoff, self.channels))
+        self.ndim = 2
+        # leading samples of the full convolution that are not part of the 'same' output
+        self.skip = self.cutoff
+
+    def update(self, chunk: np.ndarray):
+        '''
+        chunk is (n, channels), or (n,) for a single channel
+        returns (j, channels) (or (j,)) filtered samples
+        '''
+        self.ndim = chunk.ndim
+        data = chunk.reshape((chunk.shape[0], -1))
+        out = np.empty((data.shape[0], self.channels))
+        for start in range(0, data.shape[0], self.block):
+            segment = data[start:start+self.block]
+            n = segment.shape[0]
+            full = np.fft.irfft(np.fft.rfft(segment, self.nfft, axis=0) * self.kernel_fft, self.nfft, axis=0)
+            full = full[:n + self.tail.shape[0]]
+            full[:self.tail.shape[0]] += self.tail
+            out[start:start+n] = full[:n]
+            self.tail = full[n:]
+        drop = min(self.skip, out.shape[0])
+        self.skip -= drop
+        out = out[drop:]
+        return out if chunk.ndim > 1 else out[:, 0]
+
+    def flush(self):
+        '''
+        returns the last filtered samples and resets the filter
+        '''
+        out = self.tail[self.skip:self.cutoff]
+        ndim = self.ndim
+        self.reset()
+        return out if ndim > 1 else out[:, 0]
+
+def fft_filter(data: np.ndarray, cutoff: int, block_size=None):
+    '''
+    data: (n,) or (n, m) array, every column is filtered
+    Same result as calibration.filter_data (np.convolve mode='same' with the
+        Gaussian kernel) by FFT overlap-add.
+    '''
+    stream = StreamingGaussian(cutoff, 1 if data.ndim == 1 else data.shape[1], block_size)
+    return np.concatenate((stream.update(data), stream.flush()))
+
+def __first_order_sections__(data, poles, residues):
+    '''
+    sum over j of residues[j] / (1 - poles[j] z^-1) applied along axis 0 of
+        (n, m) data with zero initial state.  Each section is evaluated in
+        blocks as p^i * cumsum(p^-k x[k]), the block length keeps |p|^-L small.
+    '''
+    out = np.zeros(data.shape)
+    for p, r in zip(poles, residues):
+        length = int(max(min(np.log(1e6) / -np.log(abs(p)), data.shape[0]), 1))
+        powers = p ** np.arange(length)
+        state = np.zeros(data.shape[1], dtype=complex)
+        for start in range(0, data.shape[0], length):
+            segment = data[start:start+length]
+            n = segment.shape[0]
+            s = powers[:n, None] * (p * state + np.cumsum(segment / powers[:n, None], axis=0))
+            out[start:start+n] += (r * s).real
+            state = s[-1]
+    return out
+
+def recursive_filter(data: np.ndarray, cutoff: int):
+    '''
+    data: (n,) or (n, m) array, every column is filtered
+    Recursive (IIR) approximation of the Gaussian filter (Young & van Vliet,
+        third order, forward and backward pass).  The cost per sample does not
+        depend on cutoff; edges start from zero state like the zero padded
+        convolution.
+    '''
+    sigma = gaussian_sigma(cutoff)
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * np.sqrt(1 - 0.26891 * sigma)
+    b0 = 1.57825 + 2.44413*q + 1.4281*q**2 + 0.422205*q**3
+    b1 = 2.44413*q + 2.85619*q**2 + 1.26661*q**3
+    b2 = -(1.4281*q**2 + 1.26661*q**3)
+    b3 = 0.422205*q**3
+    a = np.array([b1, b2, b3]) / b0
+    gain = 1 - a.sum()
+    # 1 / (1 - a1 z^-1 - a2 z^-2 - a3 z^-3) as a sum of first order sections
+    poles = np.roots([1, -a[0], -a[1], -a[2]])
+    residues = [poles[j]**2 / np.prod(poles[j] - np.delete(poles, j)) for j in range(3)]
+    x = data.reshape((data.shape[0], -1)).astype(float)
+    forward = gain * __first_order_sections__(x, poles, residues)
+    backward = gain * __first_order_sections__(forward[::-1], poles, residues)[::-1]
+    return backward.reshape(data.shape)
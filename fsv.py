@@ -1,62 +1,83 @@
-from calibration import filter_data, get_xyz_calib_values, calib_data
+from calibration import get_xyz_calib_values, calib_data
+from crossing import estimate_offset, OffsetEstimate
 from nicdaq import HallDAQ
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+import os
 import numpy as np
 import zeisscmm
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from tkinter import ttk
 from PIL import Image, ImageTk
+from jobs import JobExecutor
+
+def uncertainty_filename(offset_filename):
+    '''
+    fsv_offset.txt -> fsv_uncertainty.txt, anything else -> <name>.uncertainty.txt
+    '''
+    if offset_filename.endswith('fsv_offset.txt'):
+        return offset_filename[:-len('offset.txt')] + 'uncertainty.txt'
+    return os.path.splitext(offset_filename)[0] + '.uncertainty.txt'
+
+def read_fsv_alignment(filename: str):
+    '''
+    The alignment file holds the 9 rotation and 3 translation values of the fsv
+        frame, optionally followed by 9 values with the x, y and z scan centers
+        (fsv frame, relative to the x scan center) of the fsv tool for run_sequence.
+    returns (rotation, translation, axis_centers), axis_centers is None when
+        the file has no scan centers
+    '''
+    diff = np.genfromtxt(filename, delimiter=' ').ravel()
+    diff = diff[~np.isnan(diff)]
+    if diff.shape[0] not in (12, 21):
+        raise ValueError(f'{filename} has {diff.shape[0]} values, expected 12 or 21')
+    rotation = diff[:9].reshape((3,3))
+    translation = diff[9:12]
+    if diff.shape[0] == 12:
+        return (rotation, translation, None)
+    centers = diff[12:].reshape((3,3))
+    return (rotation, translation, {axis: centers[k] for k, axis in enumerate('xyz')})
 
 class FSV:
     CERAMIC_THK = 1.0
     TRACE_THK = 0.06
     GLAZE_THK = 0.01
     TRACE_Z_OFFSET = 0.242
+    HALF_LENGTH = 20
+    # Height above the scan lines (fsv +z, away from the tool) for moves between axes
+    RETRACT_CLEARANCE = 10
+    APPROACH_SPEED = (5,5,5)
+    # Pass pairs per axis, enough for the bootstrap interval of crossing.OffsetEstimate
+    PASSES = OffsetEstimate.MIN_CI_PASSES
 
-    def __init__(self, fsv_filename: str, probe_calibration_array: np.ndarray):
-        self.daq = HallDAQ(1, 10000, start_trigger=True, acquisition='finite')
+    def __init__(self, fsv_filename: str, probe_calibration_array: np.ndarray, daq=None, cmm=None):
+        '''
+        daq and cmm can be passed in to use other backends (see simulation.py)
+        '''
+        self.daq = daq if daq is not None else HallDAQ(1, 10000, start_trigger=True, acquisition='finite')
         self.daq.power_on()
-        self.cmm = zeisscmm.CMM()
+        self.cmm = cmm if cmm is not None else zeisscmm.CMM()
         self.rotation, self.translation = self.import_fsv_alignment(fsv_filename)
+        # Scan center of every axis relative to the run_sequence start position, fsv frame
+        self.axis_centers = read_fsv_alignment(fsv_filename)[2]
         self.calibration_coeffs = probe_calibration_array
+        self.offset_estimates = {}
     
-    def calc_offset(self, data_pos: np.ndarray, data_neg: np.ndarray, filter_cutoff=500, fit_lc=175):
+    def calc_offset(self, data_pos, data_neg, filter_cutoff=500):
         '''
-        data_pos: (n, 2) array of sample data (ex. [x, bz])
-        data_neg: (n, 2) array of sample data (current reversed)
+        data_pos: (n, 2) array of sample data (ex. [x, bz]), or a sequence of
+            them for repeated passes
+        data_neg: (n, 2) array of sample data (current reversed), same form
         filter_cutoff: integer value used for smoothing raw sensor data,
             default set to 500
-        fit_lc: extra samples to cut off for better linear fit
-        returns: offset value for the respective CMM axis
-        '''
-        # Filter hallsensor data
-        dpf = filter_data(data_pos[:, 1], filter_cutoff)
-        dnf = filter_data(data_neg[:, 1], filter_cutoff)
-        # Filter noisy data and cutoff beginning/end
-        dpf_cutoff = dpf[filter_cutoff:-filter_cutoff]
-        dnf_cutoff = dnf[filter_cutoff:-filter_cutoff]
-        # Find min/max indices of filtered data and incorporate additional sample cutoff (fit_lc)
-        dpf_min_index = np.where(dpf_cutoff == dpf_cutoff.min())[0][0] + filter_cutoff + fit_lc
-        dpf_max_index = np.where(dpf_cutoff == dpf_cutoff.max())[0][0] + filter_cutoff - fit_lc
-        dnf_min_index = np.where(dnf_cutoff == dnf_cutoff.min())[0][0] + filter_cutoff + fit_lc
-        dnf_max_index = np.where(dnf_cutoff == dnf_cutoff.max())[0][0] + filter_cutoff - fit_lc
-        # dpf_polyfit = np.polyfit(data_pos[:, 0][dpf_min_index:dpf_max_index], dpf[dpf_min_index:dpf_max_index], 3)
-        # dnf_polyfit = np.polyfit(data_neg[:, 0][dnf_min_index:dnf_max_index], dnf[dnf_min_index:dnf_max_index], 3)
-        # diff = dpf_polyfit - dnf_polyfit
-        # offset = np.roots(diff)[1]
-        dpf_polyfit = np.polyfit(data_pos[:, 0][dpf_min_index:dpf_max_index], dpf[dpf_min_index:dpf_max_index], 5)
-        dnf_polyfit = np.polyfit(data_neg[:, 0][dnf_min_index:dnf_max_index], dnf[dnf_min_index:dnf_max_index], 5)
-        diff = dpf_polyfit - dnf_polyfit
-        offset = np.roots(diff)[2].real
-        # print(f'offset: {offset}')
-        return offset
+        returns: offset value for the respective CMM axis, crossing of the
+            filtered positive - negative difference (see crossing.estimate_offset)
+        '''
+        return estimate_offset(data_pos, data_neg, filter_cutoff, n_boot=0).offset
 
     def import_fsv_alignment(self, filename: str):
-        diff = np.genfromtxt(filename, delimiter=' ')
-        rotation = diff[:9].reshape((3,3))
-        translation = diff[9:]
-        return (rotation, translation)
+        return read_fsv_alignment(filename)[:2]
 
     def fsv2mcs(self, coordinate: np.ndarray):
         return (coordinate - self.translation)@self.rotation
@@ -72,8 +93,7 @@ class FSV:
         self.cmm.cnc_on()
         self.cmm.set_speed(speed)
         self.cmm.goto_position(start_pt)
-        while np.linalg.norm(start_pt - self.cmm.get_position()) > 0.025:
-            pass
+        self.cmm.wait_until_arrived(start_pt)
         self.daq.fsv_on(v=direction)
         self.daq.start_hallsensor_task()
         sleep(1) # Allow time for task to start.
@@ -90,68 +110,178 @@ class FSV:
         cal_data = calib_data(self.calibration_coeffs, data, sensitivity=sensitivity)
         return (start_position, end_position, cal_data)
 
-    def run_x_routine(self):
-        half_length = np.array([20, 0, 0])
-        current_pos_fsv = self.mcs2fsv(self.cmm.get_position())
-        start_pos_mcs = self.fsv2mcs(current_pos_fsv - half_length)
-        end_pos_mcs = self.fsv2mcs(current_pos_fsv + half_length)
-        # Scan +
-        speed_direction_vector = 5 * np.abs((end_pos_mcs - start_pos_mcs) / np.linalg.norm(end_pos_mcs - start_pos_mcs))
-        start_p, end_p, data_p = self.perform_scan(start_pos_mcs, end_pos_mcs, speed=speed_direction_vector)
-        x_p = np.linspace(start_p[0], end_p[0], data_p.shape[0])
-        sleep(1)
-        # Scan -
-        start_n, end_n, data_n = self.perform_scan(end_pos_mcs, start_pos_mcs, speed=speed_direction_vector, direction='negative')
-        x_n = np.linspace(start_n[0], end_n[0], data_n.shape[0])
-        # Combine CMM and hallsensor data into one array
-        combined_p = np.insert(data_p, 0, x_p, axis=1) # (x, Bx, By, Bz)
-        combined_n = np.insert(data_n, 0, x_n, axis=1) # (x, Bx, By, Bz)
-        data_pn_offset = self.calc_offset(combined_p[:, [0, 3]], combined_n[:, [0, 3]])
-        self.x_offset_fsv = data_pn_offset - (self.TRACE_THK/2 + self.GLAZE_THK)
-
-    def run_y_routine(self):
-        half_length = np.array([0, 20, 0])
-        current_pos_fsv = self.mcs2fsv(self.cmm.get_position())
-        start_pos_mcs = self.fsv2mcs(current_pos_fsv - half_length)
-        end_pos_mcs = self.fsv2mcs(current_pos_fsv + half_length)
-        # Scan +
-        speed_direction_vector = 5 * np.abs((end_pos_mcs - start_pos_mcs) / np.linalg.norm(end_pos_mcs - start_pos_mcs))
-        start_p, end_p, data_p = self.perform_scan(start_pos_mcs, end_pos_mcs, speed=speed_direction_vector)
-        y_p = np.linspace(start_p[1], end_p[1], data_p.shape[0])
-        sleep(1)
-        # Scan -
-        start_n, end_n, data_n = self.perform_scan(end_pos_mcs, start_pos_mcs, speed=speed_direction_vector, direction='negative')
-        y_n = np.linspace(start_n[1], end_n[1], data_n.shape[0])
-        combined_p = np.insert(data_p, 0, y_p, axis=1) # (y, Bx, By, Bz)
-        combined_n = np.insert(data_n, 0, y_n, axis=1) # (y, Bx, By, Bz)
-        data_pn_offset = self.calc_offset(combined_p[:, [0, 3]], combined_n[:, [0, 3]])
-        self.y_offset_fsv = data_pn_offset - (self.TRACE_THK/2 + self.GLAZE_THK)
-
-    def run_z_routine(self):
-        half_length = np.array([0, 0, 20])
-        current_pos_fsv = self.mcs2fsv(self.cmm.get_position())
-        start_pos_mcs = self.fsv2mcs(current_pos_fsv - half_length)
-        end_pos_mcs = self.fsv2mcs(current_pos_fsv + half_length)
-        # Set hall probe to high sensitivity
-        self.daq.change_sensitivity(sensitivity='100MT')
-        # Scan +
+    def axis_endpoints(self, axis: str, center_fsv: np.ndarray):
+        '''
+        mcs start and end of the scan along axis centered on center_fsv
+        '''
+        half = np.zeros(3)
+        half['xyz'.index(axis)] = self.HALF_LENGTH
+        return (self.fsv2mcs(center_fsv - half), self.fsv2mcs(center_fsv + half))
+
+    def scan_axis(self, axis: str, center_fsv=None, passes=None, on_pass=None):
+        '''
+        Runs passes (default PASSES) pairs of positive and negative current passes
+            along axis ('x', 'y' or 'z') centered on center_fsv (default current position).
+        on_pass(axis, index, direction) is called after every pass.
+        returns (passes_p, passes_n), lists of (n, 2) arrays of (position along
+            axis, field component) for calc_offset
+        '''
+        index = 'xyz'.index(axis)
+        passes = self.PASSES if passes is None else passes
+        if center_fsv is None:
+            center_fsv = self.mcs2fsv(self.cmm.get_position())
+        start_pos_mcs, end_pos_mcs = self.axis_endpoints(axis, center_fsv)
         speed_direction_vector = 5 * np.abs((end_pos_mcs - start_pos_mcs) / np.linalg.norm(end_pos_mcs - start_pos_mcs))
-        start_p, end_p, data_p = self.perform_scan(start_pos_mcs, end_pos_mcs, speed=speed_direction_vector, sensitivity=100, direction='negative')
-        z_p = np.linspace(start_p[2], end_p[2], data_p.shape[0])
-        sleep(1)
-        # Scan -
-        start_n, end_n, data_n = self.perform_scan(end_pos_mcs, start_pos_mcs, speed=speed_direction_vector, sensitivity=100)
-        z_n = np.linspace(start_n[2], end_n[2], data_n.shape[0])
-        combined_p = np.insert(data_p, 0, z_p, axis=1) # (z, Bx, By, Bz)
-        combined_n = np.insert(data_n, 0, z_n, axis=1) # (z, Bx, By, Bz)
-        data_pn_offset = self.calc_offset(combined_p[:, [0, 1]], combined_n[:, [0, 1]])
-        self.z_offset_fsv = data_pn_offset + self.TRACE_Z_OFFSET
-
-    def save_probe_offset(self):
+        if axis == 'z':
+            # Set hall probe to high sensitivity, current directions are swapped for z
+            self.daq.change_sensitivity(sensitivity='100MT')
+            sensitivity, directions, column = (100, ('negative', 'positive'), 1)
+        else:
+            sensitivity, directions, column = (5, ('positive', 'negative'), 3)
+        passes_p, passes_n = ([], [])
+        for k in range(passes):
+            start_p, end_p, data_p = self.perform_scan(start_pos_mcs, end_pos_mcs, speed=speed_direction_vector,
+                                                       sensitivity=sensitivity, direction=directions[0])
+            if on_pass is not None:
+                on_pass(axis, k, directions[0])
+            start_n, end_n, data_n = self.perform_scan(end_pos_mcs, start_pos_mcs, speed=speed_direction_vector,
+                                                       sensitivity=sensitivity, direction=directions[1])
+            if on_pass is not None:
+                on_pass(axis, k, directions[1])
+            # Combine CMM and hallsensor data, (position, Bx, By, Bz)
+            combined_p = np.insert(data_p, 0, np.linspace(start_p[index], end_p[index], data_p.shape[0]), axis=1)
+            combined_n = np.insert(data_n, 0, np.linspace(start_n[index], end_n[index], data_n.shape[0]), axis=1)
+            passes_p.append(combined_p[:, [0, column]])
+            passes_n.append(combined_n[:, [0, column]])
+        return (passes_p, passes_n)
+
+    def axis_offset(self, axis: str, passes_p, passes_n):
+        '''
+        fsv offset of axis from the passes of scan_axis, stored as
+            x_offset_fsv, y_offset_fsv or z_offset_fsv.  The OffsetEstimate
+            with the bootstrap uncertainty is kept in offset_estimates[axis].
+        '''
+        estimate = estimate_offset(passes_p, passes_n)
+        self.offset_estimates[axis] = estimate
+        data_pn_offset = estimate.offset
+        if axis == 'z':
+            offset = data_pn_offset + self.TRACE_Z_OFFSET
+        else:
+            offset = data_pn_offset - (self.TRACE_THK/2 + self.GLAZE_THK)
+        setattr(self, f'{axis}_offset_fsv', offset)
+        return offset
+
+    def run_x_routine(self, passes=None, on_pass=None):
+        self.axis_offset('x', *self.scan_axis('x', passes=passes, on_pass=on_pass))
+
+    def run_y_routine(self, passes=None, on_pass=None):
+        self.axis_offset('y', *self.scan_axis('y', passes=passes, on_pass=on_pass))
+
+    def run_z_routine(self, passes=None, on_pass=None):
+        self.axis_offset('z', *self.scan_axis('z', passes=passes, on_pass=on_pass))
+
+    def run_sequence(self, start_fsv=None, filename='fsv_offset.txt', on_axis=None, transit_speed=(20,20,20),
+                     passes=None, on_pass=None):
+        '''
+        Unattended x, y, z qualification from one start position (default the
+            current position) using the axis_centers of the fsv alignment file.
+            Between axes the CMM retracts above the scan lines, crosses at
+            transit_speed and approaches the start of the next axis at
+            APPROACH_SPEED (see transit), and the offset of an axis is computed on a
+            worker thread while the CMM already scans the next axis.
+            on_axis(axis, offset) is called from the worker, on_pass as in
+            scan_axis.  An exception raised by either ends the sequence.
+        passes pairs of passes are run per axis and averaged (default PASSES).
+        Writes filename and its uncertainty file, returns the (3,) fsv offsets.
+        '''
+        if self.axis_centers is None:
+            raise ValueError('The fsv alignment file has no axis scan centers')
+        if start_fsv is None:
+            start_fsv = self.mcs2fsv(self.cmm.get_position())
+        # Clear every scan line of the sequence, the z line reaches HALF_LENGTH above its center
+        clear_z = max(start_fsv[2] + center[2] for center in self.axis_centers.values()) + self.HALF_LENGTH + self.RETRACT_CLEARANCE
+        worker = ThreadPoolExecutor(max_workers=1)
+        futures = []
+        try:
+            for axis in 'xyz':
+                center_fsv = start_fsv + self.axis_centers[axis]
+                self.transit(self.axis_endpoints(axis, center_fsv)[0], clear_z, transit_speed)
+                axis_passes = self.scan_axis(axis, center_fsv, passes, on_pass)
+                futures.append(worker.submit(self.__axis_job__, axis, axis_passes, on_axis))
+        finally:
+            worker.shutdown(wait=True)
+        offsets = np.array([future.result() for future in futures])
+        self.save_probe_offset(filename)
+        return offsets
+
+    def transit(self, target_mcs, clear_z, transit_speed=(20,20,20)):
+        '''
+        Moves to target_mcs without crossing the fsv tool: straight up to the
+            fsv height clear_z at APPROACH_SPEED, across at transit_speed and
+            down onto the target at APPROACH_SPEED.
+        '''
+        position_fsv = self.mcs2fsv(self.cmm.get_position())
+        target_fsv = self.mcs2fsv(target_mcs)
+        clear_z = max(clear_z, position_fsv[2], target_fsv[2])
+        moves = ((np.array([position_fsv[0], position_fsv[1], clear_z]), self.APPROACH_SPEED),
+                 (np.array([target_fsv[0], target_fsv[1], clear_z]), transit_speed),
+                 (target_fsv, self.APPROACH_SPEED))
+        self.cmm.cnc_on()
+        for point_fsv, speed in moves:
+            point_mcs = self.fsv2mcs(point_fsv)
+            self.cmm.set_speed(speed)
+            self.cmm.goto_position(point_mcs)
+            self.cmm.wait_until_arrived(point_mcs)
+
+    def __axis_job__(self, axis, passes, on_axis):
+        offset = self.axis_offset(axis, *passes)
+        if on_axis is not None:
+            on_axis(axis, offset)
+        return offset
+
+    def save_probe_offset(self, filename='fsv_offset.txt'):
         # print(f'x_fsv: {self.x_offset_fsv}\ny_fsv: {self.y_offset_fsv}\nz_fsv: {self.z_offset_fsv}')
         offset_mcs = np.array([self.x_offset_fsv, self.y_offset_fsv, self.z_offset_fsv])@self.rotation
-        with open('fsv_offset.txt', 'w') as file:
+        with open(filename, 'w') as file:
             file.write(f'{offset_mcs[0]} {offset_mcs[1]} {offset_mcs[2]}\n')
+        if all(axis in self.offset_estimates for axis in 'xyz'):
+            self.save_offset_uncertainty(uncertainty_filename(filename))
+
+    def offset_uncertainty(self):
+        '''
+        returns ((3,) mcs, (3,) fsv) standard uncertainties (mm, k=1) of the
+            probe offset, the FSV x/y/z position error of the uncertainty budget.
+            NaN (not estimated) for axes scanned with fewer than 2 pass pairs.
+        '''
+        u_fsv = np.array([self.offset_estimates[axis].std for axis in 'xyz'])
+        # offset_mcs = offset_fsv @ rotation, the axes are independent
+        u_mcs = np.sqrt(u_fsv**2 @ self.rotation**2)
+        return (u_mcs, u_fsv)
+
+    def save_offset_uncertainty(self, filename='fsv_uncertainty.txt'):
+        '''
+        Writes the uncertainties, and the bootstrap interval with at least
+            MIN_CI_PASSES pass pairs per axis.  With fewer than 2 pass pairs on
+            any axis only an "insufficient passes" note is written.
+        '''
+        passes = {axis: len(self.offset_estimates[axis].pass_offsets) for axis in 'xyz'}
+        counts = ' '.join(f'{axis} {n}' for axis, n in passes.items())
+        if min(passes.values()) < 2:
+            with open(filename, 'w') as file:
+                file.write(f'# insufficient passes: FSV probe offset uncertainty not estimated, needs at least 2 '
+                           f'pass pairs per axis (pass pairs: {counts})\n')
+            return
+        u_mcs, u_fsv = self.offset_uncertainty()
+        header = f'FSV probe offset standard uncertainty (mm, k=1, normal): mcs x y z, fsv x y z\npass pairs: {counts}'
+        rows = [u_mcs, u_fsv]
+        if min(passes.values()) >= OffsetEstimate.MIN_CI_PASSES:
+            confidence = self.offset_estimates['x'].confidence
+            rows += list(np.array([self.offset_estimates[axis].ci for axis in 'xyz']).T)
+            header += f'\n{confidence:.0%} bootstrap interval of the fsv crossings: lo x y z, hi x y z'
+        else:
+            header += (f'\ninsufficient passes for the bootstrap interval, needs at least '
+                       f'{OffsetEstimate.MIN_CI_PASSES} pass pairs per axis')
+        np.savetxt(filename, np.vstack(rows), header=header)
 
     def shutdown(self):
         self.cmm.close()
@@ -170,7 +300,9 @@ class fsvWindow(tk.Toplevel):
         self.img_fsv_x = ImageTk.PhotoImage(Image.open('images/fsv_x.jpg'))
         self.img_fsv_y = ImageTk.PhotoImage(Image.open('images/fsv_y.jpg'))
         self.img_fsv_z = ImageTk.PhotoImage(Image.open('images/fsv_z.jpg'))
+        self.executor = JobExecutor(self)
         self.create_widgets()
+        self.protocol('WM_DELETE_WINDOW', self.close_window)
     
     def create_widgets(self):
         self.btn_load_alignment = ttk.Button(self.frm_fsv_window, text='Load FSV Alignment', command=self.load_alignment)
@@ -178,21 +310,31 @@ class fsvWindow(tk.Toplevel):
         self.btn_run_x = ttk.Button(self.frm_fsv_window, text='Run X Offset', command=lambda: self.run_fsv(offset='x'), state='disabled')
         self.btn_run_y = ttk.Button(self.frm_fsv_window, text='Run Y Offset', command=lambda: self.run_fsv(offset='y'), state='disabled')
         self.btn_run_z = ttk.Button(self.frm_fsv_window, text='Run Z Offset', command=lambda: self.run_fsv(offset='z'), state='disabled')
-        self.btn_close = ttk.Button(self.frm_fsv_window, text='Close', command=self.destroy)
+        self.btn_run_all = ttk.Button(self.frm_fsv_window, text='Run All Offsets', command=lambda: self.run_fsv(offset='all'), state='disabled')
+        self.frm_passes = tk.Frame(self.frm_fsv_window)
+        self.lbl_passes = ttk.Label(self.frm_passes, text='Pass pairs per axis')
+        self.passes = tk.IntVar(value=FSV.PASSES)
+        self.spn_passes = ttk.Spinbox(self.frm_passes, from_=1, to=50, width=5, textvariable=self.passes)
+        self.btn_cancel = ttk.Button(self.frm_fsv_window, text='Cancel', command=self.executor.cancel, state='disabled')
+        self.btn_close = ttk.Button(self.frm_fsv_window, text='Close', command=self.close_window)
+        self.run_buttons = (self.btn_run_x, self.btn_run_y, self.btn_run_z, self.btn_run_all)
         self.btn_load_alignment.grid(column=0, row=0, padx=5, pady=5)
         self.btn_load_calibration.grid(column=0, row=1, padx=5, pady=5)
         self.btn_run_x.grid(column=0, row=2, padx=5, pady=5)
         self.btn_run_y.grid(column=0, row=3, padx=5, pady=5)
         self.btn_run_z.grid(column=0, row=4, padx=5, pady=5)
-        self.btn_close.grid(column=0, row=5, padx=5, pady=5)
-        self.btn_run_x.bind('<Button-1>', lambda event: self.lbl_desc.configure(text='Please wait.  X offset routine running...'))
-        self.btn_run_y.bind('<Button-1>', lambda event: self.lbl_desc.configure(text='Please wait.  Y offset routine running...'))
-        self.btn_run_z.bind('<Button-1>', lambda event: self.lbl_desc.configure(text='Please wait.  Z offset routine running...'))
+        self.btn_run_all.grid(column=0, row=5, padx=5, pady=5)
+        self.frm_passes.grid(column=0, row=6, padx=5, pady=5)
+        self.lbl_passes.grid(column=0, row=0, padx=(0,5))
+        self.spn_passes.grid(column=1, row=0)
+        self.btn_cancel.grid(column=0, row=7, padx=5, pady=5)
+        self.btn_close.grid(column=0, row=8, padx=5, pady=5)
 
     def load_alignment(self):
         self.fsv_filename = filedialog.askopenfilename(filetypes=[('Text Files', '*.txt'), ('All Files', '*.*')])
         if (self.fsv_filename and self.calib_coeffs) is not None:
             self.btn_run_x.configure(state='enabled')
+            self.enable_run_all()
             self.load_image(self.img_fsv_x, offset_axis='x')
         self.focus()
     
@@ -204,9 +346,21 @@ class fsvWindow(tk.Toplevel):
         np.save('zg_calib_coeffs.npy', self.calib_coeffs, allow_pickle=False)
         if (self.fsv_filename and self.calib_coeffs) is not None:
             self.btn_run_x.configure(state='enabled')
+            self.enable_run_all()
             self.load_image(self.img_fsv_x, offset_axis='x')
             self.focus()
     
+    def enable_run_all(self):
+        '''
+        The xyz sequence needs the axis scan centers of the alignment file
+        '''
+        try:
+            has_centers = read_fsv_alignment(self.fsv_filename)[2] is not None
+        except ValueError as error:
+            messagebox.showerror(title='Error', message=str(error))
+            has_centers = False
+        self.btn_run_all.configure(state='enabled' if has_centers else 'disabled')
+
     def load_image(self, image, offset_axis='x'):
         try:
             self.lbl_desc.configure(text=f'Move probe over fsv tool as shown and run {offset_axis} offset')
@@ -220,25 +374,75 @@ class fsvWindow(tk.Toplevel):
     def run_fsv(self, offset='x'):
         if (self.fsv_filename and self.calib_coeffs) is None:
             messagebox.showerror(title='Error', message='Load alignment and calibration files first.')
+            return
+        try:
+            passes = self.passes.get()
+        except tk.TclError:
+            passes = 0
+        if passes < 1:
+            messagebox.showerror(title='Error', message='Enter a whole number of pass pairs of at least 1.')
+            return
+        if passes < OffsetEstimate.MIN_CI_PASSES and not messagebox.askokcancel(
+                title='Pass pairs', message=(f'With fewer than {OffsetEstimate.MIN_CI_PASSES} pass pairs per axis the '
+                                             f'offset uncertainty is not fully estimated.  Continue?')):
+            return
+        for button in self.run_buttons:
+            button.configure(state='disabled')
+        self.btn_cancel.configure(state='enabled')
+        name = 'xyz offset sequence' if offset == 'all' else f'{offset.upper()} offset routine'
+        self.lbl_desc.configure(text=f'Please wait.  {name} running...')
+        self.executor.submit(self.__offset_job__, offset, passes, name=name,
+                             on_progress=lambda message, partial: self.lbl_desc.configure(text=message),
+                             on_done=lambda result: self.offset_done(offset),
+                             on_error=lambda error: self.offset_stopped(offset, f'{name} failed: {error}'),
+                             on_cancel=lambda: self.offset_stopped(offset, f'{name} cancelled.'))
+
+    def __offset_job__(self, job, offset, passes):
+        '''
+        runs on the executor thread, hardware only, no widgets
+        '''
+        on_pass = lambda axis, index, direction: job.progress(f'{axis.upper()} pass {index + 1} ({direction}) done...')
+        on_axis = lambda axis, value: job.progress(f'{axis.upper()} offset {value:.4f} mm, continuing...')
+        if self.fsv is None:
+            self.fsv = FSV(self.fsv_filename, self.calib_coeffs)
+        if offset == 'all':
+            # Probe is positioned once over the start position of the x routine
+            self.fsv.run_sequence(on_axis=on_axis, on_pass=on_pass, passes=passes)
+            self.fsv.shutdown()
         else:
-            if self.fsv is None:
-                self.fsv = FSV(self.fsv_filename, self.calib_coeffs)
-            if offset == 'x':
-                self.fsv.run_x_routine()
-                self.btn_run_x.configure(state='disabled')
-                self.btn_run_y.configure(state='enabled')
-                self.load_image(self.img_fsv_y, offset_axis='y')
-            elif offset == 'y':
-                self.fsv.run_y_routine()
-                self.btn_run_y.configure(state='disabled')
-                self.btn_run_z.configure(state='enabled')
-                self.load_image(self.img_fsv_z, offset_axis='z')
-            elif offset == 'z':
-                self.fsv.run_z_routine()
-                self.btn_run_z.configure(state='disabled')
+            getattr(self.fsv, f'run_{offset}_routine')(passes=passes, on_pass=on_pass)
+            if offset == 'z':
                 self.fsv.save_probe_offset()
                 self.fsv.shutdown()
-                self.lbl_desc.configure(text='xyz offset routines complete.  You may now close the window.')
+
+    def offset_done(self, offset):
+        self.btn_cancel.configure(state='disabled')
+        if offset == 'x':
+            self.btn_run_y.configure(state='enabled')
+            self.load_image(self.img_fsv_y, offset_axis='y')
+        elif offset == 'y':
+            self.btn_run_z.configure(state='enabled')
+            self.load_image(self.img_fsv_z, offset_axis='z')
+        else:
+            self.lbl_desc.configure(text='xyz offset routines complete.  You may now close the window.')
+
+    def offset_stopped(self, offset, message):
+        self.btn_cancel.configure(state='disabled')
+        self.lbl_desc.configure(text=message)
+        if offset == 'all':
+            self.enable_run_all()
+            self.btn_run_x.configure(state='enabled')
+        else:
+            getattr(self, f'btn_run_{offset}').configure(state='enabled')
+
+    def close_window(self):
+        if self.executor.busy:
+            # Wait for the running routine to reach a safe point
+            self.executor.cancel()
+            self.after(100, self.close_window)
+            return
+        self.executor.shutdown()
+        self.destroy()
 
 
 if __name__ == '__main__':
@@ -1,25 +1,46 @@
-from os import remove
+import os
+import json
 from nicdaq import HallDAQ
+from concurrent.futures import ThreadPoolExecutor
 import zeisscmm
 import numpy as np
 from time import time, sleep, perf_counter
-from calibration import calib_data, remove_outliers, average_sample
+from calibration import calib_data, fused_transforms, transform_scan
+from resample import bin_by_distance
+from scanjob import ScanJob
+from robust import RobustAccumulator, SequentialMean
+
+# Next to the module, independent of the working directory the app is started from
+SAMPLE_RATE_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_rate_cache.json')
+SAMPLE_RATE_MAX_AGE = 30 * 24 * 3600
+# Default output of the scans, loaded by the field plot of the GUI
+FIELDMAP_FILENAME = 'fieldmap_reduced.fmap'
+# Standard error of the mean (mT) a static measurement dwells for
+STATIC_TARGET_SEM = 0.001
 
 class HallProbe(HallDAQ):
-    def __init__(self, coord_diff: str, rate: int, samps_per_chan: int, start_trigger=True, acquisition='finite'):
+    def __init__(self, coord_diff: str, rate: int, samps_per_chan: int, start_trigger=True, acquisition='finite', cmm=None,
+                 measure_sample_rate=False):
         '''
         HallProbe class inherits HallDAQ.
         coord_diff is the text file generated by Calypso which contain the
             rotation and translation values to switch between pcs and mcs
             reference frames.
+        cmm is an already connected zeisscmm.CMM (e.g. to a simulation.SimCMM),
+            by default the CMM at its standard address is used.
+        measure_sample_rate=True times an acquisition instead of trusting the
+            sample clock when there is no valid cached rate.
         '''
         super().__init__(rate, samps_per_chan, start_trigger, acquisition)
         self.__load_coord_diff__(coord_diff)
         self.calib_coeffs = np.load('zg_calib_coeffs.npy')
         self.s_matrix = np.load('sensitivity.npy')
         self.probe_offset = np.genfromtxt('fsv_offset.txt')
-        self.cmm = zeisscmm.CMM()
-        self.sample_rate = self.__determine_sample_rate__()
+        self.update_transforms()
+        self.cmm = cmm if cmm is not None else zeisscmm.CMM()
+        self.poller = zeisscmm.PositionPoller(self.cmm, capacity=2**18, lag=True)
+        self.lag_model = zeisscmm.LagModel()
+        self.sample_rate = self.__determine_sample_rate__(measure_sample_rate)
         self.scan_speed = 5
     
     def __repr__(self):
@@ -29,8 +50,52 @@ class HallProbe(HallDAQ):
         c_diff = np.genfromtxt(diff_file)
         self.rotation = c_diff[:9].reshape((3,3))
         self.translation = c_diff[9:]
+
+    def update_transforms(self):
+        '''
+        Caches the inverse rotation and the fused field/coordinate transforms.
+        Call again after changing rotation, translation, s_matrix or probe_offset.
+        '''
+        self.rotation_inv, self.b_mcs2pcs, self.xyz_offset = fused_transforms(
+            self.rotation, self.translation, self.s_matrix, self.probe_offset)
     
-    def __determine_sample_rate__(self):
+    def __determine_sample_rate__(self, measure=False, cache_file=None, max_age=SAMPLE_RATE_MAX_AGE):
+        '''
+        Looks up the sample rate in cache_file (default SAMPLE_RATE_CACHE), keyed by the module/chassis
+            signature and the requested rate.  An entry is used while it is
+            younger than max_age seconds and the driver still reports the same
+            sample clock.  Otherwise the rate is taken from the sample clock
+            (or measured if measure=True) and stored.
+        '''
+        cache_file = SAMPLE_RATE_CACHE if cache_file is None else cache_file
+        self.change_sampling(1, 10000)
+        key = f'{self.device_signature()}|{self.RATE}'
+        clock_rate = self.sample_clock_rate()
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        entry = cache.get(key)
+        if (entry is not None and time() - entry['time'] < max_age
+                and np.isclose(entry['clock_rate'], clock_rate, rtol=1e-6)):
+            sample_rate = entry['sample_rate']
+        else:
+            sample_rate = self.measure_sample_rate() if measure else clock_rate
+            cache[key] = {'sample_rate': sample_rate, 'clock_rate': clock_rate, 'time': time(),
+                          'source': 'measured' if measure else 'clock'}
+            try:
+                with open(cache_file, 'w') as f:
+                    json.dump(cache, f, indent=2)
+            except OSError:
+                pass
+        print(f'Sample Rate: {sample_rate}')
+        return sample_rate
+
+    def measure_sample_rate(self):
+        '''
+        Times a 10000 sample acquisition, takes a few seconds
+        '''
         self.change_sampling(1, 10000)
         self.power_on()
         self.start_hallsensor_task()
@@ -41,66 +106,113 @@ class HallProbe(HallDAQ):
         end = perf_counter()
         self.stop_hallsensor_task()
         self.power_off()
-        sample_rate = self.SAMPLES_CHAN / (end - start)
-        print(f'Sample Rate: {sample_rate}')
-        return sample_rate
+        return self.SAMPLES_CHAN / (end - start)
     
     def pcs2mcs(self, coordinate):
         return (coordinate - self.translation)@self.rotation + self.probe_offset
 
     def mcs2pcs(self, coordinate):
-        return (coordinate - self.probe_offset)@np.linalg.inv(self.rotation) + self.translation
+        return (coordinate - self.probe_offset)@self.rotation_inv + self.translation
 
-    def reduce_scan_density(self, scan_data: np.ndarray, scan_interval=0.5):
+    def transform_scan(self, volts: np.ndarray, positions: np.ndarray, sensitivity=5, out=None, dtype=np.float64):
         '''
-        scan_data is (n, 6) array (x, y, z, Bx, By, Bz)
+        volts is the (n, 4) raw hall sensor data and positions the (n, 3) mcs
+            position of every sample
+        Polynomial calibration, sensitivity matrix, mcs -> pcs rotation of B
+            and xyz and the probe offset in one vectorized pass.
+        out is an optional (n, 6) array to write into, otherwise one of dtype
+            is allocated (float32 halves memory, coordinates keep ~0.1 um).
+        returns (n, 6) array (x, y, z, Bx, By, Bz) in pcs
         '''
-        scan_distance = np.linalg.norm(scan_data[-1, :3] - scan_data[0, :3])
-        pts_mm = scan_data.shape[0] / scan_distance
-        interval_index = int(pts_mm / (1 / scan_interval))
-        reduced_data = []
-        for i in range(0, scan_data.shape[0], interval_index):
-            reduced_data.append(scan_data[i])
-        return np.array(reduced_data)
+        return transform_scan(volts, positions, self.calib_coeffs, self.b_mcs2pcs, self.rotation_inv,
+                              self.xyz_offset, sensitivity, out, dtype)
 
-    def scan_point(self, *point):
+    def reduce_scan_density(self, scan_data: np.ndarray, scan_interval=0.5, return_stats=False):
+        '''
+        scan_data is (n, 6) array (x, y, z, Bx, By, Bz) of one line
+        Samples are averaged in scan_interval mm bins of distance along the line
+            (see resample.bin_by_distance), scan_interval=None keeps full resolution.
+        returns (k, 6) array of bin means, or (mean, std, count) with return_stats=True
+        '''
+        if scan_interval is None:
+            if return_stats:
+                return (scan_data, np.zeros(scan_data.shape), np.ones(scan_data.shape[0], dtype=int))
+            return scan_data
+        mean, std, count = bin_by_distance(scan_data, scan_interval)
+        if return_stats:
+            return (mean, std, count)
+        return mean
+
+    def scan_speed_vector(self, start_point, end_point, speed=None, min_axis_speed=1.0):
+        '''
+        Per-axis G53 speeds that move along the line at speed (default scan_speed) mm/s.
+        Axes are never set below min_axis_speed, so residual offsets of the
+            start position on the other axes (within the arrival tolerance)
+            cannot stall the move.  They do not limit the path speed.
+        '''
+        speed = self.scan_speed if speed is None else speed
+        direction = np.abs((end_point - start_point) / np.linalg.norm(end_point - start_point))
+        return np.maximum(speed * direction, min_axis_speed)
+
+    def measure_static(self, num_samples=None, on_chunk=None, target_sem=STATIC_TARGET_SEM):
+        '''
+        Streams calibrated samples at the current position chunk by chunk into
+            a SequentialMean that stops once the signal has settled and the
+            standard error of the mean is below target_sem (mT), at most
+            num_samples (default SAMPLES_CHAN).
+        target_sem=None takes exactly num_samples samples into a RobustAccumulator.
+        on_chunk(accumulator) is called after every chunk for live statistics.
+        Like the qualification routines, raises RuntimeError if target_sem is
+            not reached within num_samples (SequentialMean.require_done).
+        returns the accumulator, its clipped_mean is Bxyz before the sensitivity matrix
+        '''
+        num_samples = self.SAMPLES_CHAN if num_samples is None else num_samples
+        transform = lambda volts: calib_data(self.calib_coeffs, volts)
+        self.power_on()
+        self.start_stream()
+        try:
+            if target_sem is None:
+                stats = RobustAccumulator(3)
+                sleep(1)
+                self.pulse()
+                self.accumulate_stream(stats, num_samples, transform=transform, on_chunk=on_chunk)
+            else:
+                # Settling of the sensor after power on is detected from the data
+                stats = SequentialMean(3, target_sem)
+                self.pulse()
+                self.accumulate_until_done(stats, num_samples, transform=transform, on_chunk=on_chunk)
+        finally:
+            self.stop_stream()
+            self.power_off()
+        if target_sem is not None:
+            stats.require_done('Static measurement', 'mT')
+        return stats
+
+    def scan_point(self, *point, on_chunk=None):
         if not point:
             point = self.cmm.get_position()
-            self.power_on()
-            self.start_hallsensor_task()
-            sleep(1)
-            self.pulse()
-            data = self.read_hallsensor()
-            cal_data = calib_data(self.calib_coeffs, data)
-            self.power_off()
-            self.stop_hallsensor_task()
-            Bxyz = self.s_matrix@average_sample(remove_outliers(cal_data))
+            stats = self.measure_static(on_chunk=on_chunk)
+            Bxyz = self.s_matrix@stats.clipped_mean
             return (point, Bxyz)
         else:
             point = point[0]
             self.cmm.cnc_on()
             self.cmm.set_speed((40,40,40))
             self.cmm.goto_position(point)
-            while np.linalg.norm(point - self.cmm.get_position()) > 0.025:
-                pass
-            self.power_on()
-            self.start_hallsensor_task()
-            sleep(1)
-            self.pulse()
-            data = self.read_hallsensor()
-            cal_data = calib_data(self.calib_coeffs, data)
-            self.cmm.set_speed((70,70,70))
-            self.cmm.cnc_off()
-            self.power_off()
-            self.stop_hallsensor_task()
-            Bxyz = self.s_matrix@average_sample(remove_outliers(cal_data))
+            self.cmm.wait_until_arrived(point)
+            try:
+                stats = self.measure_static(on_chunk=on_chunk)
+            finally:
+                self.cmm.set_speed((70,70,70))
+                self.cmm.cnc_off()
+            Bxyz = self.s_matrix@stats.clipped_mean
             return (point, Bxyz)
 
     def scan_line(self, start_point, end_point):
         distance = np.linalg.norm(end_point - start_point)
         travel_time = distance / self.scan_speed
         samples = ((travel_time * self.sample_rate) - self.sample_rate).round(0).astype(int)
-        speed_direction_vector = 5 * np.abs((end_point - start_point) / np.linalg.norm((end_point - start_point)))
+        speed_direction_vector = self.scan_speed_vector(start_point, end_point)
         print(f'Distance: {distance}')
         print(f'Travel Time: {travel_time}')
         print(f'Num Samples: {samples}')
@@ -108,39 +220,262 @@ class HallProbe(HallDAQ):
         self.cmm.cnc_on()
         self.cmm.set_speed((20,20,20))
         self.cmm.goto_position(start_point)
-        while np.linalg.norm(start_point - self.cmm.get_position()) > 0.025:
-            pass
+        self.cmm.wait_until_arrived(start_point)
         self.cmm.set_speed(speed_direction_vector)
         self.power_on()
         self.start_hallsensor_task()
         sleep(1)
+        # Poll from standstill to arrival so every sample time is bracketed by polled positions
+        self.poller.start()
         self.cmm.goto_position(end_point)
         sleep(1)
+        t_trigger = perf_counter()
         self.pulse()
-        start_pt = self.cmm.get_position()
         data = self.read_hallsensor()
-        end_pt = self.cmm.get_position()
-        while np.linalg.norm(end_point - self.cmm.get_position()) > 0.025:
-            pass
+        self.cmm.wait_until_arrived(end_point)
+        self.poller.stop()
         self.cmm.set_speed((70,70,70))
         self.cmm.cnc_off()
         self.stop_hallsensor_task()
         self.power_off()
-        Bxyz = calib_data(self.calib_coeffs, data)
-        for i, sample in enumerate(Bxyz):
-            Bxyz[i] = self.s_matrix@sample
-        linear = np.linspace(start_pt, end_pt, num=samples)
-        scan_distance = np.linalg.norm(end_pt - start_pt)
+        Bxyz = calib_data(self.calib_coeffs, data) @ self.s_matrix.T
+        # Position of every sample from the polled position stream instead of assuming constant velocity
+        sample_times = t_trigger + np.arange(data.shape[0]) / self.sample_rate
+        positions = self.poller.interpolate(sample_times)
+        # Correct for the speed dependent servo lag between reported and actual position
+        self.lag_model.update_from_poller(self.poller)
+        positions = self.lag_model.correct(positions, sample_times)
+        scan_distance = np.linalg.norm(positions[-1] - positions[0])
         print(f'Scan Distance: {scan_distance}')
         print(f'mm / point: {scan_distance / samples}')
-        return (linear, Bxyz)
+        return (positions, Bxyz)
         
 
-    def scan_area(self, start_point, x_length, y_length, grid=0.5):
-        pass
+    def process_line(self, data: np.ndarray, positions: np.ndarray, scan_interval=0.5, filename=None):
+        '''
+        data is the (n, 4) raw hall sensor volts of one line and positions the
+            (n, 3) mcs position of every sample
+        Calibrates and transforms the line to pcs, reduces it to scan_interval
+            and appends it to filename if given.
+        returns (m, 6) array (x, y, z, Bx, By, Bz) in pcs
+        '''
+        reduced_data = self.reduce_scan_density(self.transform_scan(data, positions), scan_interval)
+        if filename is not None:
+            with open(filename, 'a') as file:
+                np.savetxt(file, reduced_data, fmt='%.6f')
+        return reduced_data
+
+    def plan_speed_profile(self, reference: np.ndarray, start_pcs, end_pcs, min_speed=2.0, max_speed=40.0,
+                           segment_length=5.0, field_tolerance=0.5, time_uncertainty=0.001):
+        '''
+        reference is (k, 6) pcs data (x, y, z, Bx, By, Bz) of a neighboring line
+            or a coarse pre-pass, projected onto the line from start_pcs to end_pcs
+        The position error of a sample grows with speed (time_uncertainty s of
+            timing/lag residual), so each segment_length mm segment gets the
+            highest speed that keeps |dB/ds| * speed * time_uncertainty below
+            field_tolerance mT, clipped to [min_speed, max_speed] mm/s.
+            Segments without reference data run at scan_speed.
+        returns (breakpoints, speeds), (j+1, 3) pcs points from start to end and
+            (j,) path speeds, with equal neighboring segments merged
+        '''
+        start_pcs = np.asarray(start_pcs, dtype=float)
+        line = np.asarray(end_pcs, dtype=float) - start_pcs
+        length = np.linalg.norm(line)
+        direction = line / length
+        s = (reference[:, :3] - start_pcs) @ direction
+        order = np.argsort(s)
+        s = s[order]
+        gradient = np.zeros(s.shape[0])
+        if s.shape[0] > 1:
+            gradient = np.linalg.norm(np.gradient(reference[order, 3:], s, axis=0), axis=1)
+        num_segments = max(int(np.ceil(length / segment_length)), 1)
+        edges = np.linspace(0, length, num_segments + 1)
+        # Look half a segment beyond each end so speed drops before a steep region
+        lo = np.searchsorted(s, edges[:-1] - segment_length / 2)
+        hi = np.searchsorted(s, edges[1:] + segment_length / 2)
+        speeds = np.full(num_segments, float(self.scan_speed))
+        for i in range(num_segments):
+            if hi[i] > lo[i]:
+                steepest = gradient[lo[i]:hi[i]].max()
+                limit = field_tolerance / (steepest * time_uncertainty) if steepest > 0 else max_speed
+                speeds[i] = np.clip(limit, min_speed, max_speed)
+        # Quantize to 0.5 mm/s and merge segments with equal speed
+        speeds = np.floor(speeds * 2) / 2
+        keep = np.append(np.diff(speeds) != 0, True)
+        edges = np.append(0, edges[1:][keep])
+        speeds = speeds[keep]
+        breakpoints = start_pcs + np.outer(edges, direction)
+        return (breakpoints, speeds)
 
-    def scan_volume(self):
-        pass
+    def __traverse_line__(self, breakpoints, speeds, accel=100.0):
+        '''
+        Moves through the mcs breakpoints at the per-segment path speeds.
+        The next segment is commanded once the CMM is within its braking
+            distance (speed^2 / 2 accel, accel in mm/s^2) of the current
+            breakpoint, so it does not stop between segments.
+        '''
+        for i, speed in enumerate(speeds):
+            self.cmm.set_speed(self.scan_speed_vector(breakpoints[i], breakpoints[i+1], speed))
+            self.cmm.goto_position(breakpoints[i+1])
+            if i == len(speeds) - 1:
+                self.cmm.wait_until_arrived(breakpoints[i+1])
+            else:
+                self.cmm.wait_until_arrived(breakpoints[i+1], tol=max(speed**2 / (2 * accel), 0.025))
+
+    def scan_lines(self, lines: np.ndarray, filename=FIELDMAP_FILENAME, scan_interval=0.5, on_line=None, adaptive=False,
+                   metadata=None, keep_raw=True):
+        '''
+        lines is an (m, 2, 3) array of line start/end points in pcs
+        Starts a new ScanJob for filename (manifest <filename>.job.json) unless
+            filename is None, see run_job.  A .fmap filename is stored as a binary
+            fieldmap.FieldMapFile, other names as text.
+        metadata, e.g. {'part_number': ..., 'serial': ...}, goes into the job
+            manifest and the FieldMapFile header.
+        keep_raw also stores the raw volts and mcs positions of every sample in
+            <name>.raw.fmap for recalibrate.recalibrate_scans.
+        '''
+        if filename is None:
+            return self.run_job(None, on_line, lines=lines, scan_interval=scan_interval, adaptive=adaptive)
+        job = ScanJob.create(self, lines, filename, scan_interval, adaptive, metadata=metadata, keep_raw=keep_raw)
+        return self.run_job(job, on_line)
+
+    def resume(self, manifest, on_line=None):
+        '''
+        Continues an interrupted job from its manifest file.  The recorded
+            alignment and calibration are restored, a partially written line is
+            removed from the data file and finished lines are skipped.
+        returns the reduced arrays of the lines scanned by this call
+        '''
+        job = ScanJob.load(manifest)
+        job.apply(self)
+        job.truncate()
+        return self.run_job(job, on_line)
+
+    def run_job(self, job, on_line=None, lines=None, scan_interval=0.5, adaptive=False):
+        '''
+        Scans the remaining lines of a ScanJob, each finished line is appended
+            to job.filename and recorded in the manifest.
+        Without a job the lines, scan_interval and adaptive arguments are used
+            and nothing is saved.
+        The probe stays powered and the hall sensor task runs continuously for
+            the whole job.  Samples are taken from the stream while the CMM
+            travels each line and mapped to the polled, lag corrected positions.
+        Calibration, transforms, reduction and the file append of a line run on a
+            worker thread while the CMM already moves to the next line.
+        on_line(line_index, reduced_data) is called from the worker after each line.
+        If the worker fails on a line (processing, file append or on_line) the
+            job stops before the next line is processed, at most one more line
+            is traversed.
+        adaptive=True splits every line after the first into segments with speeds
+            from plan_speed_profile using the previous line as reference.
+        returns list of (k, 6) reduced arrays, one per scanned line
+        '''
+        if job is not None:
+            lines, scan_interval, adaptive = (job.lines, job.scan_interval, job.adaptive)
+            indices = job.remaining()
+        else:
+            indices = range(len(lines))
+        worker = ThreadPoolExecutor(max_workers=1)
+        results = []
+        reference = None
+        if adaptive and job is not None and indices and indices[0] - 1 in job.completed:
+            reference = job.line_data(indices[0] - 1)
+        self.power_on()
+        self.start_stream()
+        sleep(1)
+        self.pulse()
+        self.cmm.cnc_on()
+        try:
+            for i in indices:
+                start_pcs, end_pcs = lines[i]
+                start_point = self.pcs2mcs(start_pcs)
+                end_point = self.pcs2mcs(end_pcs)
+                if adaptive and results:
+                    reference = results[-1].result()
+                if adaptive and reference is not None:
+                    breakpoints, speeds = self.plan_speed_profile(reference, start_pcs, end_pcs)
+                    breakpoints = self.pcs2mcs(breakpoints)
+                else:
+                    breakpoints, speeds = (np.array([start_point, end_point]), [self.scan_speed])
+                self.cmm.set_speed((20,20,20))
+                self.cmm.goto_position(start_point)
+                self.cmm.wait_until_arrived(start_point)
+                # Stop here if the worker already failed on the previous line
+                if results and results[-1].done() and results[-1].exception() is not None:
+                    raise results[-1].exception()
+                self.poller.start()
+                # Discard samples taken while moving to the start of the line
+                self.stream.clear()
+                self.__traverse_line__(breakpoints, speeds)
+                self.poller.stop()
+                index, data = self.__read_stream_until__(self.poller.window()[1])
+                sample_times = self.stream_times(index, data.shape[0])
+                # Only samples bracketed by polled positions have a position
+                t_first, t_last = self.poller.window()
+                inside = (sample_times >= t_first) & (sample_times <= t_last)
+                data, sample_times = (data[inside], sample_times[inside])
+                positions = self.poller.interpolate(sample_times)
+                self.lag_model.update_from_poller(self.poller)
+                positions = self.lag_model.correct(positions, sample_times)
+                # The previous line was processed while this one was traversed
+                if results and results[-1].exception() is not None:
+                    raise results[-1].exception()
+                results.append(worker.submit(self.__process_line_job__, i, data, positions, sample_times, scan_interval,
+                                             job, on_line))
+        finally:
+            self.cmm.set_speed((70,70,70))
+            self.cmm.cnc_off()
+            self.stop_stream()
+            self.power_off()
+            worker.shutdown(wait=True)
+            if job is not None:
+                job.close()
+        return [result.result() for result in results]
+
+    def __read_stream_until__(self, t_end, timeout=5.0):
+        '''
+        Reads the stream until it holds a sample taken at or after the
+            perf_counter time t_end.  Samples arrive in stream_chunk blocks with
+            the every-N callback, so the end of a line is usually still pending
+            when the CMM arrives.
+        returns (index, data) of all unread samples
+        '''
+        index, data = self.read_stream(timeout=0)
+        chunks = [data]
+        end = index + data.shape[0]
+        while end == index or self.stream_times(end - 1, 1)[0] < t_end:
+            data = self.read_stream(timeout=timeout)[1]
+            if data.shape[0] == 0:
+                raise TimeoutError('No samples from the hall sensor stream')
+            chunks.append(data)
+            end += data.shape[0]
+        return (index, np.concatenate(chunks))
+
+    def __process_line_job__(self, line_index, data, positions, sample_times, scan_interval, job, on_line):
+        reduced_data = self.process_line(data, positions, scan_interval)
+        if job is not None:
+            job.append_line(line_index, reduced_data, (data, positions, sample_times))
+        if on_line is not None:
+            on_line(line_index, reduced_data)
+        return reduced_data
+
+    def scan_area(self, start_point, x_length, y_length, grid=0.5, filename=FIELDMAP_FILENAME, scan_interval=0.5, on_line=None,
+                  adaptive=False, metadata=None, keep_raw=True):
+        '''
+        start_point is a (3,) pcs coordinate, lines run along x and step by grid along y
+        '''
+        waypoints = zeisscmm.generate_scan_area(np.asarray(start_point, dtype=float), x_length, y_length, grid)
+        return self.scan_lines(waypoints.reshape((-1, 2, 3)), filename, scan_interval, on_line, adaptive=adaptive,
+                               metadata=metadata, keep_raw=keep_raw)
+
+    def scan_volume(self, start_point, x_length, y_length, z_length, grid=0.5, filename=FIELDMAP_FILENAME, scan_interval=0.5,
+                    on_line=None, adaptive=False, metadata=None, keep_raw=True):
+        '''
+        Stack of scan_area planes stepping by grid along z
+        '''
+        volume = zeisscmm.generate_scan_volume(np.asarray(start_point, dtype=float), x_length, y_length, z_length, grid)
+        return self.scan_lines(volume.reshape((-1, 2, 3)), filename, scan_interval, on_line, adaptive=adaptive,
+                               metadata=metadata, keep_raw=keep_raw)
 
     def shutdown(self):
         self.cmm.close()
@@ -149,23 +484,6 @@ class HallProbe(HallDAQ):
         
 
 if __name__ == '__main__':
-    start_points_y = np.arange(-10, 55, 0.5)
-    start_xyz = np.zeros((start_points_y.shape[0], 3))
-    for i, pt in enumerate(start_points_y):
-        start_xyz[i] = -25, pt, 3
     test = HallProbe(r'D:\CMM Programs\Hallprobe Test Magnet\magnet_alignment.txt', 1, 2)
-    for start_pt in start_xyz:
-        data = test.scan_line(test.pcs2mcs(start_pt), test.pcs2mcs(start_pt + np.array([75, 0, 0])))
-        xyz = data[0]
-        Bxyz = data[1]
-        for i, pt in enumerate(xyz):
-            xyz[i] = test.mcs2pcs(pt)
-        for i, pt in enumerate(Bxyz):
-            Bxyz[i] = pt@np.linalg.inv(test.rotation)
-        h_stack = np.hstack((xyz, Bxyz))
-        reduced_data = test.reduce_scan_density(h_stack)
-        with open('fieldmap_reduced.txt', 'a') as file:
-            np.savetxt(file, reduced_data, fmt='%.6f')
-        # np.save('xyz.npy', xyz, allow_pickle=False)
-        # np.save('Bxyz.npy', Bxyz, allow_pickle=False)
+    test.scan_area(np.array([-25, -10, 3]), 75, 64.5, grid=0.5, filename=FIELDMAP_FILENAME)
     test.shutdown()
\ No newline at end of file
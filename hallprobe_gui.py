@@ -1,21 +1,28 @@
 import tkinter as tk
 from tkinter import ttk
 from tkinter.constants import W
-from tkinter.messagebox import showinfo
+from tkinter.messagebox import showinfo, showerror
 from tkinter.scrolledtext import ScrolledText
 from zeisscmm import CMM
 from fsv import fsvWindow
 from cube import CubeWindow
 from zero_gauss import zgWindow
 from mapping import MapFrames
+from resample import minmax_decimate
+from fieldmap import FieldMapFile, load_fieldmap
+from jobs import JobExecutor
+from hallprobe import HallProbe, FIELDMAP_FILENAME
+import zeisscmm
 import numpy as np
-from os.path import isfile
+from os.path import isfile, splitext
 
 import matplotlib
 matplotlib.use("TkAgg")
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from matplotlib.figure import Figure
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
 
 from tooltip import ToolTip
 
@@ -121,6 +128,8 @@ class MapField(ttk.LabelFrame):
     def __init__(self, parent, title='Field Mapping'):
         self.map_field_parent = parent
         super().__init__(parent, text=title, labelanchor='nw')
+        self.alignment_file = None
+        self.executor = JobExecutor(self)
         self.grid(pady=10, sticky='nsew')
         self.create_frames()
         self.create_widgets()
@@ -136,7 +145,9 @@ class MapField(ttk.LabelFrame):
         self.btn_scan_point = ttk.Button(self.frm_buttons, text='Scan Point', state='disabled', command=lambda: self.load_frame(self.frm_mapframe.frm_scan_point))
         self.btn_scan_line = ttk.Button(self.frm_buttons, text='Scan Line', state='disabled', command=lambda: self.load_frame(self.frm_mapframe.frm_scan_line))
         self.btn_scan_area_volume = ttk.Button(self.frm_buttons, text='Scan Area/Volume', state='disabled', command=lambda: self.load_frame(self.frm_mapframe.frm_scan_area_volume))
-        self.btn_stop_mapping = ttk.Button(self.frm_buttons, text='Stop')
+        self.btn_stop_mapping = ttk.Button(self.frm_buttons, text='Stop', command=self.executor.cancel)
+        self.frm_mapframe.btn_sav_measure.configure(command=self.scan_area_volume)
+        self.frm_mapframe.btn_sav_stop.configure(command=self.executor.cancel)
         # Place widgets within grid
         self.btn_load_part_alignment.grid(column=0, row=0, sticky='new', padx=5, pady=5)
         self.btn_scan_point.grid(column=0, row=1, sticky='new', padx=5, pady=(0,5))
@@ -149,24 +160,118 @@ class MapField(ttk.LabelFrame):
         frame.grid(column=0, row=0)
     
     def load_part_alignment(self):
+        alignment_file = tk.filedialog.askopenfilename(filetypes=[('Text Files', '*.txt'), ('All Files', '*.*')])
+        if alignment_file == '':
+            return
+        self.alignment_file = alignment_file
         self.btn_scan_point.configure(state='enabled')
         self.btn_scan_line.configure(state='enabled')
         self.btn_scan_area_volume.configure(state='enabled')
 
+    def set_status(self, message):
+        self.map_field_parent.program_frame.lbl_controls_status.configure(text=message)
+
+    def scan_area_volume(self):
+        '''
+        Starts a scan_area (Z distance 0) or scan_volume of the entered start
+            point and distances on the executor thread, lines are line pitch
+            apart and point density is the sample interval along a line.
+            Every finished line is drawn on the field plot as it arrives.
+        '''
+        frame = self.frm_mapframe
+        try:
+            start = np.array([float(entry.get()) for entry in (frame.ent_sav_sp_x, frame.ent_sav_sp_y, frame.ent_sav_sp_z)])
+            distance = [float(entry.get() or 0) for entry in (frame.ent_sav_sd_x, frame.ent_sav_sd_y, frame.ent_sav_sd_z)]
+        except ValueError:
+            showerror(title='Error', message='Enter the start point and scan distances in mm.')
+            return
+        if frame.cbox_sav_scan_plane.get() != 'xy':
+            showerror(title='Error', message='Only xy scan planes are supported.')
+            return
+        try:
+            grid = float(frame.ent_sav_pitch.get())
+        except ValueError:
+            grid = 0
+        if grid <= 0:
+            showerror(title='Error', message='Enter the line pitch in mm.')
+            return
+        density = frame.cbox_sav_pd.get()
+        scan_interval = None if density == 'full res' else float(density)
+        if distance[2] == 0:
+            waypoints = zeisscmm.generate_scan_area(start, distance[0], distance[1], grid)
+        else:
+            waypoints = zeisscmm.generate_scan_volume(start, *distance, grid)
+        lines = waypoints.reshape((-1, 2, 3))
+        magnet = self.map_field_parent.magnet_info_frame
+        metadata = {'part_number': magnet.ent_partnum.get(), 'serial': magnet.ent_serial.get()}
+        plot = self.map_field_parent.controls_frame_parent.visuals.field_plot.field_plot
+        plot.clear()
+        plot.set_extent(lines)
+        frame.btn_sav_measure.configure(state='disabled')
+        self.set_status(f'Scanning {lines.shape[0]} lines...')
+
+        def on_progress(message, partial):
+            self.set_status(message)
+            if 'line' in partial:
+                plot.append_line(partial['line'])
+        self.executor.submit(self.__scan_job__, lines, scan_interval, metadata, name='field scan', on_progress=on_progress,
+                             on_done=lambda results: self.scan_stopped(f'Scan finished, saved to {FIELDMAP_FILENAME}'),
+                             on_error=lambda error: self.scan_stopped(f'Scan failed: {error}', error),
+                             on_cancel=lambda: self.scan_stopped('Scan stopped, resume it from its job manifest.'))
+
+    def __scan_job__(self, job, lines, scan_interval, metadata):
+        '''
+        runs on the executor thread, hardware only, no widgets
+        '''
+        def on_line(index, data):
+            # Raises Cancelled once stopped, which ends the scan after this line
+            job.progress(f'Line {index + 1} of {lines.shape[0]} done...', line=data)
+        probe = HallProbe(self.alignment_file, 1, 2)
+        try:
+            return probe.scan_lines(lines, scan_interval=scan_interval, on_line=on_line, metadata=metadata)
+        finally:
+            probe.shutdown()
+
+    def scan_stopped(self, message, error=None):
+        self.frm_mapframe.btn_sav_measure.configure(state='enabled')
+        self.set_status(message)
+        if error is not None:
+            showerror(title='Error', message=str(error))
+
 class PlotField(tk.Frame):
     '''
     tk frame for plotting magnetic field data
+    Finished lines are added with append_line as they are scanned and blitted
+        as a new scatter, the whole map is only redrawn when the color range
+        or the level of detail changes.  At most POINT_BUDGET points of the
+        current x/y view are drawn, larger maps are decimated along the scan
+        keeping the minimum and maximum |B| of every bucket.
     '''
-    def __init__(self, parent):
+    POINT_BUDGET = 50000
+
+    def __init__(self, parent, filename=FIELDMAP_FILENAME):
         self.plotfield_parent = parent
         super().__init__(parent)
+        # x, y, |B| of every point in scan order, grown by doubling
+        self.points = np.empty((4096, 3))
+        self.count = 0
+        self.bucket = 1
+        self.shown = 0
+        self.artists = []
+        self.background = None
+        self.follow = True
+        self.extent = None
+        self.updating = False
+        self.pending_refresh = None
         self.create_plot()
+        if filename is not None and not isfile(filename):
+            # Maps from before the binary format were text files
+            filename = splitext(filename)[0] + '.txt'
+        if filename is not None and (isfile(filename) or isfile(filename + FieldMapFile.EXTENSION)):
+            # Load the last map once the window is up
+            self.after_idle(self.load_map, filename)
 
     def create_plot(self):
-        data = np.genfromtxt('fieldmap_reduced.txt')
-        cmm_xyz = data[:, :3]
-        Bxyz = data[:, 3:]
-        Bxyz_norm = np.linalg.norm(Bxyz, axis=1)
         self.fig = Figure(figsize=(8,4))
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.plotfield_parent)
         self.canvas.draw()
@@ -176,13 +281,133 @@ class PlotField(tk.Frame):
         self.ax.set_xlabel('x axis [mm]')
         self.ax.set_ylabel('y axis [mm]')
         self.ax.set_zlabel('Field Strength [mT]')
-        plot3d = self.ax.scatter(cmm_xyz[:, 0], cmm_xyz[:, 1], Bxyz_norm, c=Bxyz_norm, cmap='rainbow', marker='.')
-        self.fig.colorbar(plot3d, ax=self.ax, label='mT', pad=0.1)
+        self.mappable = ScalarMappable(norm=Normalize(0, 1), cmap='rainbow')
+        self.fig.colorbar(self.mappable, ax=self.ax, label='mT', pad=0.1)
+        self.canvas.mpl_connect('draw_event', self.__on_draw__)
+        self.ax.callbacks.connect('xlim_changed', self.__on_view_changed__)
+        self.ax.callbacks.connect('ylim_changed', self.__on_view_changed__)
         self.toolbar = NavigationToolbar2Tk(self.canvas, self.plotfield_parent)
         self.toolbar.update()
         self.canvas.get_tk_widget().pack(side=tk.TOP,
                                          fill=tk.BOTH, expand=1)
 
+    def load_map(self, filename):
+        self.count = 0
+        self.follow = True
+        self.__store__(load_fieldmap(filename))
+        self.refresh()
+
+    def clear(self):
+        self.count = 0
+        self.follow = True
+        self.extent = None
+        self.refresh()
+
+    def set_extent(self, lines: np.ndarray):
+        '''
+        Sizes the x/y axes for the planned scan lines ((n, 2, 3) pcs start and
+            end points), so the lines of a running scan are blitted without
+            rescaling the plot
+        '''
+        xy = np.asarray(lines, dtype=float).reshape((-1, 3))[:, :2]
+        self.extent = (xy.min(axis=0), xy.max(axis=0))
+        self.follow = True
+        self.refresh()
+
+    def append_line(self, data: np.ndarray):
+        '''
+        data: (k, 6) array (x, y, z, Bx, By, Bz) of one finished line, e.g.
+            from the on_line callback of HallProbe.scan_lines passed on to the
+            Tk thread (jobs.Job.progress)
+        '''
+        start = self.count
+        self.__store__(data)
+        if self.count == start:
+            return
+        points = self.points[start:self.count]
+        vmin, vmax = self.mappable.get_clim()
+        estimate = self.shown + (points.shape[0] if self.bucket <= 2 else 2 * -(-points.shape[0] // self.bucket))
+        inside = self.__in_view__(points)
+        if (self.background is None or self.shown == 0 or points[:, 2].min() < vmin or points[:, 2].max() > vmax
+                or estimate > self.POINT_BUDGET or (self.follow and not inside.all())
+                or (not self.follow and not inside.any())):
+            self.refresh()
+            return
+        points = points[inside]
+        points = points[minmax_decimate(points[:, 2], self.bucket)]
+        artist = self.__scatter__(points)
+        self.shown += points.shape[0]
+        # Blit only the new line onto the last rendered frame
+        self.canvas.restore_region(self.background)
+        artist.do_3d_projection()
+        self.ax.draw_artist(artist)
+        self.canvas.blit(self.fig.bbox)
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+    def refresh(self):
+        '''
+        Redraws the whole map at the level of detail of the current view
+        '''
+        if self.pending_refresh is not None:
+            self.after_cancel(self.pending_refresh)
+            self.pending_refresh = None
+        for artist in self.artists:
+            artist.remove()
+        self.artists = []
+        self.shown = 0
+        points = self.points[:self.count]
+        if self.count:
+            self.mappable.set_clim(points[:, 2].min(), points[:, 2].max())
+            if self.follow:
+                self.updating = True
+                lo, hi = (points[:, :2].min(axis=0), points[:, :2].max(axis=0))
+                if self.extent is not None:
+                    lo, hi = (np.minimum(lo, self.extent[0]), np.maximum(hi, self.extent[1]))
+                pad = lambda lo, hi: (lo - 1, hi + 1) if lo == hi else (lo, hi)
+                self.ax.set_xlim(*pad(lo[0], hi[0]))
+                self.ax.set_ylim(*pad(lo[1], hi[1]))
+                self.ax.set_zlim(*pad(*self.mappable.get_clim()))
+                self.updating = False
+                visible = points
+            else:
+                visible = points[self.__in_view__(points)]
+            self.bucket = max(1, -(-2 * visible.shape[0] // self.POINT_BUDGET))
+            visible = visible[minmax_decimate(visible[:, 2], self.bucket)]
+            self.__scatter__(visible)
+            self.shown = visible.shape[0]
+        self.canvas.draw_idle()
+
+    def __store__(self, data):
+        k = data.shape[0]
+        if self.count + k > self.points.shape[0]:
+            points = np.empty((max(2 * self.points.shape[0], self.count + k), 3))
+            points[:self.count] = self.points[:self.count]
+            self.points = points
+        self.points[self.count:self.count+k, :2] = data[:, :2]
+        self.points[self.count:self.count+k, 2] = np.linalg.norm(data[:, 3:6], axis=1)
+        self.count += k
+
+    def __scatter__(self, points):
+        artist = self.ax.scatter(points[:, 0], points[:, 1], points[:, 2], c=points[:, 2], cmap=self.mappable.cmap,
+                                 norm=self.mappable.norm, marker='.')
+        self.artists.append(artist)
+        return artist
+
+    def __in_view__(self, points):
+        (x0, x1), (y0, y1) = (self.ax.get_xlim(), self.ax.get_ylim())
+        return (points[:, 0] >= x0) & (points[:, 0] <= x1) & (points[:, 1] >= y0) & (points[:, 1] <= y1)
+
+    def __on_draw__(self, event):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+    def __on_view_changed__(self, ax):
+        if self.updating:
+            return
+        # Zoom/pan by the user: follow the data again once the view holds all of it
+        self.follow = self.count == 0 or bool(self.__in_view__(self.points[:self.count]).all())
+        if self.pending_refresh is None:
+            self.pending_refresh = self.after(200, self.refresh)
+
 class PlotTemperature(tk.Frame):
     '''
     tk frame for plotting temperature sensor data
@@ -0,0 +1,154 @@
+import queue
+import threading
+import traceback
+
+class Cancelled(Exception):
+    '''
+    Raised inside a job by Job.check() after the job was cancelled
+    '''
+    pass
+
+class Job:
+    '''
+    Handle of one routine run by a JobExecutor, passed to the routine as its
+        first argument.
+    progress(message, **partial) sends a status message and any partial
+        results to the Tk thread, check() raises Cancelled once cancel() was
+        called.  Hardware routines call check() at safe points (e.g. from an
+        on_chunk callback), cancellation takes effect there.
+    '''
+    def __init__(self, name, fn, args, kwargs, on_progress=None, on_done=None, on_error=None, on_cancel=None):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancel = on_cancel
+        self.events = None
+        self.state = 'pending'
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+
+    def __repr__(self):
+        return f'Job({self.name}, {self.state})'
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check(self):
+        if self.cancel_event.is_set():
+            raise Cancelled(self.name)
+
+    def progress(self, message=None, **partial):
+        self.check()
+        self.events.put((self, 'progress', (message, partial)))
+
+class JobExecutor:
+    '''
+    Runs blocking hardware routines (DAQ / CMM) one at a time on a worker
+        thread so the Tk main loop stays responsive.
+    Events of the running job go through a queue that is drained on the Tk
+        thread every poll_ms with widget.after(), so all callbacks
+        (on_progress(message, partial), on_done(result), on_error(exception),
+        on_cancel()) may touch widgets.
+    '''
+    def __init__(self, widget, poll_ms=50):
+        self.widget = widget
+        self.poll_ms = poll_ms
+        self.jobs = queue.Queue()
+        self.events = queue.Queue()
+        self.current = None
+        self.pending = 0
+        self.polling = None
+        self.worker = threading.Thread(target=self.__worker__, daemon=True)
+        self.worker.start()
+
+    def __repr__(self):
+        return f'JobExecutor({self.pending} jobs)'
+
+    @property
+    def busy(self):
+        return self.pending > 0
+
+    def submit(self, fn, *args, name=None, on_progress=None, on_done=None, on_error=None, on_cancel=None, **kwargs):
+        '''
+        Queues fn(job, *args, **kwargs), returns the Job
+        '''
+        job = Job(name or getattr(fn, '__name__', 'job'), fn, args, kwargs, on_progress, on_done, on_error, on_cancel)
+        job.events = self.events
+        self.pending += 1
+        self.jobs.put(job)
+        self.__schedule__()
+        return job
+
+    def cancel(self):
+        '''
+        Cancels the running job and all queued ones
+        '''
+        if self.current is not None:
+            self.current.cancel()
+        for job in list(self.jobs.queue):
+            job.cancel()
+
+    def shutdown(self, cancel=True):
+        if cancel:
+            self.cancel()
+        self.jobs.put(None)
+        if self.polling is not None:
+            self.widget.after_cancel(self.polling)
+            self.polling = None
+
+    def __worker__(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            self.current = job
+            try:
+                job.check()
+                job.state = 'running'
+                job.result = job.fn(job, *job.args, **job.kwargs)
+                job.state = 'done'
+                self.events.put((job, 'done', job.result))
+            except Cancelled:
+                job.state = 'cancelled'
+                self.events.put((job, 'cancelled', None))
+            except Exception as error:
+                job.state = 'failed'
+                job.error = error
+                traceback.print_exc()
+                self.events.put((job, 'failed', error))
+            finally:
+                self.current = None
+
+    def __schedule__(self):
+        if self.polling is None:
+            self.polling = self.widget.after(self.poll_ms, self.__poll__)
+
+    def __poll__(self):
+        self.polling = None
+        while True:
+            try:
+                job, kind, payload = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'progress':
+                if job.on_progress is not None:
+                    job.on_progress(*payload)
+                continue
+            self.pending -= 1
+            if kind == 'done' and job.on_done is not None:
+                job.on_done(payload)
+            elif kind == 'failed' and job.on_error is not None:
+                job.on_error(payload)
+            elif kind == 'cancelled' and job.on_cancel is not None:
+                job.on_cancel()
+        if self.pending > 0:
+            self.__schedule__()
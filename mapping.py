@@ -91,6 +91,8 @@ class MapFrames(tk.Frame):
         self.cbox_sav_pd = ttk.Combobox(self.frm_scan_area_volume, values=self.density_list, width=9)
         self.lbl_sav_scan_plane = tk.Label(self.frm_scan_area_volume, text='Scan Plane')
         self.cbox_sav_scan_plane = ttk.Combobox(self.frm_scan_area_volume, values=['xy', 'yz', 'zx'], state='readonly', width=9)
+        self.lbl_sav_pitch = tk.Label(self.frm_scan_area_volume, text='Line Pitch')
+        self.ent_sav_pitch = ttk.Entry(self.frm_scan_area_volume, width=9)
         self.btn_sav_measure = ttk.Button(self.frm_scan_area_volume, text='Measure')
         self.btn_sav_stop = ttk.Button(self.frm_scan_area_volume, text='Stop')
         # Place widgets within grid
@@ -114,5 +116,8 @@ class MapFrames(tk.Frame):
         self.lbl_sav_scan_plane.grid(column=0, row=5, columnspan=2, pady=(0,5), sticky='e')
         self.cbox_sav_scan_plane.grid(column=2, row=5, columnspan=2, padx=5, pady=(0,5), sticky='w')
         self.cbox_sav_scan_plane.set('xy')
+        self.lbl_sav_pitch.grid(column=0, row=6, columnspan=2, pady=(0,5), sticky='e')
+        self.ent_sav_pitch.grid(column=2, row=6, columnspan=2, padx=5, pady=(0,5), sticky='w')
+        self.ent_sav_pitch.insert(0, '0.5')
         self.btn_sav_measure.grid(column=4, row=4, columnspan=2, padx=5, pady=(5,0), sticky='ew')
         self.btn_sav_stop.grid(column=4, row=5, columnspan=2, padx=5, pady=(0,5), sticky='ew')
\ No newline at end of file
@@ -1,8 +1,94 @@
 import nidaqmx as ni
+from nidaqmx.stream_readers import AnalogMultiChannelReader
 import numpy as np
-from time import sleep
+import threading
+from time import sleep, perf_counter
+
+class RingBuffer:
+    '''
+    Preallocated (capacity, channels) sample buffer.
+    The DAQ callback writes into it and consumers pull bounded chunks.
+    head and tail count total samples written/read since the stream started,
+        so head - tail is the number of unread samples and tail is the
+        absolute index of the next sample handed out.
+    If the consumer falls more than capacity samples behind, the oldest
+        samples are dropped and overflow is set.
+    '''
+    def __init__(self, capacity: int, channels=4, dtype=np.float64):
+        self.capacity = capacity
+        self.data = np.zeros((capacity, channels), dtype=dtype)
+        self.head = 0
+        self.tail = 0
+        self.overflow = False
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def write(self, samples: np.ndarray):
+        '''
+        samples is an (n, channels) array (views are fine, data is copied in)
+        '''
+        n = samples.shape[0]
+        with self._cond:
+            if n > self.capacity:
+                samples = samples[-self.capacity:]
+                self.head += n - self.capacity
+                n = self.capacity
+            start = self.head % self.capacity
+            first = min(n, self.capacity - start)
+            self.data[start:start+first] = samples[:first]
+            self.data[:n-first] = samples[first:]
+            self.head += n
+            if self.head - self.tail > self.capacity:
+                self.tail = self.head - self.capacity
+                self.overflow = True
+            self._cond.notify_all()
+
+    def read(self, max_samples: int, min_samples=1, timeout=None, out=None):
+        '''
+        Blocks until at least min_samples are available (or timeout/close)
+            and returns up to max_samples of them.
+        returns (index, data) where index is the absolute index of data[0]
+            and data is an (n, channels) array (a view into out if given)
+        '''
+        with self._cond:
+            self._cond.wait_for(lambda: len(self) >= min_samples or self.closed, timeout)
+            n = min(len(self), max_samples)
+            if out is None:
+                out = np.empty((n, self.data.shape[1]), dtype=self.data.dtype)
+            index = self.tail
+            start = index % self.capacity
+            first = min(n, self.capacity - start)
+            out[:first] = self.data[start:start+first]
+            out[first:n] = self.data[:n-first]
+            self.tail += n
+        return (index, out[:n])
+
+    def peek(self):
+        '''
+        returns a copy of the retained samples (the last min(head, capacity)
+            written) in order, without consuming them
+        '''
+        with self._cond:
+            n = min(self.head, self.capacity)
+            start = (self.head - n) % self.capacity
+            return np.roll(self.data, -start, axis=0)[:n].copy()
+
+    def clear(self):
+        with self._cond:
+            self.tail = self.head
+            self.overflow = False
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
 
 class HallDAQ:
+    # Callback clock marks kept for stream_times
+    CLOCK_MARKS = 4096
     POWER_ON = 1.3
     POWER_OFF = 0.0
     FSV_OFF = 0.0
@@ -25,6 +111,9 @@ class HallDAQ:
         self.mag_temp_task_status = False
         self.RATE = rate
         self.SAMPLES_CHAN = samps_per_chan
+        self.stream = None
+        self.hs_buffer = np.zeros(0)
+        self.temp_buffer = np.zeros(0)
 
         self.__create_tasks__()
         self.__configure_tasks__()
@@ -53,12 +142,37 @@ class HallDAQ:
                                                          thermocouple_type=ni.constants.ThermocoupleType.K)
         self.magnet_temp.timing.cfg_samp_clk_timing(self.RATE, sample_mode=ni.constants.AcquisitionType.CONTINUOUS,
                                                     samps_per_chan=self.SAMPLES_CHAN)
+        self.hs_reader = AnalogMultiChannelReader(self.hallsensor.in_stream)
+        self.temp_reader = AnalogMultiChannelReader(self.magnet_temp.in_stream)
     
     def change_sampling(self, rate, num_samples):
         self.hallsensor.timing.cfg_samp_clk_timing(rate, samps_per_chan=num_samples)
         self.RATE = rate
         self.SAMPLES_CHAN = num_samples
 
+    def sample_clock_rate(self):
+        '''
+        Actual (coerced) sample clock rate of the hall sensor task in Hz, as
+            reported by the driver without acquiring any data
+        '''
+        return self.hallsensor.timing.samp_clk_rate
+
+    def device_signature(self):
+        '''
+        Identifies the modules (and their chassis) used by the hall sensor task,
+            e.g. 'FieldSensor:NI 9239:1A2B3C4'
+        '''
+        devices = []
+        for device in self.hallsensor.devices:
+            devices.append(f'{device.name}:{device.product_type}:{device.serial_num:X}')
+            try:
+                chassis = device.compact_daq_chassis_device
+                devices.append(f'{chassis.name}:{chassis.product_type}:{chassis.serial_num:X}')
+            except ni.errors.DaqError:
+                # Not a C Series module
+                pass
+        return ','.join(devices)
+
     def change_sensitivity(self, sensitivity=None):
         if sensitivity is not None:
             self.hall_sensitivity.write(self.SENSOR_RANGE[sensitivity.upper().replace(' ', '')])
@@ -66,6 +180,7 @@ class HallDAQ:
             pass
     
     def close_tasks(self):
+        self.stop_stream()
         self.hallsensor.close()
         self.fsv.close()
         self.magnet_temp.close()
@@ -106,17 +221,161 @@ class HallDAQ:
         sleep(0.005)
         self.trigger.write(0)
 
-    def read_hallsensor(self):
-        while not self.hallsensor.is_task_done():
-            pass
-        sample = np.array(self.hallsensor.read(self.hallsensor._in_stream.avail_samp_per_chan)).T
-        return sample
-        
-    def read_magnet_temp(self):
-        while self.magnet_temp._in_stream.avail_samp_per_chan < self.SAMPLES_CHAN:
-            pass
-        sample = np.array(self.magnet_temp.read(self.magnet_temp._in_stream.avail_samp_per_chan)).T
-        return sample
+    def __reserve_buffer__(self, buffer: np.ndarray, channels: int, num_samples: int):
+        '''
+        buffer is a flat float64 array that is only reallocated when too small.
+        returns (buffer, view) where view is a C-contiguous (channels, num_samples)
+            reshape of its head, the layout the stream readers fill.
+        '''
+        if buffer.shape[0] < channels * num_samples:
+            buffer = np.zeros(channels * num_samples)
+        return (buffer, buffer[:channels*num_samples].reshape((channels, num_samples)))
+
+    def read_hallsensor(self, timeout=ni.constants.WAIT_INFINITELY, out=None):
+        '''
+        Returns a C-contiguous (n, 4) array (Bx, By, Bz, Temperature) in volts.
+        The stream reader fills a reusable channel-major scratch buffer, which
+            is copied once into out (an (m, 4) C-contiguous array with m >= n
+            the caller owns and can reuse, the result is out[:n]) or into a
+            new array.
+        '''
+        # Block in the driver instead of polling is_task_done()
+        self.hallsensor.wait_until_done(timeout=timeout)
+        num_samples = self.hallsensor.in_stream.avail_samp_per_chan
+        self.hs_buffer, buffer = self.__reserve_buffer__(self.hs_buffer, 4, num_samples)
+        self.hs_reader.read_many_sample(buffer, number_of_samples_per_channel=num_samples, timeout=timeout)
+        if out is None:
+            return np.ascontiguousarray(buffer.T)
+        out = out[:num_samples]
+        np.copyto(out, buffer.T)
+        return out
+
+    def read_magnet_temp(self, timeout=ni.constants.WAIT_INFINITELY):
+        '''
+        Returns a C-contiguous (n, 8) array of thermocouple temperatures.
+        '''
+        self.temp_buffer, buffer = self.__reserve_buffer__(self.temp_buffer, 8, self.SAMPLES_CHAN)
+        # read_many_sample blocks until SAMPLES_CHAN samples are in the buffer
+        self.temp_reader.read_many_sample(buffer, number_of_samples_per_channel=self.SAMPLES_CHAN, timeout=timeout)
+        return np.ascontiguousarray(buffer.T)
+
+    def start_stream(self, chunk_size=1000, buffer_samples=2**21):
+        '''
+        Switches the hall sensor task to continuous acquisition.
+        Every chunk_size samples the driver callback copies the new samples into
+            a RingBuffer of buffer_samples rows, which is drained with read_stream.
+        If the task was created with start_trigger=True acquisition starts on pulse().
+        Raises RuntimeError if a stream is already running (call stop_stream first).
+        '''
+        if self.stream is not None:
+            raise RuntimeError('Hall sensor stream is already running')
+        self.stop_hallsensor_task()
+        self.stream = RingBuffer(buffer_samples, channels=4)
+        self.stream_chunk = chunk_size
+        self.stream_scratch = np.zeros(4 * chunk_size)
+        # (samples acquired, perf_counter) at every callback, see stream_times
+        self.stream_clock = RingBuffer(self.CLOCK_MARKS, channels=2)
+        # Driver side buffer only has to hold a few callbacks worth of samples
+        self.hallsensor.timing.cfg_samp_clk_timing(self.RATE, sample_mode=ni.constants.AcquisitionType.CONTINUOUS,
+                                                   samps_per_chan=10*chunk_size)
+        self.hallsensor.register_every_n_samples_acquired_into_buffer_event(chunk_size, self.__stream_callback__)
+        self.start_hallsensor_task()
+        self.stream_rate = self.hallsensor.timing.samp_clk_rate
+        return self.stream
+
+    def __stream_callback__(self, task_handle, every_n_samples_event_type, number_of_samples, callback_data):
+        self.stream_scratch, buffer = self.__reserve_buffer__(self.stream_scratch, 4, number_of_samples)
+        self.hs_reader.read_many_sample(buffer, number_of_samples_per_channel=number_of_samples)
+        self.stream.write(buffer.T)
+        self.stream_clock.write(np.array([[self.stream.head, perf_counter()]]))
+        return 0
+
+    def stream_times(self, index: int, num_samples: int):
+        '''
+        returns (num_samples,) perf_counter times of the stream samples starting at index
+        The sample clock period is 1/stream_rate and the offset to perf_counter is
+            averaged over the callback clock marks around those samples, so DAQ
+            clock drift does not accumulate over long acquisitions.
+        '''
+        marks = self.stream_clock.peek()
+        if marks.shape[0] == 0:
+            raise RuntimeError('No stream callback has fired yet')
+        period = 1 / self.stream_rate
+        # Use the marks within a few callbacks of the requested samples
+        margin = 5 * self.stream_chunk
+        local = marks[(marks[:, 0] >= index - margin) & (marks[:, 0] <= index + num_samples + margin)]
+        if local.shape[0] == 0:
+            # Outside the retained marks, use the closest one
+            local = marks[[np.argmin(np.abs(marks[:, 0] - index))]]
+        # Callback for count samples fires after sample count-1 was acquired
+        offset = np.mean(local[:, 1] - (local[:, 0] - 1) * period)
+        return offset + (index + np.arange(num_samples)) * period
+
+    def read_stream(self, max_samples=None, min_samples=1, timeout=None):
+        '''
+        Returns (index, data) with up to max_samples (n, 4) samples from the
+            continuous stream, blocking until at least min_samples are available.
+        index is the absolute sample number of data[0] since start_stream.
+        '''
+        if max_samples is None:
+            max_samples = self.stream.capacity
+        return self.stream.read(max_samples, min_samples=min_samples, timeout=timeout)
+
+    def accumulate_stream(self, accumulator, num_samples, skip=0, transform=None, on_chunk=None, timeout=10.0,
+                          stop=None):
+        '''
+        Feeds num_samples samples of the running stream into accumulator
+            (anything with update(chunk), e.g. robust.RobustAccumulator) chunk
+            by chunk as they arrive, after discarding skip samples.
+        transform(volts) -> chunk is applied first (e.g. calibration).
+        on_chunk(accumulator) is called after every chunk for live statistics.
+        stop(accumulator) -> True ends the acquisition early.
+        returns accumulator
+        '''
+        remaining = skip
+        while remaining > 0:
+            skipped = self.read_stream(remaining, timeout=timeout)[1].shape[0]
+            if skipped == 0:
+                raise TimeoutError('No samples from the hall sensor stream')
+            remaining -= skipped
+        remaining = num_samples
+        while remaining > 0:
+            index, data = self.read_stream(remaining, timeout=timeout)
+            if data.shape[0] == 0:
+                raise TimeoutError('No samples from the hall sensor stream')
+            remaining -= data.shape[0]
+            accumulator.update(data if transform is None else transform(data))
+            if on_chunk is not None:
+                on_chunk(accumulator)
+            if stop is not None and stop(accumulator):
+                break
+        return accumulator
+
+    def accumulate_until_done(self, accumulator, max_samples, transform=None, on_chunk=None, timeout=10.0):
+        '''
+        accumulate_stream into a robust.SequentialMean until it is done or
+            max_samples are read.  Raises RuntimeError if the signal did not
+            settle, a result that did not reach its target_sem is returned
+            (check accumulator.done or call accumulator.require_done()).
+        '''
+        self.accumulate_stream(accumulator, max_samples, transform=transform, on_chunk=on_chunk, timeout=timeout,
+                               stop=lambda stats: stats.done)
+        if not accumulator.settled:
+            raise RuntimeError(f'Hall sensor signal did not settle within {max_samples} samples')
+        return accumulator
+
+    def stop_stream(self):
+        '''
+        Stops continuous acquisition and restores the finite task configuration.
+        '''
+        if self.stream is None:
+            return
+        self.stop_hallsensor_task()
+        self.hallsensor.register_every_n_samples_acquired_into_buffer_event(self.stream_chunk, None)
+        self.stream.close()
+        self.stream = None
+        self.hallsensor.timing.cfg_samp_clk_timing(self.RATE, sample_mode=self.acquisition_type,
+                                                   samps_per_chan=self.SAMPLES_CHAN)
 
     def start_hallsensor_task(self):
         if self.hs_task_status:
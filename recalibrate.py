@@ -0,0 +1,95 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from calibration import fused_transforms, transform_scan
+from fieldmap import FieldMapFile, calibration_hash
+from resample import bin_by_distance
+
+class CalibrationSet:
+    '''
+    Probe calibration used to turn raw volts into a pcs field map:
+        calib_coeffs (3, 3, 7) from calibration.get_xyz_calib_values / zero gauss,
+        s_matrix (3, 3) from the cube and probe_offset (3,) from the FSV routine.
+    rotation and translation (part alignment) are optional, by default the
+        alignment recorded with each raw scan is used.
+    '''
+    def __init__(self, calib_coeffs, s_matrix, probe_offset, rotation=None, translation=None):
+        self.calib_coeffs = np.asarray(calib_coeffs, dtype=float)
+        self.s_matrix = np.asarray(s_matrix, dtype=float)
+        self.probe_offset = np.asarray(probe_offset, dtype=float)
+        self.rotation = None if rotation is None else np.asarray(rotation, dtype=float)
+        self.translation = None if translation is None else np.asarray(translation, dtype=float)
+
+    def __repr__(self):
+        return f'CalibrationSet({self.hash()})'
+
+    @classmethod
+    def from_files(cls, calib_coeffs='zg_calib_coeffs.npy', s_matrix='sensitivity.npy', probe_offset='fsv_offset.txt'):
+        '''
+        loads the files written by the zero gauss, cube and FSV routines
+        '''
+        return cls(np.load(calib_coeffs), np.load(s_matrix), np.genfromtxt(probe_offset))
+
+    def hash(self):
+        return calibration_hash(self.calib_coeffs, self.s_matrix, self.probe_offset)
+
+def recalibrate_scan(raw_filename, calibration: CalibrationSet, output=None, scan_interval=None):
+    '''
+    Re-processes one raw scan (<name>.raw.fmap written by a ScanJob with
+        keep_raw) line by line with calibration and writes a new reduced
+        FieldMapFile, by default <name>.<calibration hash>.fmap.
+    scan_interval defaults to the one the scan was made with.
+    returns output filename
+    '''
+    raw = FieldMapFile(raw_filename)
+    metadata = raw.metadata
+    if output is None:
+        suffix = '.raw' + FieldMapFile.EXTENSION
+        base = raw_filename[:-len(suffix)] if raw_filename.endswith(suffix) else os.path.splitext(raw_filename)[0]
+        output = f'{base}.{calibration.hash()}{FieldMapFile.EXTENSION}'
+    scan_interval = metadata.get('scan_interval', 0.5) if scan_interval is None else scan_interval
+    rotation = calibration.rotation if calibration.rotation is not None else np.array(metadata['alignment']['rotation'])
+    translation = (calibration.translation if calibration.translation is not None
+                   else np.array(metadata['alignment']['translation']))
+    rotation_inv, b_mcs2pcs, xyz_offset = fused_transforms(rotation, translation, calibration.s_matrix,
+                                                           calibration.probe_offset)
+    records = raw.read()
+    lines = np.asarray(records['line'])
+    # Lines are stored contiguously in scan order
+    bounds = np.flatnonzero(np.diff(lines)) + 1 if lines.shape[0] else np.zeros(0, dtype=int)
+    header = dict(metadata, calibration_hash=calibration.hash(), source=os.path.basename(raw_filename),
+                  alignment={'rotation': rotation.tolist(), 'translation': translation.tolist()},
+                  scan_interval=scan_interval)
+    for key in ('frame', 'sensitivity'):
+        header.pop(key, None)
+    with FieldMapFile.create(output, header) as fieldmap:
+        for start, stop in zip(np.append(0, bounds), np.append(bounds, lines.shape[0])):
+            if stop == start:
+                continue
+            line = records[start:stop]
+            scan_data = transform_scan(np.asarray(line['volts'], dtype=float), np.asarray(line['xyz']),
+                                       calibration.calib_coeffs, b_mcs2pcs, rotation_inv, xyz_offset,
+                                       metadata.get('sensitivity', 5))
+            if scan_interval is not None:
+                scan_data = bin_by_distance(scan_data, scan_interval)[0]
+            fieldmap.append(scan_data[:, :3], scan_data[:, 3:6], line=lines[start])
+    return output
+
+def recalibrate_scans(raw_filenames, calibration: CalibrationSet, outputs=None, scan_interval=None, max_workers=None):
+    '''
+    recalibrate_scan for any number of archived raw scans in a process pool of
+        max_workers (default os.cpu_count()), call from under
+        `if __name__ == '__main__':` on Windows.
+    returns list of output filenames
+    '''
+    outputs = outputs if outputs is not None else [None] * len(raw_filenames)
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        return list(pool.map(recalibrate_scan, raw_filenames, [calibration] * len(raw_filenames), outputs,
+                             [scan_interval] * len(raw_filenames)))
+
+
+if __name__ == '__main__':
+    import sys
+    # python recalibrate.py scan1.raw.fmap scan2.raw.fmap ... with the current calibration files
+    for filename in recalibrate_scans(sys.argv[1:], CalibrationSet.from_files()):
+        print(filename)
@@ -0,0 +1,264 @@
+import numpy as np
+from fieldmap import FieldMapFile, load_fieldmap
+
+class DistanceBinner:
+    '''
+    Streaming resampler for line scans.
+    Samples are binned by their distance along the line from start to end
+        (projection of xyz onto the line direction) into bins of interval mm.
+    Every column is averaged per bin and the per-bin standard deviation
+        and sample count are kept, so chunks can be fed in as they arrive.
+    '''
+    def __init__(self, start_point, end_point, interval=0.5):
+        self.start_point = np.asarray(start_point, dtype=float)
+        direction = np.asarray(end_point, dtype=float) - self.start_point
+        if not np.linalg.norm(direction) > 0:
+            raise ValueError('start_point and end_point of the line must differ')
+        self.direction = direction / np.linalg.norm(direction)
+        self.interval = interval
+        self.first_bin = 0
+        self.count = np.zeros(0)
+        self.sums = None
+        self.sums_sq = None
+        self.shift = None
+
+    def __grow__(self, lo, hi, columns):
+        '''
+        extends the accumulators to cover bins lo..hi (absolute bin numbers)
+        '''
+        if self.sums is None:
+            self.first_bin = lo
+            self.count = np.zeros(hi - lo + 1)
+            self.sums = np.zeros((hi - lo + 1, columns))
+            self.sums_sq = np.zeros((hi - lo + 1, columns))
+            return
+        last_bin = self.first_bin + self.count.shape[0] - 1
+        before = max(self.first_bin - lo, 0)
+        after = max(hi - last_bin, 0)
+        if before or after:
+            self.count = np.pad(self.count, (before, after))
+            self.sums = np.pad(self.sums, ((before, after), (0, 0)))
+            self.sums_sq = np.pad(self.sums_sq, ((before, after), (0, 0)))
+            self.first_bin -= before
+
+    def update(self, scan_data: np.ndarray):
+        '''
+        scan_data is an (n, m) array with xyz in the first three columns
+        '''
+        if scan_data.shape[0] == 0:
+            return self
+        if self.shift is None:
+            # Accumulate around the first sample to keep the variance sums well conditioned
+            self.shift = scan_data[0].astype(float)
+        distance = (scan_data[:, :3] - self.start_point) @ self.direction
+        bins = np.floor(distance / self.interval).astype(int)
+        self.__grow__(bins.min(), bins.max(), scan_data.shape[1])
+        index = bins - self.first_bin
+        size = self.count.shape[0]
+        shifted = scan_data - self.shift
+        self.count += np.bincount(index, minlength=size)
+        for j in range(scan_data.shape[1]):
+            self.sums[:, j] += np.bincount(index, weights=shifted[:, j], minlength=size)
+            self.sums_sq[:, j] += np.bincount(index, weights=shifted[:, j]**2, minlength=size)
+        return self
+
+    def result(self, min_count=1):
+        '''
+        returns (mean, std, count) for every bin with at least min_count samples
+            mean and std are (k, m) arrays, count is (k,)
+            std uses ddof=1 and is 0 for single sample bins
+        '''
+        if self.sums is None:
+            return (np.zeros((0, 0)), np.zeros((0, 0)), np.zeros(0, dtype=int))
+        keep = self.count >= max(min_count, 1)
+        count = self.count[keep]
+        mean = self.sums[keep] / count[:, None]
+        var = self.sums_sq[keep] / count[:, None] - mean**2
+        var = np.maximum(var, 0) * np.where(count > 1, count / np.maximum(count - 1, 1), 0)[:, None]
+        return (mean + self.shift, np.sqrt(var), count.astype(int))
+
+def bin_by_distance(scan_data: np.ndarray, interval=0.5, start_point=None, end_point=None, min_count=1):
+    '''
+    scan_data is an (n, m) array of one line scan with xyz in the first three columns
+    Bins the whole line by distance along it (default from the first to the
+        last sample) and returns (mean, std, count) as DistanceBinner.result
+    '''
+    start_point = scan_data[0, :3] if start_point is None else start_point
+    end_point = scan_data[-1, :3] if end_point is None else end_point
+    return DistanceBinner(start_point, end_point, interval).update(scan_data).result(min_count)
+
+class GriddedMap:
+    '''
+    Scan data on a regular (z, y, x) lattice as produced by LatticeBinner.
+    x, y, z are the lattice axes, mean and variance are (nz, ny, nx, m) arrays
+        of every input column (NaN where count < min_count) and count is
+        (nz, ny, nx).
+    '''
+    def __init__(self, x, y, z, mean, variance, count):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.mean = mean
+        self.variance = variance
+        self.count = count
+
+    def __repr__(self):
+        return f'GriddedMap({self.count.shape}, {int((self.count > 0).sum())} occupied cells)'
+
+    def nodes(self):
+        '''
+        returns (nz, ny, nx, 3) xyz of the lattice nodes
+        '''
+        z, y, x = np.meshgrid(self.z, self.y, self.x, indexing='ij')
+        return np.stack((x, y, z), axis=-1)
+
+    def points(self):
+        '''
+        returns (k, m) array of the occupied cells, lattice node xyz followed by
+            the mean of the remaining columns (e.g. x, y, z, Bx, By, Bz)
+        '''
+        occupied = ~np.isnan(self.mean[..., -1])
+        return np.hstack((self.nodes()[occupied], self.mean[occupied][:, 3:]))
+
+    def save(self, filename):
+        np.savez(filename, x=self.x, y=self.y, z=self.z, mean=self.mean, variance=self.variance, count=self.count)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['x'], data['y'], data['z'], data['mean'], data['variance'], data['count'])
+
+class LatticeBinner:
+    '''
+    Streaming binning of scan data onto a regular lattice.
+    Every sample goes to its nearest lattice node (cells of spacing centered on
+        the nodes), samples outside the lattice are dropped.  Per node the
+        count, mean and variance of every column are kept, so data can be fed
+        in chunks of any size (e.g. from a memory mapped FieldMapFile).
+    '''
+    def __init__(self, origin, spacing, shape):
+        '''
+        origin is the (3,) xyz of node (0, 0, 0), spacing a scalar or (3,) xyz
+            array and shape the (nz, ny, nx) number of nodes
+        '''
+        self.origin = np.asarray(origin, dtype=float)
+        self.spacing = np.broadcast_to(np.asarray(spacing, dtype=float), (3,)).copy()
+        self.shape = tuple(int(n) for n in shape)
+        self.size = int(np.prod(self.shape))
+        self.count = np.zeros(self.size)
+        self.sums = None
+        self.sums_sq = None
+        self.shift = None
+
+    @classmethod
+    def for_scan_volume(cls, start_point, x_length, y_length, z_length=0, grid=0.5):
+        '''
+        lattice of the waypoints of zeisscmm.generate_scan_volume (z_length=0
+            for generate_scan_area), bins of grid along x as well
+        '''
+        shape = [np.arange(0, length + grid/2, grid).shape[0] for length in (z_length, y_length, x_length)]
+        return cls(start_point, grid, shape)
+
+    @classmethod
+    def covering(cls, xyz: np.ndarray, spacing=0.5):
+        '''
+        lattice with nodes on multiples of spacing covering all points in xyz
+        '''
+        spacing = np.broadcast_to(np.asarray(spacing, dtype=float), (3,))
+        lo = np.round(xyz.min(axis=0) / spacing)
+        hi = np.round(xyz.max(axis=0) / spacing)
+        return cls(lo * spacing, spacing, (hi - lo + 1)[::-1])
+
+    def axes(self):
+        '''
+        returns (x, y, z) lattice axes
+        '''
+        return tuple(self.origin[i] + self.spacing[i] * np.arange(self.shape[2 - i]) for i in range(3))
+
+    def update(self, scan_data: np.ndarray):
+        '''
+        scan_data is an (n, m) array with xyz in the first three columns
+        '''
+        if scan_data.shape[0] == 0:
+            return self
+        if self.shift is None:
+            self.shift = scan_data[0].astype(float)
+            self.sums = np.zeros((self.size, scan_data.shape[1]))
+            self.sums_sq = np.zeros((self.size, scan_data.shape[1]))
+        node = np.round((scan_data[:, :3] - self.origin) / self.spacing).astype(np.int64)
+        inside = np.all((node >= 0) & (node < self.shape[::-1]), axis=1)
+        node = node[inside]
+        index = (node[:, 2] * self.shape[1] + node[:, 1]) * self.shape[2] + node[:, 0]
+        shifted = scan_data[inside] - self.shift
+        self.count += np.bincount(index, minlength=self.size)
+        for j in range(scan_data.shape[1]):
+            self.sums[:, j] += np.bincount(index, weights=shifted[:, j], minlength=self.size)
+            self.sums_sq[:, j] += np.bincount(index, weights=shifted[:, j]**2, minlength=self.size)
+        return self
+
+    def result(self, min_count=1):
+        '''
+        returns GriddedMap, variance uses ddof=1 and is 0 for single sample cells
+        '''
+        x, y, z = self.axes()
+        columns = 0 if self.sums is None else self.sums.shape[1]
+        mean = np.full((self.size, columns), np.nan)
+        variance = np.full((self.size, columns), np.nan)
+        keep = self.count >= max(min_count, 1)
+        if self.sums is not None:
+            count = self.count[keep][:, None]
+            mean[keep] = self.sums[keep] / count
+            var = np.maximum(self.sums_sq[keep] / count - mean[keep]**2, 0)
+            variance[keep] = var * np.where(count > 1, count / np.maximum(count - 1, 1), 0)
+            mean[keep] += self.shift
+        grid_shape = self.shape + (columns,)
+        return GriddedMap(x, y, z, mean.reshape(grid_shape), variance.reshape(grid_shape),
+                          self.count.reshape(self.shape).astype(int))
+
+def grid_scan(source, spacing=0.5, binner=None, chunk_rows=2**20, min_count=1):
+    '''
+    Bins scan data onto a lattice and returns a GriddedMap.
+    source is an (n, m) array or a field map filename (FieldMapFile or text),
+        binary files are read in chunks of chunk_rows from the memory map.
+    binner defaults to LatticeBinner.covering the data with spacing.
+    '''
+    if isinstance(source, str) and source.endswith(FieldMapFile.EXTENSION):
+        fieldmap = FieldMapFile(source)
+        rows = len(fieldmap)
+        if binner is None:
+            records = fieldmap.read()
+            lo = np.full(3, np.inf)
+            hi = np.full(3, -np.inf)
+            for start in range(0, rows, chunk_rows):
+                xyz = records['xyz'][start:start+chunk_rows]
+                lo = np.minimum(lo, xyz.min(axis=0))
+                hi = np.maximum(hi, xyz.max(axis=0))
+            binner = LatticeBinner.covering(np.array([lo, hi]), spacing)
+        for start in range(0, rows, chunk_rows):
+            binner.update(fieldmap.field_data(start, start + chunk_rows))
+        return binner.result(min_count)
+    data = load_fieldmap(source) if isinstance(source, str) else np.asarray(source)
+    if binner is None:
+        binner = LatticeBinner.covering(data[:, :3], spacing)
+    for start in range(0, data.shape[0], chunk_rows):
+        binner.update(data[start:start+chunk_rows])
+    return binner.result(min_count)
+
+def minmax_decimate(values: np.ndarray, bucket: int):
+    '''
+    Level of detail for plotting: splits values (n,) in scan order into
+        buckets of bucket samples and keeps the minimum and maximum of each,
+        so peaks survive at any decimation.
+    returns sorted indices of the kept samples (all of them for bucket <= 2)
+    '''
+    n = values.shape[0]
+    if bucket <= 2 or n <= 2:
+        return np.arange(n)
+    count = -(-n // bucket)
+    padded = np.full(count * bucket, np.nan)
+    padded[:n] = values
+    padded = padded.reshape((count, bucket))
+    offsets = np.arange(count) * bucket
+    # The last bucket is the only one with padding and has at least one sample
+    keep = np.concatenate((offsets + np.nanargmin(padded, axis=1), offsets + np.nanargmax(padded, axis=1)))
+    return np.unique(keep)
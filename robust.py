@@ -0,0 +1,304 @@
+import numpy as np
+
+# MAD of a normal distribution times MAD_SIGMA is its standard deviation
+MAD_SIGMA = 1.4826
+
+class RobustAccumulator:
+    '''
+    Online statistics of (n, channels) data fed in chunks as they arrive.
+    Every channel keeps
+        count, mean and variance of all samples (Welford / Chan merge)
+        a fine histogram with per bin sums, giving the median, MAD and the
+            sigma clipped mean: the mean of the samples within
+            clip * 1.4826 * MAD of the median.
+    The histogram spans +-span robust sigmas of the first warmup samples in
+        bins bins (or of all samples so far when a statistic is read
+        earlier).  A later chunk whose median falls outside the histogram
+        doubles the bin width until it fits, existing bins merge pairwise.
+        Other samples outside it only enter count/mean/variance and are
+        always treated as outliers.
+    '''
+    def __init__(self, channels, clip=3.0, bins=16384, span=25.0, warmup=256):
+        if bins % 4:
+            raise ValueError('bins must be a multiple of 4')
+        self.channels = channels
+        self.clip = clip
+        self.bins = bins
+        self.span = span
+        self.warmup = warmup
+        self.warmup_data = []
+        self.count = 0
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros(channels)
+        self.lo = None
+        self.width = None
+        self.hist_count = np.zeros((channels, bins))
+        self.hist_sum = np.zeros((channels, bins))
+
+    def __repr__(self):
+        return f'RobustAccumulator({self.count} samples, {self.channels} channels)'
+
+    def __init_histogram__(self):
+        data = np.concatenate(self.warmup_data)
+        self.warmup_data = []
+        median = np.median(data, axis=0)
+        sigma = MAD_SIGMA * np.median(np.abs(data - median), axis=0)
+        sigma = np.where(sigma > 0, sigma, np.std(data, axis=0))
+        sigma = np.where(sigma > 0, sigma, 1e-9 * np.abs(median) + 1e-12)
+        self.lo = median - self.span * sigma
+        self.width = 2 * self.span * sigma / self.bins
+        self.__bin__(data)
+
+    def __histogram__(self):
+        '''
+        fixes the histogram from the samples so far if still warming up
+        '''
+        if self.lo is None and self.warmup_data:
+            self.__init_histogram__()
+
+    def __widen__(self, chunk):
+        '''
+        doubles the bin width of every channel until the chunk median is inside
+            the histogram, the old range stays centered
+        '''
+        median = np.median(chunk, axis=0)
+        merged = (np.arange(self.bins) + self.bins // 2) // 2
+        for c in np.flatnonzero(np.isfinite(median)):
+            while not self.lo[c] <= median[c] < self.lo[c] + self.bins * self.width[c]:
+                self.hist_count[c] = np.bincount(merged, weights=self.hist_count[c], minlength=self.bins)
+                self.hist_sum[c] = np.bincount(merged, weights=self.hist_sum[c], minlength=self.bins)
+                self.lo[c] -= self.bins // 2 * self.width[c]
+                self.width[c] *= 2
+
+    def __bin__(self, chunk):
+        index = np.floor((chunk - self.lo) / self.width).astype(np.int64)
+        inside = (index >= 0) & (index < self.bins)
+        flat = (index + np.arange(self.channels) * self.bins)[inside]
+        size = self.channels * self.bins
+        self.hist_count += np.bincount(flat, minlength=size).reshape((self.channels, self.bins))
+        self.hist_sum += np.bincount(flat, weights=chunk[inside], minlength=size).reshape((self.channels, self.bins))
+
+    def update(self, chunk: np.ndarray):
+        '''
+        chunk is an (n, channels) array
+        '''
+        n = chunk.shape[0]
+        if n == 0:
+            return self
+        # Chan et al. merge of the chunk mean/M2 into the running values
+        chunk_mean = chunk.mean(axis=0)
+        chunk_m2 = ((chunk - chunk_mean)**2).sum(axis=0)
+        total = self.count + n
+        delta = chunk_mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += chunk_m2 + delta**2 * self.count * n / total
+        self.count = total
+        if self.lo is None:
+            self.warmup_data.append(np.array(chunk, dtype=float))
+            if self.count >= self.warmup:
+                self.__init_histogram__()
+            return self
+        self.__widen__(chunk)
+        self.__bin__(chunk)
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / max(self.count - 1, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def __weighted_median__(self, values, weights, total):
+        '''
+        per channel median of (channels, k) values with weights, values sorted along axis 1
+        '''
+        cumulative = np.cumsum(weights, axis=1)
+        position = np.argmax(cumulative >= total[:, None] / 2, axis=1)
+        return np.take_along_axis(values, position[:, None], axis=1)[:, 0]
+
+    @property
+    def median(self):
+        self.__histogram__()
+        centers = self.lo[:, None] + (np.arange(self.bins) + 0.5) * self.width[:, None]
+        return self.__weighted_median__(centers, self.hist_count, np.full(self.channels, self.count, dtype=float))
+
+    @property
+    def mad(self):
+        '''
+        median absolute deviation from the median (raw, not scaled to sigma)
+        '''
+        self.__histogram__()
+        centers = self.lo[:, None] + (np.arange(self.bins) + 0.5) * self.width[:, None]
+        distance = np.abs(centers - self.median[:, None])
+        order = np.argsort(distance, axis=1)
+        return self.__weighted_median__(np.take_along_axis(distance, order, axis=1),
+                                        np.take_along_axis(self.hist_count, order, axis=1),
+                                        np.full(self.channels, self.count, dtype=float))
+
+    def __clip_mask__(self):
+        self.__histogram__()
+        centers = self.lo[:, None] + (np.arange(self.bins) + 0.5) * self.width[:, None]
+        # At least one bin, the MAD of a few identical samples is 0
+        limit = np.maximum(self.clip * MAD_SIGMA * self.mad, self.width)
+        return np.abs(centers - self.median[:, None]) <= limit[:, None]
+
+    @property
+    def clipped_mean(self):
+        '''
+        falls back to the plain mean for channels without samples in the clip window
+        '''
+        keep = self.__clip_mask__()
+        kept = (self.hist_count * keep).sum(axis=1)
+        return np.where(kept > 0, (self.hist_sum * keep).sum(axis=1) / np.maximum(kept, 1), self.mean)
+
+    @property
+    def clipped_count(self):
+        return (self.hist_count * self.__clip_mask__()).sum(axis=1).astype(int)
+
+    @property
+    def clipped_sem(self):
+        '''
+        standard error of the clipped mean, from the MAD
+        '''
+        return MAD_SIGMA * self.mad / np.sqrt(np.maximum(self.clipped_count, 1))
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.mean.copy(), 'std': self.std, 'median': self.median,
+                'mad': self.mad, 'clipped_mean': self.clipped_mean, 'clipped_sem': self.clipped_sem,
+                'rejected': self.count - self.clipped_count}
+
+def robust_mean(data: np.ndarray, clip=3.0):
+    '''
+    sigma clipped mean of every column of (n, m) data, see RobustAccumulator
+    '''
+    return RobustAccumulator(data.shape[1], clip).update(data).clipped_mean
+
+class SequentialMean(RobustAccumulator):
+    '''
+    RobustAccumulator for static measurements that decides itself how many
+        samples it needs.  Samples are taken in windows of window samples:
+        windows are discarded until the means of settle_windows consecutive
+        windows differ by less than drift_tolerance (plus their noise), after
+        that every window is accumulated.  A slow drift below the noise of a
+        window shows up as a difference between the first and second half of
+        the accumulated windows, all accumulated windows are then discarded
+        and the signal has to settle again.  Only the window means are kept,
+        not the samples.
+        done becomes True once min_samples are accumulated and the uncertainty
+        of every channel is at most target_sem.
+    uncertainty is the larger of clipped_sem and the batch means standard
+        error of the window means, which also holds for correlated noise.
+    target_sem and drift_tolerance are scalars or (channels,) arrays in the
+        units of the data, np.inf ignores a channel.
+    '''
+    def __init__(self, channels, target_sem, drift_tolerance=None, window=250, settle_windows=2, min_samples=1000,
+                 clip=3.0, bins=16384, span=25.0, warmup=256):
+        super().__init__(channels, clip, bins, span, warmup)
+        self.target_sem = np.broadcast_to(np.asarray(target_sem, dtype=float), (channels,))
+        self.drift_tolerance = (self.target_sem if drift_tolerance is None
+                                else np.broadcast_to(np.asarray(drift_tolerance, dtype=float), (channels,)))
+        self.window = window
+        self.settle_windows = settle_windows
+        self.min_samples = min_samples
+        self.settled = False
+        self.stable = 0
+        self.discarded = 0
+        self.previous = None
+        self.pending = np.zeros((0, channels))
+        self.window_means = []
+
+    def __repr__(self):
+        state = 'done' if self.done else ('settled' if self.settled else 'settling')
+        return f'SequentialMean({self.count} samples, {self.discarded} discarded, {state})'
+
+    def update(self, chunk: np.ndarray):
+        '''
+        chunk is an (n, channels) array, samples are used in whole windows
+        '''
+        self.pending = np.concatenate((self.pending, chunk)) if self.pending.shape[0] else chunk
+        full = self.pending.shape[0] // self.window * self.window
+        for start in range(0, full, self.window):
+            window = self.pending[start:start+self.window]
+            mean = window.mean(axis=0)
+            if not self.settled:
+                if self.previous is not None:
+                    noise = 3 * np.sqrt(2 / self.window) * window.std(axis=0, ddof=1)
+                    drifting = np.any(np.abs(mean - self.previous) > self.drift_tolerance + noise)
+                    self.stable = 0 if drifting else self.stable + 1
+                self.previous = mean
+                if self.stable < self.settle_windows:
+                    self.discarded += self.window
+                    continue
+                self.settled = True
+            super().update(window)
+            self.window_means.append(mean)
+            if self.count >= self.min_samples and self.__drifting__():
+                self.__restart__()
+        self.pending = self.pending[full:]
+        return self
+
+    def __drifting__(self, sigmas=3):
+        '''
+        True if the first and second half of the accumulated windows differ by
+            more than drift_tolerance plus sigmas standard errors
+        '''
+        half = len(self.window_means) // 2
+        if half == 0:
+            return False
+        first = np.mean(self.window_means[:half], axis=0)
+        second = np.mean(self.window_means[-half:], axis=0)
+        # Noise of a window mean from the scatter inside the windows, the drift does not inflate it
+        window_sem = MAD_SIGMA * self.mad / np.sqrt(self.window)
+        noise = sigmas * np.sqrt(2 / half) * window_sem
+        return bool(np.any(np.abs(second - first) > self.drift_tolerance + noise))
+
+    def __restart__(self):
+        '''
+        discards the accumulated windows and waits for the signal to settle
+            again, starting from the mean of the last window
+        '''
+        self.discarded += self.count
+        RobustAccumulator.__init__(self, self.channels, self.clip, self.bins, self.span, self.warmup)
+        self.previous = self.window_means[-1]
+        self.window_means = []
+        self.settled = False
+        self.stable = 0
+
+    @property
+    def uncertainty(self):
+        if self.count == 0:
+            return np.full(self.channels, np.inf)
+        sem = self.clipped_sem
+        if len(self.window_means) > 1:
+            batch = np.std(self.window_means, axis=0, ddof=1) / np.sqrt(len(self.window_means))
+            sem = np.maximum(sem, batch)
+        return sem
+
+    @property
+    def done(self):
+        return (self.settled and self.count >= self.min_samples and bool(np.all(self.uncertainty <= self.target_sem))
+                and not self.__drifting__(sigmas=2))
+
+    def require_done(self, what='Measurement', unit=''):
+        '''
+        Raises RuntimeError unless done, e.g. after accumulate_until_done
+            stopped at its sample limit
+        '''
+        if not self.done:
+            used = np.isfinite(self.target_sem)
+            raise RuntimeError(f'{what} did not converge within {self.count + self.discarded} samples '
+                               f'(uncertainty {np.max(self.uncertainty[used]):.2e} {unit}, '
+                               f'target {np.max(self.target_sem[used]):.0e} {unit})')
+        return self
+
+    def result(self):
+        '''
+        returns (clipped_mean, uncertainty, count)
+        '''
+        return (self.clipped_mean, self.uncertainty, self.count)
+
+    def summary(self):
+        return dict(super().summary(), uncertainty=self.uncertainty, discarded=self.discarded,
+                    settled=self.settled, done=self.done)
@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+import numpy as np
+from time import time
+from fieldmap import FieldMapFile, calibration_hash
+
+class ScanJob:
+    '''
+    Manifest of a line scan job, saved as JSON next to the data file
+        (default <filename>.job.json).
+    Records the planned lines in pcs, the alignment and calibration used and,
+        for every finished line, the offset and row count of its reduced data in
+        filename, so an interrupted job can be resumed.
+    A filename ending in .fmap is written as a FieldMapFile (offsets in rows),
+        anything else as %.6f text (offsets in bytes).
+    With keep_raw the raw volts (Vx, Vy, Vz, Vtemp), mcs positions and sample
+        times of every line also go to raw_filename (<name>.raw.fmap), so the
+        scan can be re-processed with another calibration (see recalibrate).
+    '''
+    VERSION = 1
+
+    def __init__(self, lines, filename, scan_interval=0.5, adaptive=False, manifest=None, keep_raw=False):
+        self.lines = np.asarray(lines, dtype=float).reshape((-1, 2, 3))
+        self.filename = filename
+        self.scan_interval = scan_interval
+        self.adaptive = adaptive
+        self.manifest = manifest if manifest is not None else f'{filename}.job.json'
+        self.alignment = {}
+        self.calibration = {}
+        self.metadata = {}
+        self.completed = {}
+        self.created = time()
+        self.lock = threading.Lock()
+        self.binary = filename.endswith(FieldMapFile.EXTENSION)
+        self.fieldmap = None
+        self.keep_raw = keep_raw
+        self.raw_filename = os.path.splitext(filename)[0] + '.raw' + FieldMapFile.EXTENSION
+        self.raw = None
+
+    def __repr__(self):
+        return f'ScanJob({self.manifest}, {len(self.completed)}/{self.lines.shape[0]} lines)'
+
+    @classmethod
+    def create(cls, probe, lines, filename, scan_interval=0.5, adaptive=False, manifest=None, metadata=None,
+               keep_raw=False, sensitivity=5):
+        '''
+        New job for a HallProbe, records its current alignment and calibration
+            and starts a new (empty) data file
+        metadata (e.g. part number and serial) is kept in the manifest and the
+            FieldMapFile header
+        '''
+        job = cls(lines, filename, scan_interval, adaptive, manifest, keep_raw)
+        job.alignment = {'rotation': probe.rotation.tolist(), 'translation': probe.translation.tolist()}
+        job.calibration = {'calib_coeffs': probe.calib_coeffs.tolist(), 's_matrix': probe.s_matrix.tolist(),
+                           'probe_offset': probe.probe_offset.tolist()}
+        job.metadata = dict(metadata or {})
+        header = dict(job.metadata, alignment=job.alignment, scan_interval=scan_interval,
+                      calibration_hash=calibration_hash(probe.calib_coeffs, probe.s_matrix, probe.probe_offset))
+        if keep_raw:
+            job.raw = FieldMapFile.create(job.raw_filename, dict(header, frame='mcs', sensitivity=sensitivity))
+        if job.binary:
+            job.fieldmap = FieldMapFile.create(filename, header)
+        else:
+            open(filename, 'wb').close()
+        job.save()
+        return job
+
+    @classmethod
+    def load(cls, manifest):
+        with open(manifest) as f:
+            state = json.load(f)
+        if state['version'] != cls.VERSION:
+            raise ValueError(f'Unsupported scan job version {state["version"]}')
+        job = cls(state['lines'], state['filename'], state['scan_interval'], state['adaptive'], manifest,
+                  state.get('keep_raw', False))
+        job.alignment = state['alignment']
+        job.calibration = state['calibration']
+        job.metadata = state.get('metadata', {})
+        job.created = state['created']
+        job.completed = {int(i): line for i, line in state['completed'].items()}
+        return job
+
+    def save(self):
+        '''
+        Writes the manifest atomically (temporary file + rename)
+        '''
+        state = {'version': self.VERSION, 'created': self.created, 'updated': time(),
+                 'filename': self.filename, 'scan_interval': self.scan_interval,
+                 'adaptive': self.adaptive, 'keep_raw': self.keep_raw, 'lines': self.lines.tolist(),
+                 'alignment': self.alignment, 'calibration': self.calibration, 'metadata': self.metadata,
+                 'completed': {str(i): line for i, line in sorted(self.completed.items())}}
+        temp = f'{self.manifest}.tmp'
+        with open(temp, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp, self.manifest)
+
+    def apply(self, probe):
+        '''
+        Restores the recorded alignment and calibration on a HallProbe so a
+            resumed job continues in the same reference frame
+        '''
+        probe.rotation = np.array(self.alignment['rotation'])
+        probe.translation = np.array(self.alignment['translation'])
+        probe.calib_coeffs = np.array(self.calibration['calib_coeffs'])
+        probe.s_matrix = np.array(self.calibration['s_matrix'])
+        probe.probe_offset = np.array(self.calibration['probe_offset'])
+        probe.update_transforms()
+
+    def remaining(self):
+        '''
+        indices of the lines that are not finished yet, in scan order
+        '''
+        return [i for i in range(self.lines.shape[0]) if i not in self.completed]
+
+    @property
+    def done(self):
+        return not self.remaining()
+
+    def data_end(self):
+        '''
+        offset in filename (bytes or rows) after the last finished line
+        '''
+        return max((line['offset'] + line['size'] for line in self.completed.values()), default=0)
+
+    def truncate(self):
+        '''
+        Drops anything written after the last finished line (e.g. a partial
+            append from an interrupted run)
+        '''
+        if self.keep_raw:
+            if self.raw is None:
+                self.raw = FieldMapFile(self.raw_filename, 'a')
+            self.raw.truncate(max((line['raw_offset'] + line['raw_rows'] for line in self.completed.values()),
+                                  default=0))
+        if self.binary:
+            if self.fieldmap is None:
+                self.fieldmap = FieldMapFile(self.filename, 'a')
+            self.fieldmap.truncate(self.data_end())
+            return
+        with open(self.filename, 'ab') as file:
+            file.truncate(self.data_end())
+
+    def append_line(self, index, reduced_data: np.ndarray, raw=None):
+        '''
+        Appends the (k, 6) reduced data of line index to filename and marks it
+            finished in the manifest
+        raw is (volts, positions, times) of the line, (n, 4), (n, 3) mcs and
+            (n,), stored in raw_filename if the job keeps raw data
+        '''
+        with self.lock:
+            line = {}
+            if self.keep_raw:
+                volts, positions, times = raw
+                line['raw_offset'] = len(self.raw)
+                line['raw_rows'] = volts.shape[0]
+                self.raw.append(positions, np.full(positions.shape, np.nan), volts=volts, timestamp=times, line=index)
+            if self.binary:
+                offset = len(self.fieldmap)
+                self.fieldmap.append(reduced_data[:, :3], reduced_data[:, 3:6], timestamp=time(), line=index)
+                size = reduced_data.shape[0]
+            else:
+                with open(self.filename, 'ab') as file:
+                    offset = file.tell()
+                    np.savetxt(file, reduced_data, fmt='%.6f')
+                    size = file.tell() - offset
+            line.update(offset=offset, size=size, rows=reduced_data.shape[0], time=time())
+            self.completed[index] = line
+            self.save()
+
+    def close(self):
+        if self.fieldmap is not None:
+            self.fieldmap.close()
+            self.fieldmap = None
+        if self.raw is not None:
+            self.raw.close()
+            self.raw = None
+
+    def line_data(self, index):
+        '''
+        returns the (k, 6) reduced data of a finished line
+        '''
+        line = self.completed[index]
+        if self.binary:
+            return FieldMapFile(self.filename).field_data(line['offset'], line['offset'] + line['size'])
+        with open(self.filename, 'rb') as file:
+            file.seek(line['offset'])
+            text = file.read(line['size'])
+        return np.loadtxt(text.decode().splitlines(), ndmin=2).reshape((-1, 6))
@@ -0,0 +1,459 @@
+'''
+Offline stand-ins for the cDAQ chassis and the Zeiss CMM.
+
+SimCMM is a local TCP server that speaks the subset of the CMM dialect used by
+zeisscmm.CMM (D01/D02/D16/D17/D19/D84/G02/G03/G53) on top of a Machine model
+with trapezoidal axis kinematics, servo lag and reply latency.
+SimHallDAQ / SimHallProbe replace the NI tasks with voltages synthesized from
+a MagnetModel evaluated at the machine position of every sample.
+
+Example:
+    bench = SimBench(MagnetModel([Dipole(center=(0, 0, 0), moment=(0, 0, 1))]))
+    probe = SimHallProbe('alignment.txt', 1, 2, bench=bench)
+    xyz, Bxyz = probe.scan_line(probe.pcs2mcs(start), probe.pcs2mcs(end))
+'''
+from nicdaq import HallDAQ, RingBuffer
+from hallprobe import HallProbe
+from zeisscmm import CMM
+from time import perf_counter, sleep
+import numpy as np
+import threading
+import socket
+import re
+
+MU0_4PI = 1e-7
+
+class Dipole:
+    '''
+    Point dipole source.
+    center in mm (machine coordinates), moment in A*m^2
+    '''
+    def __init__(self, center=(0, 0, 0), moment=(0, 0, 1.0)):
+        self.center = np.asarray(center, dtype=float)
+        self.moment = np.asarray(moment, dtype=float)
+
+    def field(self, xyz: np.ndarray, fsv=0):
+        '''
+        xyz is an (n, 3) array in mm, returns (n, 3) field in tesla
+        '''
+        r = (xyz - self.center) * 1e-3
+        r_norm = np.linalg.norm(r, axis=1, keepdims=True)
+        r_norm = np.maximum(r_norm, 1e-4)
+        r_hat = r / r_norm
+        m_dot_r = r_hat @ self.moment
+        return MU0_4PI * (3 * m_dot_r[:, None] * r_hat - self.moment) / r_norm**3
+
+class CurrentTrace:
+    '''
+    Straight current trace of the FSV tool, energized by HallDAQ.fsv_on.
+    point is any point on the trace (mm), direction its unit vector and
+    current the trace current in amps at +5 V.
+    '''
+    def __init__(self, point=(0, 0, 0), direction=(0, 1, 0), current=0.5):
+        self.point = np.asarray(point, dtype=float)
+        self.direction = np.asarray(direction, dtype=float) / np.linalg.norm(direction)
+        self.current = current
+
+    def field(self, xyz: np.ndarray, fsv=0):
+        if fsv == 0:
+            return np.zeros(xyz.shape)
+        r = (xyz - self.point) * 1e-3
+        r_perp = r - (r @ self.direction)[:, None] * self.direction
+        r_sq = np.maximum(np.sum(r_perp**2, axis=1, keepdims=True), 1e-10)
+        # B = mu0 I / (2 pi r) in the direction of dl x r
+        return 2 * MU0_4PI * fsv * self.current * np.cross(self.direction, r_perp) / r_sq
+
+class MagnetModel:
+    '''
+    Sum of field sources (Dipole, CurrentTrace, ...).
+    '''
+    def __init__(self, sources=()):
+        self.sources = list(sources)
+
+    def field(self, xyz: np.ndarray, fsv=0):
+        B = np.zeros(xyz.shape)
+        for source in self.sources:
+            B += source.field(xyz, fsv)
+        return B
+
+class Machine:
+    '''
+    Kinematic model of the CMM axes.
+    Every G02/G03 starts a straight segment from the current commanded position
+    with a trapezoidal speed profile limited by the G53 axis speeds.
+    The probe follows the commanded position with a servo delay, so
+    the D19 lag distance is roughly velocity * servo_delay.
+    '''
+    def __init__(self, position=(0, 0, 0), accel=100.0, servo_delay=0.02, speed=(20, 20, 20)):
+        self.accel = accel
+        self.servo_delay = servo_delay
+        self.speed = np.asarray(speed, dtype=float)
+        self.cnc = False
+        self.segments = [(perf_counter(), np.asarray(position, dtype=float), np.zeros(3), 0.0, 1.0)]
+        self.lock = threading.Lock()
+
+    def __profile__(self, tau, length, vmax):
+        '''
+        distance travelled tau seconds into a segment of the given length
+        '''
+        t_acc = vmax / self.accel
+        if self.accel * t_acc**2 > length:
+            # triangular profile, never reaches vmax
+            t_acc = np.sqrt(length / self.accel)
+            vmax = self.accel * t_acc
+            t_flat = 0.0
+        else:
+            t_flat = (length - self.accel * t_acc**2) / vmax
+        t_end = 2 * t_acc + t_flat
+        tau = np.clip(tau, 0, t_end)
+        s = np.where(tau < t_acc, 0.5 * self.accel * tau**2,
+                     np.where(tau < t_acc + t_flat,
+                              0.5 * self.accel * t_acc**2 + vmax * (tau - t_acc),
+                              length - 0.5 * self.accel * (t_end - tau)**2))
+        return (s, t_end)
+
+    def command_position(self, t):
+        '''
+        t is a scalar or (n,) array of perf_counter times, returns (3,) or (n, 3) positions
+        '''
+        t_arr = np.atleast_1d(np.asarray(t, dtype=float))
+        positions = np.empty((t_arr.shape[0], 3))
+        with self.lock:
+            segments = list(self.segments)
+        starts = np.array([seg[0] for seg in segments])
+        index = np.clip(np.searchsorted(starts, t_arr, side='right') - 1, 0, None)
+        for i in np.unique(index):
+            t0, p0, u, length, vmax = segments[i]
+            mask = index == i
+            s, _ = self.__profile__(t_arr[mask] - t0, length, vmax)
+            positions[mask] = p0 + np.outer(s, u)
+        return positions[0] if np.ndim(t) == 0 else positions
+
+    def actual_position(self, t):
+        return self.command_position(np.asarray(t) - self.servo_delay)
+
+    def lag(self, t):
+        return self.command_position(t) - self.actual_position(t)
+
+    def is_moving(self, t):
+        with self.lock:
+            t0, p0, u, length, vmax = self.segments[-1]
+        _, t_end = self.__profile__(0.0, length, vmax)
+        return t < t0 + t_end + self.servo_delay
+
+    def goto(self, xyz):
+        if not self.cnc:
+            return
+        now = perf_counter()
+        p0 = self.command_position(now)
+        delta = np.asarray(xyz, dtype=float) - p0
+        length = np.linalg.norm(delta)
+        if length == 0:
+            return
+        u = delta / length
+        # Path speed limited by whichever axis reaches its G53 speed first
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vmax = np.min(np.where(np.abs(u) > 1e-12, self.speed / np.abs(u), np.inf))
+        if not 0 < vmax < np.inf:
+            # An axis that has to move has zero speed, the move never completes
+            return
+        with self.lock:
+            self.segments.append((now, p0, u, length, vmax))
+            del self.segments[:-1000]
+
+    def step(self, dxyz):
+        self.goto(self.command_position(perf_counter()) + np.asarray(dxyz, dtype=float))
+
+class SimCMM:
+    '''
+    Local TCP stand-in for the CMM controller.
+    Use as zeisscmm.CMM(*sim.address), or through the cmm argument of
+    HallProbe, FSV and Cube.  Each connection is served on its own thread and
+    all connections share one Machine.
+    latency is the reply delay in seconds for query commands.
+    '''
+    COMMAND_RE = re.compile(r'([DG]\d\d)(.*)')
+    AXIS_RE = re.compile(r'([XYZ])([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)')
+
+    def __init__(self, machine=None, host='127.0.0.1', port=0, latency=0.0003):
+        self.machine = machine if machine is not None else Machine()
+        self.latency = latency
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen()
+        self.address = self.server.getsockname()
+        self.running = True
+        self.thread = threading.Thread(target=self.__accept__, daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return f'Simulated Zeiss CMM at {self.address[0]}:{self.address[1]}'
+
+    def __accept__(self):
+        while self.running:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.__serve__, args=(conn,), daemon=True).start()
+
+    def __serve__(self, conn):
+        buffer = ''
+        with conn:
+            while self.running:
+                try:
+                    chunk = conn.recv(4096)
+                except OSError:
+                    break
+                if not chunk:
+                    break
+                buffer += chunk.decode('ascii')
+                *commands, buffer = buffer.split('\r\n')
+                for command in commands:
+                    reply = self.handle(command.strip('\x01 '))
+                    if reply is not None:
+                        if self.latency:
+                            sleep(self.latency)
+                        conn.sendall(reply.encode('ascii'))
+
+    def __format_xyz__(self, xyz, fmt='+09.4f'):
+        return ''.join(f'{axis}{value:{fmt}}' for axis, value in zip('XYZ', xyz))
+
+    def __parse_xyz__(self, args, default):
+        xyz = np.array(default, dtype=float)
+        for axis, value in self.AXIS_RE.findall(args):
+            xyz['XYZ'.index(axis)] = float(value)
+        return xyz
+
+    def handle(self, command: str):
+        '''
+        Returns the reply string for one command or None for commands without reply.
+        '''
+        match = self.COMMAND_RE.match(command)
+        if match is None:
+            return None
+        code, args = match.groups()
+        now = perf_counter()
+        machine = self.machine
+        if code == 'D01':
+            machine.cnc = True
+        elif code == 'D02':
+            machine.cnc = False
+        elif code == 'D16':
+            return '@B\r\n' if machine.is_moving(now) else '@_\r\n'
+        elif code == 'D84':
+            return self.__format_xyz__(machine.command_position(now)) + '\r\n'
+        elif code == 'D17':
+            with machine.lock:
+                t0, p0, u, length, vmax = machine.segments[-1]
+            target = p0 + u * length
+            return (self.__format_xyz__(machine.command_position(now)) + 'W+000.0000'
+                    + self.__format_xyz__(target) + '\r\n')
+        elif code == 'D19':
+            return self.__format_xyz__(machine.lag(now), fmt='+08.4f') + '\r\n'
+        elif code == 'G53':
+            machine.speed = self.__parse_xyz__(args, machine.speed)
+        elif code == 'G02':
+            machine.goto(self.__parse_xyz__(args, machine.command_position(now)))
+        elif code == 'G03':
+            machine.step(self.__parse_xyz__(args, np.zeros(3)))
+        return None
+
+    def close(self):
+        self.running = False
+        self.server.close()
+
+class SimBench:
+    '''
+    Shared state of one simulated measurement setup.
+    model: MagnetModel evaluated at the probe position
+    cmm: SimCMM the probe is mounted on (created if None)
+    rate: actual sample clock of the hall sensor module in Hz
+        (the NI-9229 runs at 50 kS/s / n, 1612.9 Hz is its slowest clock)
+    noise: rms noise of the hall voltages in volts
+    probe_offset: sensor position relative to the reported CMM position in mm
+    '''
+    def __init__(self, model=None, cmm=None, rate=1612.9, noise=2e-4, temperature=20.0,
+                 probe_offset=(0, 0, 0), seed=None):
+        self.model = model if model is not None else MagnetModel()
+        self.cmm = cmm if cmm is not None else SimCMM()
+        self.rate = rate
+        self.noise = noise
+        self.temperature = temperature
+        self.probe_offset = np.asarray(probe_offset, dtype=float)
+        self.rng = np.random.default_rng(seed)
+
+    def connect(self):
+        return CMM(*self.cmm.address)
+
+    def hall_voltages(self, t: np.ndarray, volts_per_tesla=5, fsv=0):
+        '''
+        t is an (n,) array of sample times, returns (n, 4) volts (Vx, Vy, Vz, Vtemp)
+        '''
+        xyz = self.cmm.machine.actual_position(t) - self.probe_offset
+        volts = np.empty((t.shape[0], 4))
+        volts[:, :3] = self.model.field(xyz, fsv) * volts_per_tesla
+        volts[:, 3] = 0.0
+        volts += self.rng.normal(0, self.noise, volts.shape)
+        return volts
+
+class SimDAQMixin:
+    '''
+    Replaces every NI task of HallDAQ with the SimBench.
+    Place it before HallDAQ (or a HallDAQ subclass) in the bases.
+    '''
+    def __init__(self, *args, bench=None, **kwargs):
+        self.bench = bench if bench is not None else SimBench()
+        self.fsv_state = 0
+        self.volts_per_tesla = self.SENSOR_RANGE['2T']
+        self.acq_start = None
+        self.stream_thread = None
+        super().__init__(*args, **kwargs)
+
+    def __create_tasks__(self):
+        pass
+
+    def __configure_tasks__(self):
+        pass
+
+    def change_sampling(self, rate, num_samples):
+        self.RATE = rate
+        self.SAMPLES_CHAN = num_samples
+
+    def sample_clock_rate(self):
+        return self.bench.rate
+
+    def device_signature(self):
+        return f'SimBench:{self.bench.rate}'
+
+    def change_sensitivity(self, sensitivity=None):
+        if sensitivity is not None:
+            self.volts_per_tesla = 100 if sensitivity.upper().replace(' ', '') == '100MT' else 5
+
+    def close_tasks(self):
+        self.stop_stream()
+
+    def fsv_on(self, v='positive'):
+        self.fsv_state = 1 if v == 'positive' else -1
+
+    def fsv_off(self):
+        self.fsv_state = 0
+
+    def power_on(self, sensitivity='2T'):
+        self.power_status = True
+
+    def power_off(self):
+        self.power_status = False
+
+    def pulse(self):
+        if self.hs_task_status and self.acq_start is None:
+            self.acq_start = perf_counter()
+
+    def start_hallsensor_task(self):
+        if not self.hs_task_status:
+            self.hs_task_status = True
+            self.acq_start = None if self.trigger_status else perf_counter()
+
+    def stop_hallsensor_task(self):
+        self.hs_task_status = False
+        self.acq_start = None
+
+    def start_magnet_temp_task(self):
+        self.mag_temp_task_status = True
+
+    def stop_magnet_temp_task(self):
+        self.mag_temp_task_status = False
+
+    def __sample_times__(self, first, num_samples):
+        return self.acq_start + (first + np.arange(num_samples)) / self.bench.rate
+
+    def read_hallsensor(self, timeout=None, out=None):
+        while self.acq_start is None:
+            sleep(0.001)
+        t = self.__sample_times__(0, self.SAMPLES_CHAN)
+        remaining = t[-1] - perf_counter()
+        if remaining > 0:
+            sleep(remaining)
+        volts = self.bench.hall_voltages(t, self.volts_per_tesla, self.fsv_state)
+        if out is not None:
+            out = out[:volts.shape[0]]
+            np.copyto(out, volts)
+            return out
+        return volts
+
+    def read_magnet_temp(self, timeout=None):
+        shape = (self.SAMPLES_CHAN, 8)
+        return self.bench.temperature + self.bench.rng.normal(0, 0.01, shape)
+
+    def start_stream(self, chunk_size=1000, buffer_samples=2**21):
+        if self.stream is not None:
+            raise RuntimeError('Hall sensor stream is already running')
+        self.stop_hallsensor_task()
+        self.stream = RingBuffer(buffer_samples, channels=4)
+        self.stream_chunk = chunk_size
+        self.stream_rate = self.bench.rate
+        self.stream_clock = RingBuffer(self.CLOCK_MARKS, channels=2)
+        self.start_hallsensor_task()
+        self.stream_thread = threading.Thread(target=self.__stream_worker__, daemon=True)
+        self.stream_thread.start()
+        return self.stream
+
+    def __stream_worker__(self):
+        stream = self.stream
+        written = 0
+        while self.hs_task_status and not stream.closed:
+            if self.acq_start is None:
+                sleep(0.001)
+                continue
+            t = self.__sample_times__(written, self.stream_chunk)
+            remaining = t[-1] - perf_counter()
+            if remaining > 0:
+                sleep(remaining)
+            stream.write(self.bench.hall_voltages(t, self.volts_per_tesla, self.fsv_state))
+            written += self.stream_chunk
+            self.stream_clock.write(np.array([[stream.head, perf_counter()]]))
+
+    def stop_stream(self):
+        if self.stream is None:
+            return
+        self.stop_hallsensor_task()
+        self.stream.close()
+        if self.stream_thread is not None:
+            self.stream_thread.join()
+            self.stream_thread = None
+        self.stream = None
+
+class SimHallDAQ(SimDAQMixin, HallDAQ):
+    '''
+    Drop-in HallDAQ backed by a SimBench, e.g. FSV(..., daq=SimHallDAQ(1, 10000, bench=bench))
+    '''
+    pass
+
+class SimHallProbe(SimDAQMixin, HallProbe):
+    '''
+    HallProbe on a SimBench.  Connects to bench.cmm unless cmm is given.
+    '''
+    def __init__(self, coord_diff: str, rate: int, samps_per_chan: int, start_trigger=True,
+                 acquisition='finite', bench=None, cmm=None, measure_sample_rate=False):
+        bench = bench if bench is not None else SimBench()
+        cmm = cmm if cmm is not None else bench.connect()
+        super().__init__(coord_diff, rate, samps_per_chan, start_trigger, acquisition,
+                         bench=bench, cmm=cmm, measure_sample_rate=measure_sample_rate)
+
+
+if __name__ == '__main__':
+    import tempfile
+    import os
+    bench = SimBench(MagnetModel([Dipole(center=(10, 20, -5), moment=(0, 0, 1.0))]), seed=0)
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file:
+        file.write('1 0 0 0 1 0 0 0 1 0 0 0\n')
+    probe = SimHallProbe(file.name, 1, 2, bench=bench)
+    start = perf_counter()
+    xyz, Bxyz = probe.scan_line(np.array([-15., 20, 0]), np.array([35., 20, 0]))
+    print(f'Scanned {xyz.shape[0]} samples in {perf_counter() - start:.1f} s')
+    print(f'Peak field: {np.abs(Bxyz).max():.1f} mT')
+    probe.shutdown()
+    bench.cmm.close()
+    os.remove(file.name)
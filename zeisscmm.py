@@ -1,15 +1,51 @@
-from time import sleep
+from time import sleep, perf_counter
+from functools import partial
 import numpy as np
+import threading
+import asyncio
 import socket
 import re
 
+POSITION_RE = re.compile(r'[+-]\d+\.\d+')
+NUMBER_RE = re.compile(r'[+-]\d*\.\d+')
+
+def parse_position(reply: str):
+    return np.array([float(i) for i in POSITION_RE.findall(reply)])
+
+def parse_positions(reply: str):
+    position_np = np.array([float(i) for i in NUMBER_RE.findall(reply)])
+    return (position_np[:3], position_np[4:])
+
+def parse_lag(reply: str):
+    return np.array([float(i) for i in NUMBER_RE.findall(reply)][:3])
+
 class CMM(socket.socket):
     '''
     Creates a TCP connection to the Zeiss CMM.
+    Replies are read through a receive buffer and split on REPLY_TERMINATOR,
+    so a reply split across packets or several replies in one packet are
+    handled.  query_many() pipelines several queries in one round trip.
+    Every send and receive times out after timeout seconds, a reply that does
+    not arrive raises TimeoutError instead of blocking the scan thread.  The
+    next query first drains any late reply (see resync), so it is not read as
+    the answer to that query.
     '''
-    def __init__(self, ip='192.4.1.200', port=4712):
+    REPLY_TERMINATOR = b'\r\n'
+    PARSERS = {'D16': str,
+               'D17': parse_positions,
+               'D19': parse_lag,
+               'D84': parse_position}
+
+    def __init__(self, ip='192.4.1.200', port=4712, timeout=5.0):
         super().__init__(socket.AF_INET, socket.SOCK_STREAM)
+        self.settimeout(timeout)
+        # Nagle's algorithm delays the short query packets (see packet_timer.py)
+        self.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.connect((ip, port))
+        # One request/reply exchange at a time when polled from several threads
+        self.lock = threading.RLock()
+        self.rx_buffer = b''
+        self.out_of_step = False
         self.cnc_status = False
         self.speed = None
         # self.position = None
@@ -18,16 +54,74 @@ class CMM(socket.socket):
     def __repr__(self):
         return 'Zeiss CMM Object'
 
+    def __command__(self, command: str):
+        '''
+        sends a command that has no reply
+        '''
+        with self.lock:
+            self.sendall(f'{command}\r\n'.encode('ascii'))
+
+    def __read_reply__(self):
+        while self.REPLY_TERMINATOR not in self.rx_buffer:
+            try:
+                chunk = self.recv(1024)
+            except socket.timeout:
+                self.out_of_step = True
+                raise TimeoutError(f'No reply from the CMM within {self.gettimeout()} s (received '
+                                   f'{len(self.rx_buffer)} bytes without {self.REPLY_TERMINATOR!r})') from None
+            if not chunk:
+                raise ConnectionError('CMM closed the connection')
+            self.rx_buffer += chunk
+        reply, self.rx_buffer = self.rx_buffer.split(self.REPLY_TERMINATOR, 1)
+        return reply.decode('ascii')
+
+    def resync(self, quiet=0.2):
+        '''
+        Discards buffered and late replies until the CMM has sent nothing for
+            quiet seconds.  Called before the next query after a timeout.
+        '''
+        with self.lock:
+            timeout = self.gettimeout()
+            self.settimeout(quiet)
+            try:
+                while True:
+                    chunk = self.recv(1024)
+                    if not chunk:
+                        raise ConnectionError('CMM closed the connection')
+            except socket.timeout:
+                pass
+            finally:
+                self.settimeout(timeout)
+            self.rx_buffer = b''
+            self.out_of_step = False
+
+    def __query__(self, command: str):
+        return self.query_many([command], parse=False)[0]
+
+    def query_many(self, commands, parse=True):
+        '''
+        Sends all commands (e.g. ['D16', 'D84', 'D19']) in one packet and reads
+            the replies, which the controller answers in order.
+        returns a list with one reply per command, parsed with PARSERS when parse=True
+        '''
+        with self.lock:
+            if self.out_of_step:
+                self.resync()
+            self.sendall(''.join(f'{command}\r\n\x01' for command in commands).encode('ascii'))
+            replies = [self.__read_reply__() for command in commands]
+        if parse:
+            replies = [self.PARSERS.get(command, str)(reply) for command, reply in zip(commands, replies)]
+        return replies
+
     def get_status(self):
-        self.send('D16\r\n\x01'.encode('ascii'))
-        self.status = self.recv(1024).decode('ascii')
+        self.status = self.__query__('D16')
         return self.status
     
     def cnc_on(self):
-        self.send('D01\r\n'.encode('ascii'))
+        self.__command__('D01')
         self.cnc_status = True
     def cnc_off(self):
-        self.send('D02\r\n'.encode('ascii'))
+        self.__command__('D02')
         self.cnc_status = False
 
     def set_speed(self, speed):
@@ -35,7 +129,7 @@ class CMM(socket.socket):
         speed in mm/s (3,) array
         '''
         self.speed = speed
-        self.send(f'G53X{round(speed[0], 3)}Y{round(speed[1], 3)}Z{round(speed[2], 3)}\r\n'.encode('ascii'))
+        self.__command__(f'G53X{round(speed[0], 3)}Y{round(speed[1], 3)}Z{round(speed[2], 3)}')
     
     def wait(self, delay):
         while '@_' in self.get_status():
@@ -45,27 +139,248 @@ class CMM(socket.socket):
         sleep(delay)
     
     def goto_position(self, xyz):
-        self.send(f'G02X{xyz[0]}Y{xyz[1]}Z{xyz[2]}\r\n'.encode('ascii'))
+        self.__command__(f'G02X{xyz[0]}Y{xyz[1]}Z{xyz[2]}')
     
     def step_cmm(self, xyz):
-        self.send(f'G03X{xyz[0]}Y{xyz[1]}Z{xyz[2]}\r\n'.encode('ascii'))
+        self.__command__(f'G03X{xyz[0]}Y{xyz[1]}Z{xyz[2]}')
 
     def get_position(self):
-        self.send('D84\r\n\x01'.encode('ascii'))
-        position_str = self.recv(1024).decode('ascii')
-        return np.array([float(i) for i in re.findall(r'[+-]\d+\.\d+', position_str)])
+        return parse_position(self.__query__('D84'))
     
     def get_positions(self):
-        self.send('D17\r\n\x01'.encode('ascii'))
-        position_str = self.recv(1024).decode('ascii')
-        position_np = np.array([float(i) for i in re.findall(r'[+-]\d*\.\d+', position_str)])
-        return (position_np[:3], position_np[4:])
+        return parse_positions(self.__query__('D17'))
     
     def get_lag_distance(self):
-        self.send('D19\r\n\x01'.encode('ascii'))
-        lag = self.recv(1024).decode('ascii')
-        lag_np = np.array([float(i) for i in re.findall(r'[-\+]\d*\.\d+', lag)][:3])
-        return lag_np
+        return parse_lag(self.__query__('D19'))
+
+    def get_state(self):
+        '''
+        status, position and lag distance in one pipelined round trip
+        returns (status str, (3,) position, (3,) lag)
+        '''
+        self.status, position, lag = self.query_many(['D16', 'D84', 'D19'])
+        return (self.status, position, lag)
+
+    def estimate_arrival(self, target, position=None):
+        '''
+        estimated travel time in seconds from position (default: current
+            position) to target at the last set speed, ignoring acceleration
+        '''
+        if position is None:
+            position = self.get_position()
+        delta = np.asarray(target) - position
+        distance = np.linalg.norm(delta)
+        if distance == 0:
+            return 0.0
+        speed = np.asarray(self.speed if self.speed is not None else (70, 70, 70), dtype=float)
+        direction = np.abs(delta) / distance
+        moving_axes = direction > 1e-9
+        # Path speed is limited by the first axis to reach its set speed
+        path_speed = np.min(speed[moving_axes] / direction[moving_axes])
+        return distance / path_speed
+
+    def wait_until_arrived(self, target, tol=0.025, timeout=None, min_interval=0.002, max_interval=0.1, stall_time=2.0):
+        '''
+        Blocks until the CMM position is within tol (mm) of target.
+        Status and position are polled in one pipelined round trip with a
+            poll interval of half the remaining estimated travel time,
+            clipped to [min_interval, max_interval].
+        timeout in seconds, by default 3x the estimated travel time + 10 s.
+        Raises TimeoutError when the timeout expires or the controller reports
+            idle (D16 '@_') away from target for longer than stall_time.
+        returns the final (3,) position
+        '''
+        target = np.asarray(target, dtype=float)
+        start = perf_counter()
+        idle_since = None
+        while True:
+            status, position = self.query_many(['D16', 'D84'])
+            self.status = status
+            distance = np.linalg.norm(target - position)
+            if distance <= tol:
+                return position
+            now = perf_counter()
+            eta = self.estimate_arrival(target, position)
+            if timeout is None:
+                timeout = 3 * eta + 10
+            if now - start > timeout:
+                raise TimeoutError(f'CMM did not reach {target} within {timeout:.1f} s (last position {position})')
+            if '@_' in status:
+                idle_since = now if idle_since is None else idle_since
+                if now - idle_since > stall_time:
+                    raise TimeoutError(f'CMM stopped at {position}, {distance:.3f} mm from {target}')
+            else:
+                idle_since = None
+            sleep(min(max(eta / 2, min_interval), max_interval))
+
+    async def wait_until_arrived_async(self, target, **kwargs):
+        '''
+        asyncio version of wait_until_arrived, polls on the default executor.
+        Several waits can run at once, they share the connection through self.lock.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(self.wait_until_arrived, target, **kwargs))
+
+class PositionPoller:
+    '''
+    Background thread that queries the CMM position (D84) as fast as the
+    controller answers and keeps (perf_counter, x, y, z) rows in a fixed size
+    ring buffer.  Each row is stamped with the midpoint of its round trip.
+    With lag=True the lag distance (D19) is pipelined with every position
+        query and the rows are (t, x, y, z, lag_x, lag_y, lag_z).
+    Use interpolate() to map sample times (e.g. DAQ samples) to positions.
+    An exception in the poll thread ends polling, it is raised again by
+        stop() and interpolate().
+    '''
+    def __init__(self, cmm: CMM, capacity=2**16, interval=0.0, lag=False):
+        self.cmm = cmm
+        self.capacity = capacity
+        self.interval = interval
+        self.lag = lag
+        self.data = np.zeros((capacity, 7 if lag else 4))
+        self.count = 0
+        self.running = False
+        self.thread = None
+        self.error = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def __run__(self):
+        try:
+            while self.running:
+                t_send = perf_counter()
+                if self.lag:
+                    xyz, lag = self.cmm.query_many(['D84', 'D19'])
+                else:
+                    xyz = self.cmm.get_position()
+                t_recv = perf_counter()
+                if xyz.shape[0] == 3:
+                    with self.lock:
+                        row = self.data[self.count % self.capacity]
+                        row[0] = (t_send + t_recv) / 2
+                        row[1:4] = xyz
+                        if self.lag:
+                            row[4:] = lag
+                        self.count += 1
+                if self.interval:
+                    sleep(self.interval)
+        except Exception as error:
+            self.error = error
+            self.running = False
+
+    def __raise_error__(self):
+        if self.error is not None:
+            raise RuntimeError('Position polling failed') from self.error
+
+    def start(self):
+        '''
+        Clears the buffer and starts polling
+        '''
+        if self.running:
+            return
+        self.count = 0
+        self.error = None
+        self.running = True
+        self.thread = threading.Thread(target=self.__run__, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.__raise_error__()
+
+    def snapshot(self):
+        '''
+        returns (m, 4) array of the buffered (t, x, y, z) rows, oldest first
+        '''
+        with self.lock:
+            n = min(self.count, self.capacity)
+            start = self.count % self.capacity if self.count > self.capacity else 0
+            return np.roll(self.data[:n], -start, axis=0)
+
+    def window(self):
+        '''
+        returns (t_first, t_last) of the buffered rows
+        '''
+        with self.lock:
+            if self.count == 0:
+                raise RuntimeError('No positions have been polled')
+            first = self.data[self.count % self.capacity if self.count > self.capacity else 0, 0]
+            return (first, self.data[(self.count - 1) % self.capacity, 0])
+
+    def interpolate(self, t: np.ndarray):
+        '''
+        t is an (n,) array of perf_counter times
+        returns (n, 3) positions linearly interpolated between polled positions
+        Raises ValueError for times outside the buffered rows (before polling
+            started, after it stopped or already overwritten in the ring buffer).
+        '''
+        self.__raise_error__()
+        history = self.snapshot()
+        if history.shape[0] == 0:
+            raise RuntimeError('No positions have been polled')
+        t = np.asarray(t)
+        if t.size and (t.min() < history[0, 0] or t.max() > history[-1, 0]):
+            raise ValueError(f'Times {t.min():.3f}..{t.max():.3f} s are outside the polled window '
+                             f'{history[0, 0]:.3f}..{history[-1, 0]:.3f} s')
+        return np.column_stack([np.interp(t, history[:, 0], history[:, i]) for i in (1, 2, 3)])
+
+class LagModel:
+    '''
+    Per-axis servo lag model lag = gain * velocity.
+    lag is the D19 lag distance (commanded - actual position), so the actual
+        probe position is the reported position minus the predicted lag.
+    The gains are least squares fits through the origin, accumulated over
+        every call to update() so each scan refines the model.
+    '''
+    def __init__(self):
+        self.sum_vl = np.zeros(3)
+        self.sum_vv = np.zeros(3)
+
+    @property
+    def gain(self):
+        '''
+        (3,) lag in mm per mm/s of axis velocity, i.e. the servo delay in seconds
+        '''
+        return np.divide(self.sum_vl, self.sum_vv, out=np.zeros(3), where=self.sum_vv > 0)
+
+    def update(self, velocity: np.ndarray, lag: np.ndarray):
+        '''
+        velocity and lag are (n, 3) arrays sampled at the same times
+        '''
+        self.sum_vl += np.sum(velocity * lag, axis=0)
+        self.sum_vv += np.sum(velocity * velocity, axis=0)
+
+    def update_from_poller(self, poller: PositionPoller):
+        '''
+        fits the polled lag distances against the velocity of the polled positions
+        '''
+        history = poller.snapshot()
+        if history.shape[0] < 3 or history.shape[1] < 7:
+            return
+        velocity = np.gradient(history[:, 1:4], history[:, 0], axis=0)
+        self.update(velocity, history[:, 4:7])
+
+    def predict(self, velocity: np.ndarray):
+        return velocity * self.gain
+
+    def correct(self, positions: np.ndarray, times: np.ndarray):
+        '''
+        positions is an (n, 3) array of reported positions at the (n,) sample times
+        returns (n, 3) lag compensated positions
+        '''
+        if positions.shape[0] < 2:
+            return positions.copy()
+        velocity = np.gradient(positions, times, axis=0)
+        return positions - self.predict(velocity)
 
 
 def generate_scan_area(start_point, x_length, y_length, grid=0.5):
@@ -74,15 +389,12 @@ def generate_scan_area(start_point, x_length, y_length, grid=0.5):
     function returns an (n, 3) array of waypoints for hall probe scanning a single plane
     '''
     end_point = start_point + [x_length, y_length, 0]
-    num_waypoints = 4*y_length + 2
-    num_y_patterns = int((num_waypoints-2)/4)
-    x_pattern = np.tile(np.array([end_point[0], end_point[0], start_point[0], start_point[0]]), num_y_patterns)
-    x = x_pattern.copy()
-    x = np.insert(x, 0, start_point[0])
-    
-    x = np.append(x, end_point[0])
-    y = np.array([[i, i] for i in np.arange(start_point[1], end_point[1]+grid, grid)]).flatten()
-    z = np.array([start_point[2]]*num_waypoints)
+    y_lines = np.arange(start_point[1], end_point[1]+grid/2, grid)
+    # Serpentine: even lines run start -> end along x, odd lines end -> start
+    forward = np.arange(y_lines.shape[0]) % 2 == 0
+    x = np.where(forward[:, None], [start_point[0], end_point[0]], [end_point[0], start_point[0]]).flatten()
+    y = np.repeat(y_lines, 2)
+    z = np.full(x.shape[0], start_point[2])
     xyz = np.array([x, y, z]).T
     
     return xyz
@@ -92,23 +404,10 @@ def generate_scan_volume(start_point, x_length, y_length, z_length, grid=0.5):
     function returns a (z index, waypoints, xyz columns) array which is a stack of planes along z
     '''
     end_point = start_point + [x_length, y_length, z_length]
-    num_waypoints = int(2*(1/grid)*y_length + 2)
-    num_y_patterns = int((num_waypoints-2)/4)
-    x_pattern = np.tile(np.array([end_point[0], end_point[0], start_point[0], start_point[0]]), num_y_patterns)
-    x = x_pattern.copy()
-    x = np.insert(x, 0, start_point[0])
-    
-    x = np.append(x, end_point[0])
-    y = np.array([[i, i] for i in np.arange(start_point[1], end_point[1]+grid, grid)]).flatten()
-    z_wp = np.array([start_point[2]]*num_waypoints)
-    xyz_wp = np.array([x, y, z_wp]).T
-    z = np.arange(start_point[2], end_point[2]+grid, grid)
-    volume = np.zeros((z.shape[0], x.shape[0], 3))
-    new_z = xyz_wp.copy()
-
-    for h in range(volume.shape[0]):
-        new_z[:, 2] = z[h]
-        volume[h] = new_z
+    xyz_wp = generate_scan_area(start_point, x_length, y_length, grid)
+    z = np.arange(start_point[2], end_point[2]+grid/2, grid)
+    volume = np.repeat(xyz_wp[None], z.shape[0], axis=0)
+    volume[:, :, 2] = z[:, None]
     
     return volume
 
@@ -119,32 +418,11 @@ def transform_points(xyz_array, translation, rotation, inverse=False):
     rotation is a (3,3) array
     use inverse=True to go from mcs to pcs coordinates
     '''
-    xyz_array_copy = xyz_array.copy()
+    # Points are rows, so rotation@point is point@rotation.T for all points at once
     if not inverse:
-        if xyz_array.ndim == 1:
-            xyz_array_copy = rotation@xyz_array + translation
-        
-        elif xyz_array.ndim == 2:
-            for i, point in enumerate(xyz_array):
-                xyz_array_copy[i] = rotation@point + translation
-
-        elif xyz_array.ndim == 3:
-            for i, height in enumerate(xyz_array):
-                for j, point in enumerate(height):
-                    xyz_array_copy[i, j] = rotation@point + translation
-
+        xyz_array_copy = xyz_array@rotation.T + translation
     else:
-        if xyz_array.ndim == 1:
-            xyz_array_copy = np.linalg.inv(rotation)@(xyz_array - translation)
-        
-        elif xyz_array.ndim == 2:
-            for i, point in enumerate(xyz_array):
-                xyz_array_copy[i] = np.linalg.inv(rotation)@(point - translation)
-
-        elif xyz_array.ndim == 3:
-            for i, height in enumerate(xyz_array):
-                for j, point in enumerate(height):
-                    xyz_array_copy[i, j] = np.linalg.inv(rotation)@(point - translation)
+        xyz_array_copy = (xyz_array - translation)@np.linalg.inv(rotation).T
     return xyz_array_copy
 
 if __name__ == '__main__':
@@ -1,21 +1,37 @@
 import numpy as np
 from nicdaq import HallDAQ
+from robust import SequentialMean
 import tkinter as tk
 from tkinter import ttk
+from tkinter import messagebox
 from PIL import Image, ImageTk
+from jobs import JobExecutor
 
 class ZeroGauss:
-    def __init__(self):
-        self.daq = HallDAQ(1, 20000)
+    # Standard error of the mean (V) of Vx, Vy, Vz, the temperature channel is not used
+    TARGET_SEM = (5e-6, 5e-6, 5e-6, np.inf)
+    MAX_SAMPLES = 13750
+
+    def __init__(self, daq=None):
+        self.daq = daq if daq is not None else HallDAQ(1, 20000)
     
-    def measure_offset(self):
+    def measure_offset(self, on_chunk=None):
+        '''
+        on_chunk(stats) is called after every chunk with the SequentialMean
+        Raises RuntimeError if TARGET_SEM is not reached within MAX_SAMPLES.
+        '''
+        self.stats = SequentialMean(4, self.TARGET_SEM)
         self.daq.power_on()
-        self.daq.start_hallsensor_task()
-        data = self.daq.read_hallsensor()[6250:13750]
-        self.daq.stop_hallsensor_task()
-        self.daq.power_off()
-        self.daq.close_tasks()
-        self.zg_offset = np.mean(data, axis=0)
+        self.daq.start_stream()
+        try:
+            # Samples are averaged as they arrive, from settling until TARGET_SEM is met
+            self.daq.accumulate_until_done(self.stats, self.MAX_SAMPLES, on_chunk=on_chunk)
+        finally:
+            self.daq.stop_stream()
+            self.daq.power_off()
+            self.daq.close_tasks()
+        self.stats.require_done('Offset', 'V')
+        self.zg_offset = self.stats.clipped_mean
     
     def save_offset(self, filename):
         with open(filename, 'w') as file:
@@ -29,24 +45,62 @@ class zgWindow(tk.Toplevel):
         self.img = ImageTk.PhotoImage(Image.open('images/zg_chamber1.jpg'))
         self.geometry('1200x800')
         self.title('Zero Gauss Offset')
+        self.executor = JobExecutor(self)
         self.create_widgets()
+        self.protocol('WM_DELETE_WINDOW', self.close_window)
     
     def create_widgets(self):
         self.btn_zg_run = ttk.Button(self.frm_zg_window, text='Record Offset', command=self.run_zg)
-        self.btn_close = ttk.Button(self.frm_zg_window, text='Close', command=self.destroy)
+        self.btn_cancel = ttk.Button(self.frm_zg_window, text='Cancel', command=self.executor.cancel, state='disabled')
+        self.btn_close = ttk.Button(self.frm_zg_window, text='Close', command=self.close_window)
         self.lbl_desc = ttk.Label(self.frm_zg_window, text='Move probe into zero gauss chamber as shown.')
         self.lbl_img = ttk.Label(self.frm_zg_window, image=self.img)
         self.btn_zg_run.grid(column=0, row=0, padx=5, pady=5, sticky='nw')
-        self.btn_close.grid(column=0, row=1, padx=5, pady=5, sticky='nw')
+        self.btn_cancel.grid(column=0, row=1, padx=5, pady=5, sticky='nw')
+        self.btn_close.grid(column=0, row=2, padx=5, pady=5, sticky='nw')
         self.lbl_desc.grid(column=1, row=0, padx=5, pady=5, sticky='w')
-        self.lbl_img.grid(column=1, row=1, padx=5, pady=5)
-        self.btn_zg_run.bind('<Button-1>', lambda event: self.lbl_desc.configure(text='Please wait.  Recording samples...'))
+        self.lbl_img.grid(column=1, row=1, padx=5, pady=5, rowspan=3)
     
     def run_zg(self):
+        self.btn_zg_run.configure(state='disabled')
+        self.btn_cancel.configure(state='enabled')
+        self.lbl_desc.configure(text='Please wait.  Recording samples...')
+        self.executor.submit(self.__record_offset__, name='zero gauss offset',
+                             on_progress=lambda message, partial: self.lbl_desc.configure(text=message),
+                             on_done=lambda offset: self.finish('Signal offset saved.  You may now close the window.'),
+                             on_error=lambda error: self.finish(f'Recording failed: {error}', error),
+                             on_cancel=lambda: self.finish('Recording cancelled.'))
+
+    def __record_offset__(self, job):
+        '''
+        runs on the executor thread
+        '''
+        def on_chunk(stats):
+            if stats.settled:
+                job.progress(f'Recording samples... {stats.count} samples, '
+                             f'uncertainty {np.max(stats.uncertainty[:3]):.2e} V')
+            else:
+                job.progress(f'Waiting for the signal to settle... {stats.discarded} samples')
         zg = ZeroGauss()
-        zg.measure_offset()
+        zg.measure_offset(on_chunk=on_chunk)
         zg.save_offset('zg_offset.txt')
-        self.lbl_desc.configure(text='Signal offset saved.  You may now close the window.')
+        return zg.zg_offset
+
+    def finish(self, message, error=None):
+        self.btn_cancel.configure(state='disabled')
+        self.btn_zg_run.configure(state='enabled')
+        self.lbl_desc.configure(text=message)
+        if error is not None:
+            messagebox.showerror(title='Error', message=str(error))
+
+    def close_window(self):
+        if self.executor.busy:
+            # Wait for the running acquisition to reach a safe point
+            self.executor.cancel()
+            self.after(100, self.close_window)
+            return
+        self.executor.shutdown()
+        self.destroy()
 
 if __name__ == '__main__':
     test = ZeroGauss()